@@ -1,9 +1,11 @@
 import asyncio
 import re
+import time
 import typing
 
 import aiohttp
 import discord
+from discord.ext import tasks
 from yaml import load
 
 try:
@@ -11,6 +13,14 @@ try:
 except ImportError:
     from yaml import Loader
 
+import catalog
+import clients
+import metrics
+import series
+import state
+import tracing
+import tracker
+
 
 class DiscordClient(discord.Client):
     # request headers
@@ -23,35 +33,44 @@ class DiscordClient(discord.Client):
         'k': 1000
     }
     current_amount: float = 0
+    poll_every = 5.0  # seconds between polls of the donation total
 
     def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
         self.config = load(open('config.yaml', 'r'), Loader)
+        super().__init__(*args, **dict(clients.options(self.config, 'anticheat'), **kwargs))
         # aiohttp session, do not change
         # (it gets defined later because it yelled at me for creating in non-async func)
         self.session: typing.Optional[aiohttp.ClientSession] = None
-
-    async def load_gdq_json(self, query):
+        self.tracker: typing.Optional[tracker.TrackerClient] = None
+        self.metrics = None  # metrics server, started once on the first on_ready
+        self.store = state.open_store(self.config)
+        self.catalog = catalog.EventCatalog(self.store, self.config['gdq_url'], self.config.get('catalog_max_age', 86400.0))
+        self.series: typing.Optional[series.DonationSeries] = None  # donation history, opened once the event is known
+        self.polled_at = 0.0  # unix time the total of the last successful poll was fetched
+        self.fetched_at: typing.Optional[float] = None  # unix time the last index loaded was fetched
+        self.polled = asyncio.Event()  # set by each successful poll
+
+    async def load_gdq_json(self, query, **kwargs):
         """
-        Loads and processes a GDQ API page
+        Loads and processes a GDQ API page.
+        Failed requests are retried and fall back to the last good response, see tracker.TrackerClient.get
         :param query: the search parameters to query
         :return: json object
         """
-        url = f"{self.config['gdq_url']}{query}"
-        async with self.session.get(url, **self.gdq_headers) as r:
-            if r.status == 200:
-                jsondata = await r.json()
-            else:
-                print("GET {} returned {} {} -- aborting".format(url, r.status, await r.text()))
-                exit()
-        return jsondata
+        return await self.tracker.get(query, **kwargs)
 
     async def load_gdq_index(self):
         """
         Returns the GDQ index (main) page, includes donation totals
         :return: json object
         """
-        return (await self.load_gdq_json(f"?type=event&id={self.config['event_id']}"))[0]['fields']
+        query = f"?type=event&id={self.config['event_id']}"
+        index = (await self.load_gdq_json(query))[0]['fields']
+        # during an outage the tracker client serves the last good response, which keeps the time it was fetched
+        self.fetched_at = self.tracker.fetched_at(query)
+        if self.series is not None:
+            self.series.record(index, self.fetched_at)
+        return index
 
     async def load_donation_total(self) -> float:
         """
@@ -61,7 +80,11 @@ class DiscordClient(discord.Client):
         return float((await self.load_gdq_index())['amount'])
 
     async def on_ready(self):
-        self.session = aiohttp.ClientSession()
+        self.session = aiohttp.ClientSession(trace_configs=[metrics.http_trace('http')])
+        self.tracker = tracker.TrackerClient(self.config['gdq_url'], self.session, self.gdq_headers['headers'], delay=0)
+        if self.metrics is None:
+            self.metrics = await metrics.start(self.config, 'anticheat')
+            tracing.setup(self.config)
         print('Logged in as')
         print(self.user.name)
         print(self.user.id)
@@ -69,12 +92,73 @@ class DiscordClient(discord.Client):
 
         # load event info
         if not isinstance(self.config['event_id'], int):
-            orig_id = self.config['event_id'].lower()
-            events = await self.load_gdq_json(f"?type=event")
-            self.config['event_id'] = next((event['pk'] for event in events if event['fields']['short'].lower() == orig_id), None)
+            orig_id = self.config['event_id']
+            self.config['event_id'] = await self.catalog.resolve(orig_id, self.tracker)
             if self.config['event_id'] is None:
                 print(f"Could not find event {orig_id}")
                 exit()
+        self.series = series.open_series(self.config, self.config['event_id'])
+        # the total only goes up, so the saved one can vouch for claims below it straight away
+        self.current_amount = max(self.current_amount, self.store.get(f"anticheat:{self.config['event_id']}", 'current_amount', 0))
+        if not self.poller.is_running():
+            self.poller.start()
+
+    @tasks.loop(seconds=poll_every)
+    async def poller(self):
+        """Keeps the donation history going, claims are checked against it rather than the tracker"""
+        with metrics.cycle('poller', self.poll_every), tracing.cycle('poller'):
+            try:
+                with tracing.span('fetch'):
+                    total = await self.load_donation_total()
+            except tracker.TrackerError as e:
+                print(f"Could not poll the donation total: {e}")
+            else:
+                if self.fetched_at <= self.polled_at:
+                    # the last good response again, claims made since then can't be checked against it
+                    print("Could not poll the donation total: the tracker served the last good response")
+                else:
+                    self.current_amount = total
+                    self.store.set(f"anticheat:{self.config['event_id']}", 'current_amount', self.current_amount)
+                    self.polled_at = self.fetched_at
+                    # wake up the claims waiting for this poll
+                    self.polled.set()
+                    self.polled = asyncio.Event()
+        metrics.save(self.config, 'anticheat')
+
+    def known_until(self) -> float:
+        """Unix time up to which the donation history is known, from this bot's polls or the other bots' samples"""
+        known = self.polled_at
+        if self.series is not None and len(self.series.samples()):
+            known = max(known, float(self.series.times[-1]))
+        return known
+
+    async def history_until(self, t: float) -> bool:
+        """
+        Waits until the donation history reaches a point in time.
+        :param t: unix time
+        :return: whether it did, False if polling stalled for a few intervals
+        """
+        deadline = time.monotonic() + 3 * self.poll_every
+        while self.known_until() < t:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self.polled.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def total_at(self, t: float) -> float:
+        """
+        Looks up the donation total at a point in time in the history.
+        :param t: unix time
+        :return: $ raised, the latest polled total without a history
+        """
+        if self.series is None:
+            return self.current_amount
+        total = float(self.series.total_at(t))
+        return self.current_amount if total != total else total  # NaN, nothing recorded yet
 
     async def handle(self, msg: discord.Message):
         if self.session is None:
@@ -91,15 +175,29 @@ class DiscordClient(discord.Client):
         if match.group(2):
             amount *= self.suffix_map[match.group(2).lower()]
 
-        if self.current_amount < amount:
-            self.current_amount = await self.load_donation_total()
-        # conversion to int gives users benefit of the doubt in regard to rounding errors
-        if int(self.current_amount) >= int(amount):
-            print(f"${msg.author} (${msg.author.id}) is HONEST about ${amount:,.2f}!")
-            await msg.add_reaction("✅")
-        else:
-            print(f"${msg.author} (${msg.author.id}) is LYING about ${amount:,.2f}!")
-            await msg.reply(f"liar! >:( we're at only ${self.current_amount:,.2f}, not ${amount:,.2f}.")
+        # the claim is judged by the total when it was made (the snowflake time, or when it was edited), however late it
+        # is handled
+        sent_at = msg.edited_at or discord.utils.snowflake_time(msg.id)
+        metrics.gauge('loop_lag_seconds', (discord.utils.utcnow() - sent_at).total_seconds(), loop='handle')
+        with metrics.cycle('handle'), tracing.cycle('handle'):
+            # donations made just before the claim only show up in the poll after it, so the total one poll later counts
+            checked_at = sent_at.timestamp() + self.poll_every
+            total = self.total_at(checked_at)
+            if int(total) < int(amount):
+                if not await self.history_until(checked_at):
+                    print(f"Could not check ${amount:,.2f}: the donation total hasn't been polled since")
+                    return
+                total = self.total_at(checked_at)
+            # conversion to int gives users benefit of the doubt in regard to rounding errors
+            if int(total) >= int(amount):
+                print(f"${msg.author} (${msg.author.id}) is HONEST about ${amount:,.2f}!")
+                with tracing.span('publish'):
+                    await msg.add_reaction("✅")
+            else:
+                print(f"${msg.author} (${msg.author.id}) is LYING about ${amount:,.2f}!")
+                with tracing.span('publish'):
+                    await msg.reply(f"liar! >:( we were at only ${total:,.2f}, not ${amount:,.2f}.")
+        metrics.save(self.config, 'anticheat')
 
     async def on_message(self, msg: discord.Message):
         await self.handle(msg)
@@ -109,7 +207,5 @@ class DiscordClient(discord.Client):
 
 
 if __name__ == '__main__':
-    intents = discord.Intents.default()
-    intents.message_content = True
-    client = DiscordClient(intents=intents, allowed_mentions=discord.AllowedMentions(users=False, roles=False, everyone=False))
+    client = DiscordClient()
     client.run(client.config['token'])
@@ -0,0 +1,106 @@
+"""
+Compares the memory the discord.py caches hold with the default settings and with each bot's lean settings.
+
+Gateway events are fed straight to the client's connection state: GUILD_CREATE for every guild, then messages spread
+over the channels from a pool of members. Nothing connects to Discord.
+
+usage: python -m benchmarks.bench_memory [--guilds 5] [--channels 50] [--members 200] [--emojis 100] [--messages 50000]
+"""
+import argparse
+import asyncio
+import gc
+import itertools
+import os
+import sys
+import tracemalloc
+
+import discord
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clients  # noqa: E402
+from benchmarks.fake_discord import FakeDiscord  # noqa: E402
+
+snowflakes = itertools.count(1 << 50)
+
+
+def member_json(user_id: int) -> dict:
+    return {'user': {'id': str(user_id), 'username': f'user{user_id}', 'discriminator': '0', 'global_name': None,
+                     'avatar': None}, 'roles': [], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False,
+            'mute': False, 'flags': 0}
+
+
+def guild_json(channels: int, members: int, emojis: int) -> dict:
+    fake = FakeDiscord()
+    guild_id = fake.add_guild()
+    data = fake.guilds[guild_id]
+    data['id'] = str(next(snowflakes))
+    data['channels'] = []
+    for _ in range(channels):
+        channel = fake.channels[fake.add_channel(guild_id)]
+        data['channels'].append(dict(channel, id=str(next(snowflakes)), guild_id=data['id']))
+    data['members'] = [member_json(next(snowflakes)) for _ in range(members)]
+    data['emojis'] = [{'id': str(next(snowflakes)), 'name': f'emoji{i}', 'roles': [], 'require_colons': True,
+                       'managed': False, 'animated': False, 'available': True} for i in range(emojis)]
+    data.update(member_count=members, large=False, presences=[], voice_states=[], threads=[],
+                stage_instances=[], guild_scheduled_events=[], soundboard_sounds=[])
+    return data
+
+
+def message_json(channel: dict, member: dict) -> dict:
+    return {'id': str(next(snowflakes)), 'channel_id': channel['id'], 'guild_id': channel['guild_id'],
+            'author': member['user'], 'member': {k: v for k, v in member.items() if k != 'user'},
+            'content': 'x' * 300, 'timestamp': '2024-01-01T00:00:00+00:00', 'edited_timestamp': None, 'tts': False,
+            'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': [],
+            'pinned': False, 'type': 0, 'flags': 0}
+
+
+async def measure(kwargs: dict, guilds: list, messages: int) -> int:
+    """
+    Feeds the events to a client.
+    :param kwargs: keyword arguments of discord.Client
+    :param guilds: GUILD_CREATE payloads
+    :param messages: number of messages
+    :return: bytes allocated by the client which are still alive afterwards
+    """
+    gc.collect()
+    start = tracemalloc.get_traced_memory()[0]
+    client = discord.Client(**kwargs)
+    state = client._connection
+    for data in guilds:
+        state._add_guild_from_data(dict(data))
+    channels = [channel for data in guilds for channel in data['channels']]
+    members = [member for data in guilds for member in data['members']]
+    for i in range(messages):
+        channel = channels[i % len(channels)]
+        state.parse_message_create(message_json(channel, members[(i * 7) % len(members)]))
+        if i % 1000 == 0:
+            await asyncio.sleep(0)  # lets the dispatched on_message events run
+    await asyncio.sleep(0)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - start
+    await client.close()
+    return used
+
+
+async def run(args):
+    guilds = [guild_json(args.channels, args.members, args.emojis) for _ in range(args.guilds)]
+    profiles = {'discord.py defaults': {'intents': discord.Intents.default()}}
+    for bot in clients.intents:
+        profiles[bot] = clients.options({}, bot)
+    tracemalloc.start()
+    print(f"{'profile':<20} {'memory':>10}")
+    for name, kwargs in profiles.items():
+        used = await measure(kwargs, guilds, args.messages)
+        note = f"  ({kwargs['max_messages']} message cache)" if kwargs.get('max_messages') else ''
+        print(f"{name:<20} {used / 1024 / 1024:>6.1f} MiB{note}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compares the memory of discord.py's caches by client settings")
+    parser.add_argument('--guilds', type=int, default=5)
+    parser.add_argument('--channels', type=int, default=50, help="text channels per guild")
+    parser.add_argument('--members', type=int, default=200, help="members per guild")
+    parser.add_argument('--emojis', type=int, default=100, help="custom emoji per guild")
+    parser.add_argument('--messages', type=int, default=50000)
+    asyncio.run(run(parser.parse_args()))
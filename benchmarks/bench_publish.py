@@ -0,0 +1,125 @@
+"""
+Load-tests the schedule publishers across many channels against a local Discord stand-in.
+
+usage: python -m benchmarks.bench_publish [--configs 1x100,12x150,36x300] [--time-scale 0.01] [--webhooks] [--parallel]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+import aiohttp
+import discord
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import publisher  # noqa: E402
+from benchmarks.fake_discord import FakeDiscord  # noqa: E402
+
+channels_per_guild = 4
+
+
+def render(runs: int, cycle: int):
+    """
+    Builds schedule payloads resembling human_schedule's output.
+    Every cycle the current run moves on by one and the schedule gets a few runs shorter, so later cycles exercise
+    edits, pin moves and surplus deletion.
+    :param runs: number of run messages
+    :param cycle: the cycle number, starting at 0
+    :return: list of publisher.Payload
+    """
+    runs = max(runs - 5 * cycle, 1)
+    payloads = [publisher.Payload(content=f"**Benchmark Games Done Quick**\nCycle {cycle}")]
+    for i in range(runs):
+        prefix = publisher.ARROW + ' ' if i == cycle % runs else ''
+        lines = [f"{prefix}<t:{1767544200 + i * 3600}:d>: Game {i} (Any%) by Runner{i} in 1:00:00"]
+        lines += [f"\N{WARNING SIGN} Bid {i}-{b} (${b * 100:,.2f}/$5,000.00, {b * 2}%)" for b in range(3)]
+        payloads.append(publisher.Payload(content='\n'.join(lines)))
+    payloads.append(publisher.Payload(embed=discord.Embed(title="Run Roster", description=f"Cycle {cycle}")))
+    return payloads
+
+
+def short_route(route: str) -> str:
+    return route.replace(' /channels/{channel_id}', ' ').replace(' /webhooks/{webhook_id}/{token}', ' webhook')
+
+
+async def connect(fake: FakeDiscord) -> discord.Client:
+    """
+    Logs a discord.py client into the stand-in and caches its guilds, so channels resolve with permissions.
+    :return: the client
+    """
+    discord.http.Route.BASE = fake.api_url
+    client = discord.Client(intents=discord.Intents.none())
+    await client.login('fake-token')
+    for guild_id, data in fake.guilds.items():
+        guild = discord.Guild(data=data, state=client._connection)
+        member = {'user': fake.user, 'roles': [], 'joined_at': None, 'deaf': False, 'mute': False, 'flags': 0}
+        guild._add_member(discord.Member(data=member, guild=guild, state=client._connection))
+        client._connection._add_guild(guild)
+    return client
+
+
+async def bench(fake: FakeDiscord, channels: int, runs: int, cycles: int, webhooks: bool, parallel: bool):
+    guild_id = None
+    channel_ids = []
+    for i in range(channels):
+        if i % channels_per_guild == 0:
+            guild_id = fake.add_guild()
+        channel_ids.append(fake.add_channel(guild_id))
+
+    client = await connect(fake)
+    session = aiohttp.ClientSession()
+    try:
+        if webhooks:
+            state = {}
+            publishers = [publisher.WebhookPublisher(publisher.webhook_from_url(fake.add_webhook(channel_id), session),
+                                                     state) for channel_id in channel_ids]
+        else:
+            publishers = [publisher.ChannelPublisher(await client.fetch_channel(channel_id), client.user)
+                          for channel_id in channel_ids]
+
+        for cycle in range(cycles):
+            payloads = render(runs, cycle)
+            fake.reset_counters()
+            start = time.perf_counter()
+            if parallel:
+                await asyncio.gather(*(pub.publish(payloads) for pub in publishers))
+            else:
+                for pub in publishers:
+                    await pub.publish(payloads)
+            wall = time.perf_counter() - start
+            calls = sum(fake.calls.values())
+            limited = sum(fake.ratelimited.values())
+            print(f"{channels:>3}x{runs:<4} {cycle + 1:>5} {calls:>7} {limited:>6} {wall:>9.2f} "
+                  f"{wall / fake.time_scale / 60:>11.1f}   "
+                  + ', '.join(f"{short_route(route)}: {n}" for route, n in fake.calls.most_common(4)))
+    finally:
+        await session.close()
+        await client.close()
+
+
+async def run(configs, cycles: int, time_scale: float, webhooks: bool, parallel: bool):
+    print(f"{'config':<8} {'cycle':>5} {'calls':>7} {'429s':>6} {'wall (s)':>9} {'~real (min)':>11}   busiest routes")
+    for channels, runs in configs:
+        fake = FakeDiscord(time_scale)
+        await fake.start()
+        try:
+            await bench(fake, channels, runs, cycles, webhooks, parallel)
+        finally:
+            await fake.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load-tests the schedule publishers against a local Discord stand-in")
+    parser.add_argument('--configs', default='1x100,12x150,36x300',
+                        help="comma separated CHANNELSxRUNS configurations")
+    parser.add_argument('--cycles', type=int, default=3, help="publish cycles per configuration")
+    parser.add_argument('--time-scale', type=float, default=0.01, help="factor applied to every rate limit window")
+    parser.add_argument('--webhooks', action='store_true', help="publish through webhooks instead of the bot")
+    parser.add_argument('--parallel', action='store_true', help="publish to all channels at once")
+    args = parser.parse_args()
+    logging.getLogger('discord').setLevel(logging.ERROR)  # discord.py warns about every 429 it receives
+    configs = [tuple(map(int, config.split('x'))) for config in args.configs.split(',')]
+    asyncio.run(run(configs, args.cycles, args.time_scale, args.webhooks, args.parallel))
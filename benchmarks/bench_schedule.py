@@ -0,0 +1,221 @@
+"""
+Benchmarks a schedule cycle of main.py against a local tracker stand-in.
+
+usage: python -m benchmarks.bench_schedule [small|medium|huge ...] [--cycles N]
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import datetime
+import io
+import itertools
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import aiohttp
+import discord
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import publisher  # noqa: E402
+import state  # noqa: E402
+from benchmarks import fixtures  # noqa: E402
+from benchmarks.stub_tracker import StubTracker  # noqa: E402
+
+bench_config = {
+    'token': '',
+    'event_id': fixtures.event_id,
+    'schedule_channel': [],
+    'local_timezone': 'US/Eastern',
+    'gdq_url': 'http://127.0.0.1/tracker/search/',  # replaced once the stand-in is running
+    'twitch_channel': 'GamesDoneQuick',
+    'run_name_display': 'name',
+    'emojis': {'twitter': ':bird:', 'twitch': ':tv:', 'youtube': ':movie_camera:'},
+    'upcoming_runs': 3,
+    'wait_minutes': 15,
+    'series_dir': None,
+    'state_db': ':memory:',
+}
+
+
+def import_bot(name: str = 'main'):
+    """
+    Imports a bot module, the ones which read config.yaml (and predictions.json) at import time get it written from
+    bench_config (and with no predictions).
+    :param name: the module to import
+    :return: the module
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'config.yaml'), 'w') as f:
+            yaml.safe_dump(bench_config, f)
+        with open(os.path.join(tmp, 'predictions.json'), 'w') as f:
+            f.write('[]')
+        os.chdir(tmp)
+        try:
+            return __import__(name)
+        finally:
+            os.chdir(cwd)
+
+
+class MemoryMessage:
+    def __init__(self, channel, content=None, embed=None, type=discord.MessageType.default):
+        self.channel = channel
+        self.id = next(channel.snowflakes)
+        self.author = channel.user
+        self.content = content or ''
+        self.embed = embed
+        self.type = type
+        self.pinned = False
+
+    async def edit(self, content=None, embed=None):
+        self.channel.calls['edit'] += 1
+        self.content = content or ''
+        self.embed = embed
+
+    async def pin(self):
+        self.channel.calls['pin'] += 1
+        self.pinned = True
+        self.channel.messages.append(MemoryMessage(self.channel, type=discord.MessageType.pins_add))
+
+    async def unpin(self):
+        self.channel.calls['unpin'] += 1
+        self.pinned = False
+
+    async def delete(self):
+        self.channel.calls['delete'] += 1
+        self.channel.messages.remove(self)
+
+
+class MemoryChannel:
+    """
+    In-memory channel implementing what publisher.ChannelPublisher uses, counting the API calls it would make.
+    For realistic rate limits use benchmarks.fake_discord instead.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.messages = []
+        self.calls = collections.Counter()
+        now = discord.utils.time_snowflake(datetime.datetime.now(datetime.timezone.utc))
+        self.snowflakes = itertools.count(now)
+        self.guild = types.SimpleNamespace(me=user)
+        self.topic = None
+
+    def __str__(self):
+        return "#memory"
+
+    def permissions_for(self, member):
+        return discord.Permissions(manage_messages=True)
+
+    async def history(self, after=None, limit=None, oldest_first=None):
+        self.calls['history'] += max(1, -(-len(self.messages) // 100))  # pages of 100 messages
+        for message in list(self.messages):
+            yield message
+
+    async def edit(self, topic=None):
+        self.calls['edit'] += 1
+        self.topic = topic
+
+    async def send(self, content=None, embed=None):
+        self.calls['send'] += 1
+        message = MemoryMessage(self, content, embed)
+        self.messages.append(message)
+        return message
+
+    async def delete_messages(self, messages):
+        self.calls['bulk delete' if len(messages) > 1 else 'delete'] += 1
+        for message in messages:
+            self.messages.remove(message)
+
+
+def create_client(main, gdq_url: str, session: aiohttp.ClientSession):
+    """
+    Creates a schedule pipeline outside of a host, which would connect to discord and start the scheduler.
+    :param main: the imported main.py
+    :param gdq_url: URL of the tracker stand-in
+    :param session: aiohttp session
+    :return: TrackerPipeline
+    """
+    stand_in = types.SimpleNamespace(store=state.StateStore(':memory:'), executor=None, session=session,
+                                     gateway=False, queue=publisher.PublishQueue())
+    client = main.TrackerPipeline(dict(bench_config, gdq_url=gdq_url), stand_in)
+    client.social_emoji = dict(bench_config['emojis'])
+    client.gdq = main.tracker.TrackerClient(gdq_url, session, delay=0)
+    return client
+
+
+class Measurement:
+    def __init__(self, stub: StubTracker, channels=()):
+        self.stub = stub
+        self.channels = channels
+
+    def __enter__(self):
+        self.stub.reset()
+        for channel in self.channels:
+            channel.calls.clear()
+        tracemalloc.reset_peak()
+        self.start_memory = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.start
+        self.peak_memory = tracemalloc.get_traced_memory()[1] - self.start_memory
+        self.requests = sum(self.stub.requests.values())
+        self.bytes = self.stub.bytes_sent
+        self.discord_calls = sum(sum(channel.calls.values()) for channel in self.channels)
+
+    def row(self, size: str, phase: str) -> str:
+        return (f"{size:<7} {phase:<14} {self.wall * 1000:>10.1f} {self.requests:>9} {self.bytes / 1024:>10.1f} "
+                f"{self.peak_memory / 1024 / 1024:>9.2f} {self.discord_calls:>9}")
+
+
+async def bench(size: str, cycles: int, main):
+    stub = StubTracker(fixtures.build(size))
+    await stub.start()
+    main.vods.reddit_url = stub.url
+    session = aiohttp.ClientSession()
+    client = create_client(main, stub.gdq_url, session)
+    user = types.SimpleNamespace(id=1)
+    channel = MemoryChannel(user)
+    try:
+        with Measurement(stub) as m:
+            await client.load_event()
+        print(m.row(size, 'startup'))
+        client.publishers = {1: main.publisher.ChannelPublisher(channel, user)}
+        for cycle in range(cycles):
+            with Measurement(stub, [channel]) as m, contextlib.redirect_stdout(io.StringIO()):
+                await client.update_schedule()
+                await client.client.queue.join()
+            print(m.row(size, 'first cycle' if cycle == 0 else f'cycle {cycle + 1}'))
+    finally:
+        client.client.queue.close()
+        await session.close()
+        await stub.stop()
+
+
+async def run(sizes, cycles):
+    main = import_bot()
+    print(f"{'size':<7} {'phase':<14} {'wall (ms)':>10} {'requests':>9} {'KiB parsed':>10} "
+          f"{'peak MiB':>9} {'API calls':>9}")
+    for size in sizes:
+        await bench(size, cycles, main)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks a schedule cycle against a local tracker stand-in")
+    parser.add_argument('sizes', nargs='*', help=f"event sizes out of {', '.join(fixtures.sizes)}, defaults to all")
+    parser.add_argument('--cycles', type=int, default=3, help="schedule cycles per event size")
+    args = parser.parse_args()
+    for size in args.sizes:
+        if size not in fixtures.sizes:
+            parser.error(f"unknown size {size}")
+    tracemalloc.start()
+    asyncio.run(run(args.sizes or list(fixtures.sizes), args.cycles))
@@ -0,0 +1,364 @@
+import collections
+import datetime
+import itertools
+import json
+import typing
+
+from aiohttp import web
+import discord
+
+
+# per-route rate limits as (requests, per seconds), bucketed by channel (or webhook) like discord's major parameters
+route_limits = {
+    'GET /channels/{channel_id}': (5, 1),
+    'PATCH /channels/{channel_id}': (2, 600),  # topic edits are notoriously strict
+    'GET /channels/{channel_id}/messages': (5, 1),
+    'POST /channels/{channel_id}/messages': (5, 5),
+    'PATCH /channels/{channel_id}/messages/{message_id}': (5, 5),
+    'DELETE /channels/{channel_id}/messages/{message_id}': (5, 1),
+    'POST /channels/{channel_id}/messages/bulk-delete': (1, 1),
+    'PUT /channels/{channel_id}/pins/{message_id}': (5, 5),
+    'DELETE /channels/{channel_id}/pins/{message_id}': (5, 5),
+    'PUT /channels/{channel_id}/messages/pins/{message_id}': (5, 5),
+    'DELETE /channels/{channel_id}/messages/pins/{message_id}': (5, 5),
+    'POST /webhooks/{webhook_id}/{token}': (5, 2),
+    'PATCH /webhooks/{webhook_id}/{token}/messages/{message_id}': (5, 2),
+    'DELETE /webhooks/{webhook_id}/{token}/messages/{message_id}': (5, 2),
+}
+global_limit = (50, 1)  # requests per second over all routes, per bot token
+
+api_prefix = '/api/v10'
+
+
+class Bucket:
+    def __init__(self, limit: int, per: float):
+        self.limit = limit
+        self.per = per
+        self.remaining = limit
+        self.reset_at = 0.0
+
+    def hit(self, now: float) -> typing.Optional[float]:
+        """
+        Takes a request from the bucket.
+        :param now: current time
+        :return: seconds until the bucket resets if it is empty, otherwise None
+        """
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.per
+        if self.remaining == 0:
+            return self.reset_at - now
+        self.remaining -= 1
+        return None
+
+
+class FakeDiscord:
+    """
+    Local stand-in for the Discord REST routes the bots use, with realistic per-route rate limits.
+    discord.py is pointed at it by changing discord.http.Route.BASE to api_url. time_scale shrinks every rate limit
+    window so that hours of rate-limited publishing can be benchmarked in seconds.
+    """
+
+    def __init__(self, time_scale: float = 1.0):
+        self.time_scale = time_scale
+        self.snowflakes = itertools.count(discord.utils.time_snowflake(datetime.datetime.now(datetime.timezone.utc)))
+        self.user = self.user_json(next(self.snowflakes), 'Schedule Bot')
+        self.guilds: typing.Dict[int, dict] = {}
+        self.channels: typing.Dict[int, dict] = {}
+        self.messages: typing.Dict[int, typing.Dict[int, dict]] = {}  # dict of channel_id: {message_id: message}
+        self.webhooks: typing.Dict[int, dict] = {}
+        self.buckets: typing.Dict[typing.Tuple[str, str], Bucket] = {}
+        self.global_bucket = Bucket(global_limit[0], global_limit[1] * time_scale)
+        self.calls = collections.Counter()  # requests per route
+        self.ratelimited = collections.Counter()  # 429s per route
+        self.runner: web.AppRunner = None
+        self.url = None
+
+        app = web.Application(middlewares=[self.ratelimit])
+        app.router.add_get(api_prefix + '/users/@me', self.get_user)
+        app.router.add_get(api_prefix + '/oauth2/applications/@me', self.get_application)
+        app.router.add_get(api_prefix + '/guilds/{guild_id}', self.get_guild)
+        app.router.add_get(api_prefix + '/channels/{channel_id}', self.get_channel)
+        app.router.add_patch(api_prefix + '/channels/{channel_id}', self.edit_channel)
+        app.router.add_get(api_prefix + '/channels/{channel_id}/messages', self.history)
+        app.router.add_post(api_prefix + '/channels/{channel_id}/messages', self.send)
+        app.router.add_post(api_prefix + '/channels/{channel_id}/messages/bulk-delete', self.bulk_delete)
+        for pins in ('/channels/{channel_id}/pins/{message_id}', '/channels/{channel_id}/messages/pins/{message_id}'):
+            app.router.add_put(api_prefix + pins, self.pin)
+            app.router.add_delete(api_prefix + pins, self.unpin)
+        app.router.add_patch(api_prefix + '/channels/{channel_id}/messages/{message_id}', self.edit)
+        app.router.add_delete(api_prefix + '/channels/{channel_id}/messages/{message_id}', self.delete)
+        app.router.add_post(api_prefix + '/webhooks/{webhook_id}/{token}', self.execute_webhook)
+        app.router.add_patch(api_prefix + '/webhooks/{webhook_id}/{token}/messages/{message_id}', self.edit_webhook_message)
+        app.router.add_delete(api_prefix + '/webhooks/{webhook_id}/{token}/messages/{message_id}', self.delete_webhook_message)
+        self.app = app
+
+    @property
+    def api_url(self) -> str:
+        return self.url + api_prefix
+
+    # setup
+
+    @staticmethod
+    def user_json(user_id: int, name: str) -> dict:
+        return {'id': str(user_id), 'username': name, 'discriminator': '0000', 'global_name': None, 'avatar': None,
+                'bot': True}
+
+    def add_guild(self) -> int:
+        guild_id = next(self.snowflakes)
+        self.guilds[guild_id] = {
+            'id': str(guild_id), 'name': f'Guild {len(self.guilds) + 1}', 'owner_id': self.user['id'],
+            'icon': None, 'splash': None, 'features': [], 'emojis': [], 'stickers': [], 'verification_level': 0,
+            'default_message_notifications': 0, 'explicit_content_filter': 0, 'mfa_level': 0, 'nsfw_level': 0,
+            'premium_tier': 0, 'preferred_locale': 'en-US', 'afk_timeout': 300, 'system_channel_flags': 0,
+            'roles': [{'id': str(guild_id), 'name': '@everyone', 'permissions': '0', 'position': 0, 'color': 0,
+                       'hoist': False, 'managed': False, 'mentionable': False, 'flags': 0}],
+        }
+        return guild_id
+
+    def add_channel(self, guild_id: int) -> int:
+        channel_id = next(self.snowflakes)
+        self.channels[channel_id] = {
+            'id': str(channel_id), 'type': 0, 'guild_id': str(guild_id), 'name': f'schedule-{len(self.channels) + 1}',
+            'position': len(self.channels), 'permission_overwrites': [], 'topic': None, 'nsfw': False,
+            'parent_id': None, 'last_message_id': None, 'rate_limit_per_user': 0, 'flags': 0,
+        }
+        self.messages[channel_id] = {}
+        return channel_id
+
+    def add_webhook(self, channel_id: int) -> str:
+        """
+        :return: the webhook URL, in the format discord.Webhook.from_url expects
+        """
+        webhook_id = next(self.snowflakes)
+        token = (str(webhook_id) * 4)[:68]  # from_url only accepts tokens of 60 to 68 characters
+        self.webhooks[webhook_id] = {'channel_id': channel_id, 'token': token,
+                                     'user': self.user_json(webhook_id, 'Schedule Webhook')}
+        return f'https://discord.com/api/webhooks/{webhook_id}/{token}'
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.ratelimited.clear()
+
+    # rate limits
+
+    @staticmethod
+    def json_response(data=None, status: int = 200, headers: dict = None) -> web.Response:
+        headers = {'Via': '1.1 google', **(headers or {})}
+        if data is None:
+            return web.Response(status=204, headers=headers)
+        # discord.py only parses bodies whose content type is exactly application/json, without a charset
+        return web.Response(body=json.dumps(data).encode(), status=status, headers=headers,
+                            content_type='application/json')
+
+    @web.middleware
+    async def ratelimit(self, request: web.Request, handler):
+        route = f"{request.method} {request.match_info.route.resource.canonical[len(api_prefix):]}"
+        self.calls[route] += 1
+        now = request.loop.time()
+        major = request.match_info.get('channel_id') or request.match_info.get('webhook_id') or ''
+        is_webhook = route.startswith(f"{request.method} /webhooks")
+
+        retry_after = None if is_webhook else self.global_bucket.hit(now)
+        if retry_after is not None:
+            self.ratelimited[route] += 1
+            return self.json_response({'message': 'You are being rate limited.', 'retry_after': retry_after,
+                                       'global': True}, 429, {'X-RateLimit-Global': 'true'})
+
+        limit = route_limits.get(route)
+        if limit is None:
+            return await handler(request)
+        key = (route, major)
+        if key not in self.buckets:
+            self.buckets[key] = Bucket(limit[0], limit[1] * self.time_scale)
+        bucket = self.buckets[key]
+        retry_after = bucket.hit(now)
+        headers = {
+            'X-RateLimit-Bucket': route.replace(' ', ':'),
+            'X-RateLimit-Limit': str(bucket.limit),
+            'X-RateLimit-Remaining': str(bucket.remaining),
+            'X-RateLimit-Reset-After': f"{max(bucket.reset_at - now, 0.001):.3f}",
+        }
+        if retry_after is not None:
+            self.ratelimited[route] += 1
+            return self.json_response({'message': 'You are being rate limited.', 'retry_after': retry_after,
+                                       'global': False}, 429, headers)
+        response = await handler(request)
+        response.headers.update(headers)
+        return response
+
+    # users, guilds and channels
+
+    async def get_user(self, request: web.Request) -> web.Response:
+        return self.json_response(self.user)
+
+    async def get_application(self, request: web.Request) -> web.Response:
+        return self.json_response({'id': self.user['id'], 'name': self.user['username'], 'description': '',
+                                   'icon': None, 'verify_key': '', 'bot_public': False, 'bot_require_code_grant': False,
+                                   'owner': self.user, 'team': None, 'flags': 0, 'summary': ''})
+
+    async def get_guild(self, request: web.Request) -> web.Response:
+        guild = self.guilds.get(int(request.match_info['guild_id']))
+        if guild is None:
+            return self.json_response({'message': 'Unknown Guild', 'code': 10004}, 404)
+        return self.json_response(guild)
+
+    def find_channel(self, request: web.Request) -> typing.Optional[dict]:
+        return self.channels.get(int(request.match_info['channel_id']))
+
+    async def get_channel(self, request: web.Request) -> web.Response:
+        channel = self.find_channel(request)
+        if channel is None:
+            return self.json_response({'message': 'Unknown Channel', 'code': 10003}, 404)
+        return self.json_response(channel)
+
+    async def edit_channel(self, request: web.Request) -> web.Response:
+        channel = self.find_channel(request)
+        if channel is None:
+            return self.json_response({'message': 'Unknown Channel', 'code': 10003}, 404)
+        data = await request.json()
+        for key in ('name', 'topic'):
+            if key in data:
+                channel[key] = data[key]
+        return self.json_response(channel)
+
+    # messages
+
+    def create_message(self, channel_id: int, author: dict, data: dict, message_type: int = 0) -> dict:
+        message_id = next(self.snowflakes)
+        message = {
+            'id': str(message_id), 'channel_id': str(channel_id), 'guild_id': self.channels[channel_id]['guild_id'],
+            'author': author, 'content': data.get('content') or '', 'embeds': data.get('embeds') or [],
+            'timestamp': discord.utils.snowflake_time(message_id).isoformat(), 'edited_timestamp': None,
+            'tts': False, 'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'attachments': [],
+            'pinned': False, 'type': message_type, 'flags': 0,
+        }
+        self.messages[channel_id][message_id] = message
+        self.channels[channel_id]['last_message_id'] = str(message_id)
+        return message
+
+    def find_message(self, request: web.Request, channel_id: int = None) -> typing.Optional[dict]:
+        channel_id = channel_id or int(request.match_info['channel_id'])
+        return self.messages.get(channel_id, {}).get(int(request.match_info['message_id']))
+
+    @staticmethod
+    def update_message(message: dict, data: dict):
+        for key in ('content', 'embeds'):
+            if key in data:
+                message[key] = data[key] or ([] if key == 'embeds' else '')
+        message['edited_timestamp'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    async def history(self, request: web.Request) -> web.Response:
+        channel = self.find_channel(request)
+        if channel is None:
+            return self.json_response({'message': 'Unknown Channel', 'code': 10003}, 404)
+        limit = min(int(request.query.get('limit', 50)), 100)
+        ids = sorted(self.messages[int(channel['id'])])
+        if 'after' in request.query:
+            after = int(request.query['after'])
+            ids = [i for i in ids if i > after][:limit]
+        else:
+            before = int(request.query.get('before', 2 ** 64))
+            ids = [i for i in ids if i < before][-limit:]
+        channel_messages = self.messages[int(channel['id'])]
+        return self.json_response([channel_messages[i] for i in reversed(ids)])  # newest first, like discord
+
+    async def send(self, request: web.Request) -> web.Response:
+        channel = self.find_channel(request)
+        if channel is None:
+            return self.json_response({'message': 'Unknown Channel', 'code': 10003}, 404)
+        return self.json_response(self.create_message(int(channel['id']), self.user, await request.json()))
+
+    async def edit(self, request: web.Request) -> web.Response:
+        message = self.find_message(request)
+        if message is None:
+            return self.json_response({'message': 'Unknown Message', 'code': 10008}, 404)
+        self.update_message(message, await request.json())
+        return self.json_response(message)
+
+    async def delete(self, request: web.Request) -> web.Response:
+        message = self.find_message(request)
+        if message is None:
+            return self.json_response({'message': 'Unknown Message', 'code': 10008}, 404)
+        del self.messages[int(message['channel_id'])][int(message['id'])]
+        return self.json_response()
+
+    async def bulk_delete(self, request: web.Request) -> web.Response:
+        channel_id = int(request.match_info['channel_id'])
+        ids = [int(i) for i in (await request.json())['messages']]
+        if not 2 <= len(ids) <= 100:
+            return self.json_response({'message': 'Invalid Form Body', 'code': 50035}, 400)
+        cutoff = discord.utils.time_snowflake(datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=14))
+        if any(i < cutoff for i in ids):
+            return self.json_response({'message': 'You can only bulk delete messages that are under 14 days old.',
+                                       'code': 50034}, 400)
+        for i in ids:
+            self.messages[channel_id].pop(i, None)
+        return self.json_response()
+
+    async def pin(self, request: web.Request) -> web.Response:
+        message = self.find_message(request)
+        if message is None:
+            return self.json_response({'message': 'Unknown Message', 'code': 10008}, 404)
+        if not message['pinned']:
+            message['pinned'] = True
+            self.create_message(int(message['channel_id']), self.user, {}, 6)  # "pinned a message" notice
+        return self.json_response()
+
+    async def unpin(self, request: web.Request) -> web.Response:
+        message = self.find_message(request)
+        if message is None:
+            return self.json_response({'message': 'Unknown Message', 'code': 10008}, 404)
+        message['pinned'] = False
+        return self.json_response()
+
+    # webhooks
+
+    def find_webhook(self, request: web.Request) -> typing.Optional[dict]:
+        webhook = self.webhooks.get(int(request.match_info['webhook_id']))
+        if webhook is None or webhook['token'] != request.match_info['token']:
+            return None
+        return webhook
+
+    async def execute_webhook(self, request: web.Request) -> web.Response:
+        webhook = self.find_webhook(request)
+        if webhook is None:
+            return self.json_response({'message': 'Unknown Webhook', 'code': 10015}, 404)
+        if request.content_type == 'application/json':
+            data = await request.json()
+        else:  # discord.py sends webhook messages as multipart
+            data = json.loads((await request.post())['payload_json'])
+        message = self.create_message(webhook['channel_id'], webhook['user'], data)
+        message['webhook_id'] = webhook['user']['id']
+        return self.json_response(message if request.query.get('wait') in ('1', 'true') else None)
+
+    async def edit_webhook_message(self, request: web.Request) -> web.Response:
+        webhook = self.find_webhook(request)
+        message = webhook and self.find_message(request, webhook['channel_id'])
+        if message is None:
+            return self.json_response({'message': 'Unknown Message', 'code': 10008}, 404)
+        if request.content_type == 'application/json':
+            data = await request.json()
+        else:
+            data = json.loads((await request.post())['payload_json'])
+        self.update_message(message, data)
+        return self.json_response(message)
+
+    async def delete_webhook_message(self, request: web.Request) -> web.Response:
+        webhook = self.find_webhook(request)
+        message = webhook and self.find_message(request, webhook['channel_id'])
+        if message is None:
+            return self.json_response({'message': 'Unknown Message', 'code': 10008}, 404)
+        del self.messages[webhook['channel_id']][int(message['id'])]
+        return self.json_response()
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
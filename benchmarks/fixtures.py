@@ -0,0 +1,119 @@
+import datetime
+import json
+import random
+import typing
+
+
+# runs, bids per run and options per bid war of the benchmarked event sizes
+sizes = {
+    'small': (50, 4, 3),
+    'medium': (150, 8, 5),
+    'huge': (400, 10, 8),
+}
+
+event_id = 1
+event_short = 'bench2026'
+
+
+def record(model: str, pk: int, fields: dict) -> dict:
+    return {'model': model, 'pk': pk, 'fields': fields}
+
+
+class Fixture:
+    """
+    A synthetic tracker event shaped like the GDQ search API responses.
+    The same seed always produces the same event.
+    """
+
+    def __init__(self, runs: int, bids_per_run: int, options_per_bid: int, seed: int = 0):
+        rng = random.Random(seed)
+        start = datetime.datetime(2026, 1, 4, 16, 30, tzinfo=datetime.timezone.utc)
+        self.event = record('tracker.event', event_id, {
+            'short': event_short, 'name': 'Benchmark Games Done Quick 2026', 'receivername': 'Benchmark Foundation',
+            'timezone': 'US/Eastern', 'datetime': start.isoformat(), 'locked': False,
+            'amount': 1234567.89, 'count': 45678, 'minimumdonation': 5.0,
+            'canonical_url': f'https://example.com/tracker/event/{event_short}',
+        })
+
+        self.runners = []
+        self.runs = []
+        self.bids = []
+        self.options = []
+        self.vods = []
+        self.yt = []
+        time = start
+        for i in range(runs):
+            runner_ids = []
+            for _ in range(rng.choice((1, 1, 1, 2, 4))):
+                pk = len(self.runners) + 1
+                runner_ids.append(pk)
+                self.runners.append(record('tracker.runner', pk, {
+                    'name': f'Runner{pk}', 'stream': rng.choice(('', f'twitch.tv/runner{pk}', f'youtube.com/runner{pk}')),
+                    'twitter': rng.choice(('', f'runner{pk}')), 'youtube': rng.choice(('', f'runner{pk}')),
+                }))
+            length = datetime.timedelta(minutes=rng.randint(10, 180))
+            self.runs.append(record('tracker.speedrun', 1000 + i, {
+                'name': f'Game {i}', 'display_name': f'Game {i}', 'twitch_name': f'Game {i}',
+                'category': rng.choice(('Any%', '100%', 'Glitchless', 'All Bosses')),
+                'runners': runner_ids, 'coop': rng.random() < 0.2,
+                'starttime': time.isoformat(), 'endtime': (time + length).isoformat(),
+                'run_time': str(length), 'event': event_id,
+            }))
+            time += length + datetime.timedelta(minutes=10)
+            self.vods.append([str(rng.randint(10 ** 9, 10 ** 10)), f'{rng.randint(0, 9)}h{rng.randint(0, 59)}m0s'])
+            self.yt.append(f'yt{i:08}')
+
+            for _ in range(rng.randint(0, bids_per_run * 2)):
+                pk = 5000 + len(self.bids)
+                total = round(rng.uniform(0, 50000), 2)
+                war = rng.random() < 0.4
+                self.bids.append(record('tracker.bid', pk, {
+                    'name': f'Bid {pk}', 'speedrun': 1000 + i, 'event': event_id, 'total': total,
+                    'goal': None if war else round(rng.uniform(1000, 60000), 2),
+                    'state': rng.choice(('OPENED', 'CLOSED')), 'parent': None,
+                    'canonical_url': f'https://example.com/tracker/bid/{pk}',
+                }))
+                if war:
+                    for _ in range(rng.randint(2, options_per_bid * 2)):
+                        option = 50000 + len(self.options)
+                        self.options.append(record('tracker.bid', option, {
+                            'name': f'Option {option}', 'parent': pk, 'speedrun': 1000 + i, 'event': event_id,
+                            'total': round(rng.uniform(0, 20000), 2), 'goal': None, 'state': 'OPENED',
+                        }))
+
+    def search(self, query: typing.Dict[str, str]) -> typing.Optional[list]:
+        """
+        Answers a tracker search query.
+        :param query: the query string parameters
+        :return: list of records, or None for unknown queries
+        """
+        search_type = query.get('type')
+        if search_type == 'event':
+            return [self.event] if 'id' not in query or query['id'] == str(event_id) else []
+        results = {'run': self.runs, 'runner': self.runners, 'bid': self.bids, 'bidtarget': self.options}.get(search_type)
+        if results is not None and 'id' in query:
+            return [result for result in results if str(result['pk']) == query['id']]
+        return results
+
+    def wiki(self, page: str) -> typing.Optional[dict]:
+        """
+        Builds a reddit wiki page response, with a comment on every line like the real VODThread pages.
+        :param page: name of the wiki page
+        :return: json object, or None if the page doesn't exist
+        """
+        data = {f'{event_short}vods': self.vods, f'{event_short}yt': self.yt}.get(page)
+        if data is None:
+            return None
+        lines = ['['] + [json.dumps(item) + (',' if i < len(data) - 1 else '') + f'  # run {i}'
+                         for i, item in enumerate(data)] + [']']
+        return {'kind': 'wikipage', 'data': {'content_md': '\r\n'.join(lines), 'revision_id': f'rev-{page}',
+                                             'revision_date': 1767544200}}
+
+    def revisions(self, page: str) -> typing.Optional[dict]:
+        if self.wiki(page) is None:
+            return None
+        return {'kind': 'Listing', 'data': {'children': [{'id': f'rev-{page}', 'timestamp': 1767544200}]}}
+
+
+def build(size: str, seed: int = 0) -> Fixture:
+    return Fixture(*sizes[size], seed=seed)
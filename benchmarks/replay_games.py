@@ -0,0 +1,181 @@
+"""
+Replays a donation series through the Ping% and prediction games of games.py as fast as they can go.
+
+Each tick hands a total to GDQGames.tick, the code the bot runs every run_every seconds against the tracker, with the
+game channel replaced by one which keeps what is sent. Totals come from a series recorded by the bots (see series.py),
+sampled every --every seconds of event time, or from a synthetic event. Predictions come from a predictions.json or
+are generated. Prints the announcements, checks that every milestone and surpassed prediction was handled, and times
+the ticks.
+
+usage: python -m benchmarks.replay_games [--series series/donations-36.bin | --ticks 1000000] [--predictions FILE |
+    --players 10000] [--every 10] [--show]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+import discord
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import series  # noqa: E402
+from benchmarks.bench_schedule import import_bot  # noqa: E402
+
+
+class CaptureChannel:
+    """Stands in for the game channel, keeping what is sent along with the event time of the tick"""
+
+    def __init__(self):
+        self.sent = []  # list of (unix time, content)
+        self.now = 0.0
+
+    async def send(self, content=None, allowed_mentions=None):
+        self.sent.append((self.now, content))
+
+
+def recorded_totals(filename: str, every: float) -> np.ndarray:
+    """
+    Samples a recorded donation series like the bot would poll it.
+    :param filename: the series file
+    :param every: seconds between ticks, 0 to use every sample
+    :return: structured array with the fields t and total
+    """
+    donations = series.DonationSeries(filename)
+    samples = donations.samples()
+    if not len(samples):
+        raise SystemExit(f"{filename} has no samples")
+    if every <= 0:
+        t = np.array(donations.times)
+    else:
+        t = np.arange(donations.times[0], donations.times[-1] + every, every)
+    totals = np.zeros(len(t), [('t', '<f8'), ('total', '<f8')])
+    totals['t'] = t
+    totals['total'] = donations.total_at(t)
+    return totals
+
+
+def synthetic_totals(ticks: int, every: float, final: float, seed: int) -> np.ndarray:
+    """
+    Makes up an event which raises final dollars in bursts of donations, with quiet ticks in between.
+    :param ticks: number of ticks
+    :param every: seconds between ticks
+    :param final: $ raised by the end
+    :param seed: random seed
+    :return: structured array with the fields t and total
+    """
+    rng = np.random.default_rng(seed)
+    raised = rng.exponential(1.0, ticks) * (rng.random(ticks) < 0.6)
+    raised *= final / raised.sum()
+    totals = np.zeros(ticks, [('t', '<f8'), ('total', '<f8')])
+    totals['t'] = time.time() - ticks * every + np.arange(ticks) * every
+    totals['total'] = np.round(np.cumsum(raised), 2)
+    return totals
+
+
+def synthetic_predictions(players: int, final: float, seed: int) -> list:
+    """
+    Makes up a predictions.json: guesses around the final total, each one's max halfway to the next guess.
+    :param players: number of predictions
+    :param final: $ raised by the end of the event
+    :param seed: random seed
+    :return: list of dicts with ping, amount and max
+    """
+    rng = np.random.default_rng(seed)
+    amounts = np.unique(np.round(rng.normal(final, final / 4, players).clip(0.01), 2))
+    pings = rng.integers(10 ** 17, 10 ** 18, len(amounts))  # user IDs, a clash is as good as impossible
+    maxes = np.append(np.round((amounts[:-1] + amounts[1:]) / 2, 2), 5e12)
+    return [{'ping': int(ping), 'amount': float(amount), 'max': float(high)}
+            for ping, amount, high in zip(pings, amounts, maxes)]
+
+
+def check(games, client, totals: np.ndarray) -> list:
+    """
+    Works out what the replay should have announced and compares.
+    :return: list of problems
+    """
+    first, final = totals['total'][0], totals['total'][-1]
+    problems = []
+    expected = [x for x in client.feed.milestones if first < x <= final]
+    announced = sum(1 for _, content in client.channel.sent if content.startswith(f"<@{games.murph}>"))
+    if announced != len(expected):
+        problems.append(f"{announced} milestones announced, expected {len(expected)}")
+    lost = set(client.lost)
+    missed = [p['ping'] for p in client.predictions if p['max'] < final and p['ping'] not in lost]
+    if missed:
+        problems.append(f"{len(missed)} surpassed predictions weren't marked as lost")
+    early = [p['ping'] for p in client.predictions if p['max'] >= final and p['ping'] in lost]
+    if early:
+        problems.append(f"{len(early)} predictions were marked as lost before they were surpassed")
+    return problems
+
+
+async def replay(games, totals: np.ndarray, predictions: list, show: bool):
+    client = games.GDQGames(intents=discord.Intents.none())  # never logs in, so the game loop doesn't start
+    client.channel = CaptureChannel()
+    client.load_predictions(predictions)
+    client.load_state()
+
+    times = np.zeros(len(totals))
+    index = {'amount': 0.0, 'count': 0}
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i, (t, total) in enumerate(totals.tolist()):
+            index['amount'] = total
+            client.channel.now = t
+            tick = time.perf_counter()
+            await client.tick(index, t)
+            times[i] = time.perf_counter() - tick
+    wall = time.perf_counter() - started
+
+    sent = client.channel.sent
+    if show:
+        for t, content in sent:
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t))} {content}")
+        print()
+    milestones = sum(1 for _, content in sent if content.startswith(f"<@{games.murph}>"))
+    print(f"replayed {len(totals):,} ticks, ${totals['total'][0]:,.2f} to ${totals['total'][-1]:,.2f}, "
+          f"{len(predictions):,} predictions")
+    print(f"announcements: {len(sent):,} ({milestones:,} milestones, {len(sent) - milestones:,} predictions), "
+          f"{len(client.lost):,} predictions lost")
+    p50, p99 = np.percentile(times, [50, 99]) * 1e6
+    print(f"per tick: mean {times.mean() * 1e6:.1f} us, p50 {p50:.1f} us, p99 {p99:.1f} us, max {times.max() * 1e6:.1f} us")
+    print(f"throughput: {len(totals) / wall:,.0f} ticks/s ({wall:.2f} s)")
+    problems = check(games, client, totals)
+    for problem in problems:
+        print(f"MISMATCH: {problem}")
+    if not problems:
+        print("every milestone and surpassed prediction was handled")
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replays a donation series through the games of games.py")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--series', help="a recorded series file, ie. series/donations-36.bin")
+    source.add_argument('--ticks', type=int, default=100000, help="ticks of a synthetic event")
+    parser.add_argument('--final', type=float, default=2500000.0, help="$ raised by the end of a synthetic event")
+    parser.add_argument('--predictions', help="a predictions.json, defaults to generated ones")
+    parser.add_argument('--players', type=int, default=1000, help="number of generated predictions")
+    parser.add_argument('--every', type=float, help="seconds between ticks, defaults to the bot's run_every")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--show', action='store_true', help="print every announcement")
+    args = parser.parse_args()
+
+    games = import_bot('games')
+    every = games.run_every if args.every is None else args.every
+    if args.series:
+        totals = recorded_totals(args.series, every)
+    else:
+        totals = synthetic_totals(args.ticks, every or games.run_every, args.final, args.seed)
+    if args.predictions:
+        with open(args.predictions) as f:
+            predictions = json.load(f)
+    else:
+        predictions = synthetic_predictions(args.players, totals['total'][-1], args.seed)
+    sys.exit(1 if asyncio.run(replay(games, totals, predictions, args.show)) else 0)
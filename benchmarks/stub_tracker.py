@@ -0,0 +1,79 @@
+import asyncio
+import collections
+import json
+import sys
+
+from aiohttp import web
+
+from benchmarks import fixtures
+
+
+class StubTracker:
+    """
+    Local stand-in for the tracker search API and the reddit wiki, serving a fixture.
+    Counts the requests and bytes served so the benchmarks can report them.
+    """
+
+    def __init__(self, fixture: fixtures.Fixture):
+        self.fixture = fixture
+        self.requests = collections.Counter()  # requests per endpoint
+        self.bytes_sent = 0
+        self.runner: web.AppRunner = None
+        self.url = None
+        app = web.Application()
+        app.router.add_get('/tracker/search/', self.search)
+        app.router.add_get('/r/{subreddit}/wiki/revisions/{page}.json', self.revisions)
+        app.router.add_get('/r/{subreddit}/wiki/{page}.json', self.wiki)
+        self.app = app
+
+    @property
+    def gdq_url(self) -> str:
+        return f"{self.url}/tracker/search/"
+
+    def reset(self):
+        self.requests.clear()
+        self.bytes_sent = 0
+
+    def respond(self, endpoint: str, data) -> web.Response:
+        self.requests[endpoint] += 1
+        if data is None:
+            return web.Response(status=404, text='not found')
+        body = json.dumps(data).encode()
+        self.bytes_sent += len(body)
+        return web.Response(body=body, content_type='application/json')
+
+    async def search(self, request: web.Request) -> web.Response:
+        query = dict(request.query)
+        return self.respond(query.get('type', '?'), self.fixture.search(query))
+
+    async def wiki(self, request: web.Request) -> web.Response:
+        return self.respond('wiki', self.fixture.wiki(request.match_info['page']))
+
+    async def revisions(self, request: web.Request) -> web.Response:
+        return self.respond('wiki revisions', self.fixture.revisions(request.match_info['page']))
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+async def serve(size: str = 'medium', port: int = 8000):
+    """Runs the stand-in until interrupted, for pointing a real bot's gdq_url at it"""
+    stub = StubTracker(fixtures.build(size))
+    await stub.start(port=port)
+    print(f"Serving a {size} event at {stub.gdq_url} (event_id: {fixtures.event_id})")
+    while True:
+        await asyncio.sleep(3600)
+
+
+if __name__ == '__main__':
+    # usage: python -m benchmarks.stub_tracker [small|medium|huge] [port]
+    args = sys.argv[1:]
+    asyncio.get_event_loop().run_until_complete(serve(*args[:1], *map(int, args[1:2])))
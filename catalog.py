@@ -0,0 +1,116 @@
+"""
+Index of the events on a tracker, shared by the bots through the state store.
+
+event_id may be given as a short name (ie. sgdq2020), which the tracker only resolves as part of the list of every
+event it has ever run. The catalog keeps that list in the state store as a short name to pk index (and pk to event
+metadata), so a bot starting up resolves the name with a dict lookup instead of downloading and scanning the list.
+Short names never move to another event, so a saved entry is used straight away however old it is: an old catalog is
+refreshed in the background, and one missing the name (a new event) is refreshed before giving up.
+"""
+import asyncio
+import time
+import typing
+
+import state
+import tracker
+
+# event fields kept in the catalog, the others (ie. the donation total) change too often to be worth keeping
+metadata = ('short', 'name', 'timezone', 'datetime', 'date')
+
+
+class EventCatalog:
+    def __init__(self, store: state.StateStore, base_url: str, max_age: float = 86400.0):
+        """
+        :param store: state store the catalog is kept in
+        :param base_url: the tracker's search API, each tracker has its own catalog
+        :param max_age: seconds after which the catalog is refreshed in the background
+        """
+        self.store = store
+        self.namespace = f"catalog:{base_url}"
+        self.max_age = max_age
+        self.events: typing.Dict[int, dict] = {}  # dict of pk: metadata
+        self.shorts: typing.Dict[str, int] = {}  # dict of lowercase short name: pk
+        self.updated_at = 0.0
+        self.refreshing: typing.Optional[asyncio.Future] = None
+        self.load()
+
+    def load(self):
+        saved = self.store.get(self.namespace, 'events')
+        if saved is None:
+            return
+        self.events = {int(pk): fields for pk, fields in saved['events'].items()}
+        self.shorts = {fields['short'].lower(): pk for pk, fields in self.events.items() if fields.get('short')}
+        self.updated_at = saved['updated_at']
+
+    def update(self, events: typing.List[dict]):
+        """
+        Replaces the catalog with a fresh event list, and saves it.
+        :param events: ?type=event records
+        :return: None
+        """
+        self.events = {event['pk']: {key: event['fields'][key] for key in metadata if key in event['fields']}
+                       for event in events}
+        self.shorts = {fields['short'].lower(): pk for pk, fields in self.events.items() if fields.get('short')}
+        self.updated_at = time.time()
+        self.store.set(self.namespace, 'events', {'updated_at': self.updated_at, 'events': self.events})
+
+    def stale(self) -> bool:
+        return time.time() - self.updated_at > self.max_age
+
+    def lookup(self, event_id: typing.Union[int, str]) -> typing.Optional[int]:
+        """
+        Resolves an event from the saved catalog only.
+        :param event_id: pk or short name
+        :return: pk, None if the short name isn't in the catalog
+        """
+        if isinstance(event_id, int):
+            return event_id
+        return self.shorts.get(event_id.lower())
+
+    def info(self, pk: int) -> typing.Optional[dict]:
+        """The saved metadata of an event: its short name, name, timezone and start"""
+        return self.events.get(pk)
+
+    async def refresh(self, client: tracker.TrackerClient, patient: bool = False):
+        """
+        Downloads the event list, once however many callers ask at the same time.
+        :param client: client of the tracker
+        :param patient: wait for the tracker to respond, rather than raising tracker.TrackerError
+        """
+        if self.refreshing is None:
+            self.refreshing = asyncio.ensure_future(self.download(client, patient))
+        await asyncio.shield(self.refreshing)
+
+    async def download(self, client: tracker.TrackerClient, patient: bool):
+        try:
+            self.update(await client.get("?type=event", patient=patient))
+        finally:
+            self.refreshing = None
+
+    async def refresh_quietly(self, client: tracker.TrackerClient):
+        try:
+            await self.refresh(client)
+        except tracker.TrackerError as e:
+            print(f"CATALOG: {e} -- keeping the saved events")
+
+    async def resolve(self, event_id: typing.Union[int, str], client: tracker.TrackerClient,
+                      patient: bool = True) -> typing.Optional[int]:
+        """
+        Resolves an event, from the catalog if it has it.
+        :param event_id: pk or short name
+        :param client: client of the tracker, for refreshing the catalog
+        :param patient: wait for the tracker to respond if the catalog has to be refreshed first
+        :return: pk, None if the tracker has no event with the short name
+        """
+        if isinstance(event_id, int):
+            return event_id
+        pk = self.lookup(event_id)
+        if pk is None or self.stale():
+            self.load()  # another bot may have refreshed it
+            pk = self.lookup(event_id)
+        if pk is None:
+            await self.refresh(client, patient)
+            return self.lookup(event_id)
+        if self.stale() and self.refreshing is None:
+            asyncio.ensure_future(self.refresh_quietly(client))
+        return pk
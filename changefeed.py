@@ -0,0 +1,217 @@
+import asyncio
+import pickle
+import typing
+import zlib
+
+import tracing
+
+
+# kinds of changes
+RUN_ADDED = 'run_added'
+RUN_REMOVED = 'run_removed'
+RUN_MOVED = 'run_moved'  # start time or position in the schedule changed
+ESTIMATE_CHANGED = 'estimate_changed'
+RUN_CHANGED = 'run_changed'  # anything else, ie. runners or category
+BID_ADDED = 'bid_added'
+BID_REMOVED = 'bid_removed'
+BID_TOTAL_CHANGED = 'bid_total_changed'
+BID_GOAL_MET = 'bid_goal_met'
+BID_CLOSED = 'bid_closed'
+OPTION_ADDED = 'option_added'
+OPTION_TOOK_LEAD = 'option_took_lead'
+TOTAL_CHANGED = 'total_changed'
+TOTAL_CROSSED = 'total_crossed'
+
+
+class Change(typing.NamedTuple):
+    kind: str
+    pk: typing.Optional[int] = None  # the changed run/bid/option, or the parent bid for OPTION_TOOK_LEAD
+    old: typing.Any = None  # previous fields (or total)
+    new: typing.Any = None  # current fields (or total)
+    value: typing.Any = None  # extra data, ie. the milestone of TOTAL_CROSSED or the previous leader's pk
+
+
+def record_hash(fields: dict) -> int:
+    """
+    Hashes the fields of a tracker record. Pickling is several times faster than JSON, and the tracker always sends the
+    fields in the same order.
+    :param fields: the record's fields
+    :return: int
+    """
+    return zlib.crc32(pickle.dumps(fields))
+
+
+class RecordSet:
+    """The hashes and fields of one type of tracker record, from the previous snapshot"""
+
+    def __init__(self):
+        self.hashes: typing.Dict[int, int] = {}  # dict of pk: hash
+        self.fields: typing.Dict[int, dict] = {}  # dict of pk: fields
+        self.old_fields: typing.Dict[int, dict] = {}  # fields from the snapshot before
+        self.order: typing.List[int] = []  # pks in the order they were received
+
+    def update(self, records: typing.List[dict]) -> typing.Tuple[list, list, list]:
+        """
+        Stores a new snapshot.
+        :param records: tracker records, as returned by the search API
+        :return: lists of added pks, removed pks and changed pks
+        """
+        hashes = {}
+        fields = {}
+        changed = []
+        for record in records:
+            pk = record['pk']
+            record_fields = record['fields']
+            hashes[pk] = h = record_hash(record_fields)
+            fields[pk] = record_fields
+            if pk in self.hashes and self.hashes[pk] != h:
+                changed.append(pk)
+        added = [pk for pk in hashes if pk not in self.hashes]
+        removed = [pk for pk in self.hashes if pk not in hashes]
+        self.old_fields = self.fields
+        self.hashes = hashes
+        self.fields = fields
+        self.order = [record['pk'] for record in records]
+        return added, removed, changed
+
+
+class ChangeFeed:
+    """
+    Diffs successive snapshots of tracker data and hands typed changes to subscribers.
+    Records are compared by hash, only the ones whose hash changed are inspected field by field.
+    The first snapshot of each record type only sets the baseline and produces no changes.
+    """
+
+    def __init__(self, milestones: typing.Iterable[float] = ()):
+        self.runs = RecordSet()
+        self.bids = RecordSet()
+        self.options = RecordSet()
+        self.leaders: typing.Dict[int, int] = {}  # dict of bid_id: leading option_id
+        self.total: typing.Optional[float] = None
+        self.milestones = sorted(milestones)  # totals to announce with TOTAL_CROSSED
+        self.crossed: typing.Set[float] = set()
+        self.loaded: typing.Set[str] = set()  # record types which have a baseline
+        self.subscribers: typing.List[typing.Tuple[typing.Set[str], typing.Callable]] = []
+
+    def subscribe(self, callback: typing.Callable, *kinds: str):
+        """
+        Registers a callback for changes. The callback may be a coroutine function.
+        :param callback: receives each Change
+        :param kinds: kinds of changes to receive, all if none are given
+        :return: None
+        """
+        self.subscribers.append((set(kinds), callback))
+
+    def diff_runs(self, runs: typing.List[dict]) -> typing.List[Change]:
+        old_order = {pk: i for i, pk in enumerate(self.runs.order)}
+        added, removed, changed = self.runs.update(runs)
+        if 'run' not in self.loaded:
+            self.loaded.add('run')
+            return []
+        old_fields, new_fields = self.runs.old_fields, self.runs.fields
+        changes = [Change(RUN_ADDED, pk, None, new_fields[pk]) for pk in added]
+        changes += [Change(RUN_REMOVED, pk, old_fields[pk], None) for pk in removed]
+        changed = set(changed)
+        for i, pk in enumerate(self.runs.order):
+            if pk not in old_order:
+                continue
+            old, new = old_fields[pk], new_fields[pk]
+            kinds = []
+            if old_order[pk] != i or (pk in changed and old['starttime'] != new['starttime']):
+                kinds.append(RUN_MOVED)
+            if pk in changed:
+                if old['run_time'] != new['run_time']:
+                    kinds.append(ESTIMATE_CHANGED)
+                if not kinds:
+                    kinds.append(RUN_CHANGED)
+            changes += [Change(kind, pk, old, new, old_order[pk]) for kind in kinds]
+        return changes
+
+    def diff_bids(self, bids: typing.List[dict], options: typing.List[dict]) -> typing.List[Change]:
+        added, removed, changed = self.bids.update(bids)
+        changes = []
+        if 'bid' in self.loaded:
+            old_fields, new_fields = self.bids.old_fields, self.bids.fields
+            changes += [Change(BID_ADDED, pk, None, new_fields[pk]) for pk in added]
+            changes += [Change(BID_REMOVED, pk, old_fields[pk], None) for pk in removed]
+            for pk in changed:
+                old, new = old_fields[pk], new_fields[pk]
+                if old['total'] != new['total']:
+                    changes.append(Change(BID_TOTAL_CHANGED, pk, old, new))
+                    if new['goal'] is not None and float(old['total']) < float(new['goal']) <= float(new['total']):
+                        changes.append(Change(BID_GOAL_MET, pk, old, new))
+                if old['state'] != 'CLOSED' and new['state'] == 'CLOSED':
+                    changes.append(Change(BID_CLOSED, pk, old, new))
+        self.loaded.add('bid')
+
+        added, _, changed = self.options.update(options)
+        leaders = {}
+        for pk, fields in self.options.fields.items():
+            parent = fields['parent']
+            if parent not in leaders or float(fields['total']) > float(self.options.fields[leaders[parent]]['total']):
+                leaders[parent] = pk
+        if 'bidtarget' in self.loaded:
+            changes += [Change(OPTION_ADDED, pk, None, self.options.fields[pk]) for pk in added]
+            if added or changed:
+                for parent, leader in leaders.items():
+                    if parent in self.leaders and self.leaders[parent] != leader:
+                        changes.append(Change(OPTION_TOOK_LEAD, parent, self.options.old_fields.get(self.leaders[parent]),
+                                              self.options.fields[leader], self.leaders[parent]))
+        self.loaded.add('bidtarget')
+        self.leaders = leaders
+        return changes
+
+    def diff_records(self, runs: typing.Optional[typing.List[dict]], bids: typing.Optional[typing.List[dict]],
+                     options: typing.Optional[typing.List[dict]]) -> typing.List[Change]:
+        changes = []
+        if runs is not None:
+            changes += self.diff_runs(runs)
+        if bids is not None and options is not None:
+            changes += self.diff_bids(bids, options)
+        return changes
+
+    def diff_total(self, index: dict) -> typing.List[Change]:
+        total = float(index['amount'])
+        old, self.total = self.total, total
+        if old is None:
+            # milestones reached before the bot started aren't announced
+            self.crossed.update(x for x in self.milestones if x <= total)
+            return []
+        changes = []
+        if total != old:
+            changes.append(Change(TOTAL_CHANGED, None, old, total))
+        for x in self.milestones:
+            if x > total:
+                break
+            if x not in self.crossed:
+                self.crossed.add(x)
+                changes.append(Change(TOTAL_CROSSED, None, old, total, x))
+        return changes
+
+    async def update(self, runs: typing.List[dict] = None, bids: typing.List[dict] = None,
+                     options: typing.List[dict] = None, index: dict = None) -> typing.List[Change]:
+        """
+        Diffs a new snapshot against the previous one and notifies subscribers.
+        Parts of the snapshot which weren't loaded this time can be left out.
+        :param runs: ?type=run records
+        :param bids: ?type=bid records, must be given together with options
+        :param options: ?type=bidtarget records
+        :param index: fields of the event, includes the donation total
+        :return: list of changes
+        """
+        changes = []
+        with tracing.span('diff'):
+            if runs is not None or bids is not None:
+                # a big event has thousands of records to hash, which would hold up the event loop
+                changes += await asyncio.get_event_loop().run_in_executor(None, self.diff_records, runs, bids, options)
+            if index is not None:
+                changes += self.diff_total(index)
+        for change in changes:
+            for kinds, callback in self.subscribers:
+                if kinds and change.kind not in kinds:
+                    continue
+                with tracing.span(change.kind):
+                    result = callback(change)
+                    if asyncio.iscoroutine(result):
+                        await result
+        return changes
@@ -0,0 +1,58 @@
+"""
+Lean discord.py settings for the bots.
+
+discord.py caches by default what a general purpose bot might want: the last 1000 messages seen in any channel (with
+their authors, embeds and attachments), every member it hears about and, with the members intent, whole member lists
+chunked in at startup. These bots only look at one or two channels, so each one gets just the intents its features
+use, no member cache, no chunking and no message cache unless it needs one.
+
+Memory held by the client after joining 5 guilds of 50 channels, 200 members and 100 custom emoji each, and seeing
+50,000 messages of 300 characters, measured by benchmarks/bench_memory.py with discord.py 2.7:
+
+    profile                 memory
+    discord.py defaults    1.6 MiB
+    schedule, horaro       0.2 MiB
+    games                  0.1 MiB
+    anticheat              0.4 MiB  (200 message cache)
+
+Most of the difference is the message cache, real messages with embeds, attachments and reactions make it bigger. The
+intents also spare the bots the events they would only throw away, ie. typing, reactions, presences and voice states.
+"""
+import discord
+
+import metrics
+
+# intents each bot's features need
+intents = {
+    # pin notices in the schedule channels, and the custom emoji used for social media links
+    'schedule': discord.Intents(guilds=True, guild_messages=True, emojis=True),
+    'horaro': discord.Intents(guilds=True, guild_messages=True, emojis=True),
+    # t! commands and Ping% mentions
+    'games': discord.Intents(guilds=True, guild_messages=True, message_content=True),
+    # donation total claims
+    'anticheat': discord.Intents(guilds=True, guild_messages=True, message_content=True),
+}
+
+# messages kept in the cache, on_message_edit only fires for messages in it
+message_caches = {
+    'anticheat': 200,
+}
+
+
+def options(config: dict, bot: str) -> dict:
+    """
+    Builds the keyword arguments of discord.Client for a bot.
+    The message_cache config key overrides the size of the bot's message cache, 0 disables it.
+    :param config: the bot's config
+    :param bot: name of the bot, ie. schedule, horaro, games or anticheat
+    :return: dict
+    """
+    max_messages = config.get('message_cache', message_caches.get(bot))
+    return {
+        'intents': intents[bot],
+        'max_messages': max_messages or None,
+        'member_cache_flags': discord.MemberCacheFlags.none(),
+        'chunk_guilds_at_startup': False,
+        'allowed_mentions': discord.AllowedMentions(users=False, roles=False, everyone=False),
+        'http_trace': metrics.http_trace('discord'),
+    }
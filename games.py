@@ -2,7 +2,9 @@ import asyncio
 import json
 from statistics import mean
 from operator import sub
+import time
 import traceback
+import typing
 
 import aiohttp
 import discord
@@ -13,6 +15,16 @@ try:
 except ImportError:
     from yaml import Loader
 
+import catalog
+import changefeed
+import clients
+import metrics
+import replies
+import series
+import standings
+import state
+import tracing
+import tracker
 
 config = load(open('config.yaml', 'r'), Loader)
 
@@ -27,40 +39,38 @@ predictions = json.load(open('predictions.json', 'r'))
 
 # aiohttp session, do not change
 session: aiohttp.ClientSession = None  # gets defined later because it yelled at me for creating in non-async func
+# self-ratelimits to avoid bullying the API, and keeps the game going from the last total during tracker hiccups
+gdq: tracker.TrackerClient = None
 
 # request headers
 gdq_headers = {"headers": {"User-Agent": "rush-schedule-updater"}}
 
 run_every = 10.0
 all_donation_length = 6 + 1
+# saved totals younger than this are picked up after a restart, so milestones crossed in between still get announced
+resume_window = 300.0
 
 
-async def load_gdq_json(query):
+async def load_gdq_json(query, **kwargs):
     """
-    Loads and processes a GDQ API page
+    Loads and processes a GDQ API page.
+    Failed requests are retried and fall back to the last good response, see tracker.TrackerClient.get
     :param query: the search parameters to query
     :return: json object
     """
-    url = f"{config['gdq_url']}{query}"
-    async with session.get(url, **gdq_headers) as r:
-        if r.status == 200:
-            jsondata = await r.json()
+    return await gdq.get(query, **kwargs)
 
-            # self-ratelimit to avoid bullying the API. impacts the first run the most as it fills in the username cache,
-            # but further runs should only be affected by about 10 seconds.
-            await asyncio.sleep(2.5)
-        else:
-            print("GET {} returned {} {} -- aborting".format(url, r.status, await r.text()))
-            exit()
-    return jsondata
 
-
-async def load_gdq_index():
+async def load_gdq_index(**kwargs):
     """
     Returns the GDQ index (main) page, includes donation totals
     :return: json object
     """
-    return (await load_gdq_json(f"?type=event&id={config['event_id']}"))[0]['fields']
+    return (await load_gdq_json(index_query(), **kwargs))[0]['fields']
+
+
+def index_query() -> str:
+    return f"?type=event&id={config['event_id']}"
 
 
 def comma_format(input_list):
@@ -72,16 +82,28 @@ class GDQGames(discord.Client):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.channel = None
-        self.donation_milestones = []  # ping% milestones that have been reached
-        self.first_donation_check = True  # if this is the ping% init
+        self.feed = changefeed.ChangeFeed(murph_donations or ())  # announces ping% milestones as they are crossed
+        self.feed.subscribe(self.ping_murph, changefeed.TOTAL_CROSSED)
+        self.feed.subscribe(self.check_predictions, changefeed.TOTAL_CHANGED)
+        self.first_donation_check = True  # if this is the prediction init
         self.tie_lock = asyncio.Lock()  # prevents race conditions
         self.tie_tracker = {}  # dict of datetime's to track ties in ping%
         self.lost = []  # users whose predictions have lost
+        self.predictions = None  # sorted by amount, each one's max is halfway to the next
+        self.standings = None
+        self.load_predictions(predictions)
+        self.store = state.open_store(config)
+        self.catalog = catalog.EventCatalog(self.store, config['gdq_url'], config.get('catalog_max_age', 86400.0))
+        self.namespace = None  # key of this event's state, set once the event is known
+        self.series = None  # donation history, opened once the event is known
 
         self.donations = 0
         self.all_donations = []
         self.prefix = 't!'
+        self.answers = {}  # replies to commands for the current total, dict of key: reply
+        self.replies = replies.ReplyQueue(config.get('command_cooldown', 2.0), config.get('command_window', run_every))
 
+    async def setup_hook(self):
         self.gamer.start()  # start game loop
 
     async def on_ready(self):
@@ -91,14 +113,10 @@ class GDQGames(discord.Client):
     async def on_message(self, message: discord.Message):
         if message.content.startswith(self.prefix):
             cmd = message.content.replace(self.prefix, '', 1)
-            if cmd in ['donations', 'totals', 'total', 'amount', 'raised']:
-                await message.channel.send(f"${self.donations:,.2f}")
-            elif cmd in ['rate']:
-                if len(self.all_donations) <= 1:
-                    await message.channel.send(f"Not enough data yet, please wait")
-                else:
-                    rate = list(map(sub, self.all_donations[1:], self.all_donations[:-1]))
-                    await message.channel.send(f"Average donation rate per {int(run_every)} seconds over the past {int(run_every*len(rate))} seconds: ${mean(rate):,.2f}")
+            found = self.command(cmd, message)
+            if found is not None:
+                key, answer = found
+                self.replies.request(message.channel, key, message.author.id, lambda: self.answer(key, answer))
         if message.mentions:
             if discord.utils.get(message.mentions, id=murph):
                 authid = message.author.id
@@ -107,43 +125,211 @@ class GDQGames(discord.Client):
                     if created not in self.tie_tracker:
                         self.tie_tracker[created] = [authid]
                     else:
-                        users = list(map(self.get_user, self.tie_tracker[created] + [authid]))
+                        # mentions rather than names, which would need the member cache
+                        users = [f"<@{user}>" for user in self.tie_tracker[created] + [authid]]
                         await self.channel.send("{} tied in Ping%!".format(comma_format(users)))
                     self.tie_tracker[created].append(authid)
 
+    def command(self, cmd: str, message: discord.Message) -> typing.Optional[typing.Tuple[str, typing.Callable]]:
+        """
+        Looks up a t! command.
+        :param cmd: the command, without the prefix
+        :param message: the message it was sent in
+        :return: (key of the reply, function or coroutine function making it), None if it isn't a command
+        """
+        if cmd in ['donations', 'totals', 'total', 'amount', 'raised']:
+            return 'total', lambda: f"${self.donations:,.2f}"
+        elif cmd in ['rate']:
+            return 'rate', self.average_rate
+        elif cmd.startswith('rate ') and self.series is not None:
+            return cmd, lambda: self.rate_over(cmd[len('rate '):])
+        elif cmd in ['spikes'] and self.series is not None:
+            return 'spikes', self.biggest_spikes
+        elif cmd in ['runs'] and self.series is not None:
+            return 'runs', self.best_runs
+        elif cmd in ['closest'] or cmd.startswith('closest '):
+            return cmd, lambda: self.closest_predictions(cmd[len('closest'):])
+        elif cmd in ['rank'] or cmd.startswith('rank '):
+            user = message.mentions[0] if message.mentions else message.author
+            return f"rank {user.id}", lambda: self.prediction_rank(user)
+        elif cmd in ['alive', 'remaining']:
+            return 'alive', self.predictions_alive
+        return None
+
+    async def answer(self, key: str, answer: typing.Callable) -> str:
+        """
+        Makes the reply to a command, once per donation total.
+        :param key: key of the reply
+        :param answer: function or coroutine function making it
+        :return: the reply
+        """
+        if key not in self.answers:
+            reply = answer()
+            if asyncio.iscoroutine(reply):
+                reply = await reply
+            self.answers[key] = reply
+        return self.answers[key]
+
+    def average_rate(self) -> str:
+        if len(self.all_donations) <= 1:
+            return f"Not enough data yet, please wait"
+        rate = list(map(sub, self.all_donations[1:], self.all_donations[:-1]))
+        return f"Average donation rate per {int(run_every)} seconds over the past {int(run_every*len(rate))} seconds: ${mean(rate):,.2f}"
+
+    def rate_over(self, minutes: str) -> str:
+        """
+        Answers t!rate <minutes> from the donation history.
+        :param minutes: the command's argument
+        :return: the reply
+        """
+        try:
+            minutes = float(minutes)
+        except ValueError:
+            return "Usage: t!rate <minutes>"
+        if minutes <= 0:
+            return "Usage: t!rate <minutes>"
+        now = time.time()
+        raised = float(self.series.total_at(now) - self.series.total_at(now - minutes * 60))
+        if raised != raised:  # NaN, nothing recorded yet
+            return "Not enough data yet, please wait"
+        return f"Raised ${raised:,.2f} over the past {minutes:g} minutes, ${raised / minutes * 60:,.2f} per hour"
+
+    def biggest_spikes(self, top: int = 3) -> str:
+        found = self.series.spikes(60.0, top)
+        if not found:
+            return "Not enough data yet, please wait"
+        return "Biggest minutes of the event:\n" + '\n'.join(
+            f"{i + 1}. ${raised:,.2f} in the minute up to <t:{int(t)}:f>" for i, (t, raised) in enumerate(found))
+
+    async def best_runs(self, top: int = 3) -> str:
+        """
+        Answers t!runs with the runs which raised the most so far.
+        :param top: number of runs to list
+        :return: the reply
+        """
+        runs = await load_gdq_json(f"?type=run&event={config['event_id']}", max_age=300)
+        pks, starts, ends = series.run_windows(runs)
+        now = time.time()
+        started = starts <= now
+        if not started.any() or not len(self.series.samples()):
+            return "Not enough data yet, please wait"
+        # the current run is counted up to now
+        raised, per_hour = self.series.by_run(starts[started], ends[started].clip(max=now))
+        names = {run['pk']: run['fields']['name'] for run in runs}
+        pks = [pk for pk, s in zip(pks, started) if s]
+        best = raised.argsort()[::-1][:top]
+        return "Runs which raised the most:\n" + '\n'.join(
+            f"{i + 1}. {names[pks[j]]}: ${raised[j]:,.2f} (${per_hour[j]:,.2f} per hour)" for i, j in enumerate(best))
+
+    def load_predictions(self, predictions: list):
+        self.predictions = predictions
+        self.standings = standings.Standings(predictions)
+
+    def closest_predictions(self, n: str) -> str:
+        """
+        Answers t!closest [n] with the predictions closest to the current total.
+        :param n: the command's argument
+        :return: the reply
+        """
+        try:
+            n = int(n or 5)
+        except ValueError:
+            return "Usage: t!closest [1-10]"
+        if not 1 <= n <= 10:
+            return "Usage: t!closest [1-10]"
+        if self.feed.total is None:
+            return "Not enough data yet, please wait"
+        found = self.standings.closest(self.donations, n)
+        if not found:
+            return "Nobody made a prediction"
+        return f"Closest predictions to ${self.donations:,.2f}:\n" + '\n'.join(
+            f"{i + 1}. <@{ping}>: ${amount:,.2f} (${distance:,.2f} away)" for i, (ping, amount, distance) in enumerate(found))
+
+    def prediction_rank(self, user: discord.abc.User) -> str:
+        """
+        Answers t!rank [@user] with where the author's (or the mentioned user's) prediction ranks.
+        :param user: the author, or the mentioned user
+        :return: the reply
+        """
+        if self.feed.total is None:
+            return "Not enough data yet, please wait"
+        found = self.standings.rank(self.donations, user.id)
+        if found is None:
+            return f"<@{user.id}> didn't make a prediction"
+        rank, amount, distance, surpassed = found
+        return (f"<@{user.id}>'s prediction of ${amount:,.2f} is #{rank:,} of {len(self.standings):,}, "
+                f"${distance:,.2f} away from the total" + (" (surpassed)" if surpassed else ""))
+
+    def predictions_alive(self) -> str:
+        if self.feed.total is None:
+            return "Not enough data yet, please wait"
+        return f"{self.standings.alive(self.donations):,} of {len(self.standings):,} predictions are still in the running"
+
+    async def ping_murph(self, change: changefeed.Change):
+        x = change.value
+        totals = list(map(int, f"{x:,}".split(',')))
+        if len(totals) == 2:
+            y = f"{totals[0]}K"
+        elif len(totals) == 3:
+            decimal = f".{totals[1]:03}"
+            while decimal.endswith('0') or decimal.endswith('.'):
+                decimal = decimal[:-1]
+            y = f"{totals[0]}{decimal}M"
+        else:  # weird edge case?? use legacy message
+            y = f"${x:,}"
+        out = f"<@{murph}> {y}"
+        mentions = discord.AllowedMentions(users=[discord.Object(murph)])
+        with tracing.span('publish'):
+            await self.store.announce(f"milestone:{config['event_id']}:{x}",
+                                      lambda: self.channel.send(out, allowed_mentions=mentions))
+
     @tasks.loop(seconds=run_every)
     async def gamer(self):
-        try:
-            index = await load_gdq_index()
-            self.donations = float(index['amount'])
-            self.all_donations.append(self.donations)
-            # limit the length of the list ig??? idk why i did this
-            while len(self.all_donations) > all_donation_length:
-                del self.all_donations[0]
-
-            for x in murph_donations:
-                if self.donations >= x and x not in self.donation_milestones:
-                    if not self.first_donation_check:
-                        totals = list(map(int, f"{x:,}".split(',')))
-                        if len(totals) == 2:
-                            y = f"{totals[0]}K"
-                        elif len(totals) == 3:
-                            decimal = f".{totals[1]:03}"
-                            while decimal.endswith('0') or decimal.endswith('.'):
-                                decimal = decimal[:-1]
-                            y = f"{totals[0]}{decimal}M"
-                        else:  # weird edge case?? use legacy message
-                            y = f"${x:,}"
-                        out = f"<@{murph}> {y}"
-                        mentions = discord.AllowedMentions(users=[discord.Object(murph)])
-                        await self.channel.send(out, allowed_mentions=mentions)
-                    self.donation_milestones.append(x)
-
-            loser = ""
-            winner = ""
-            users = []
-            for prediction in predictions:
-                if prediction['ping'] not in self.lost:
+        with metrics.cycle('gamer', run_every), tracing.cycle('gamer'):
+            try:
+                with tracing.span('fetch'):
+                    index = await load_gdq_index()
+                # the time it was fetched, the last good response served again in an outage isn't a new sample
+                await self.tick(index, gdq.fetched_at(index_query()))
+            except:
+                traceback.print_exc()
+        metrics.save(config, 'games')
+
+    async def tick(self, index: dict, t: float = None):
+        """
+        Plays Ping% and the prediction game with a new donation total, see benchmarks/replay_games.py for replaying them.
+        :param index: fields of the event, as returned by the tracker
+        :param t: unix time of the total, defaults to now
+        :return: None
+        """
+        if self.series is not None:
+            self.series.record(index, t)
+        self.donations = float(index['amount'])
+        self.answers.clear()
+        self.all_donations.append(self.donations)
+        # limit the length of the list ig??? idk why i did this
+        while len(self.all_donations) > all_donation_length:
+            del self.all_donations[0]
+
+        await self.feed.update(index=index)
+        if self.first_donation_check:  # the feed's first total is only its baseline, the predictions are scanned anyway
+            await self.check_predictions()
+        self.save_state()
+
+    async def check_predictions(self, change: changefeed.Change = None):
+        """
+        Marks the predictions the total surpassed as lost, announcing the first of them along with the next closest one.
+        Runs whenever the total changes; the first scan only catches up and announces nothing.
+        :param change: the TOTAL_CHANGED change, None for the first scan
+        :return: None
+        """
+        loser = ""
+        winner = ""
+        users = []
+        with tracing.span('predictions'):
+            lost = set(self.lost)
+            for prediction in self.predictions:
+                if prediction['ping'] not in lost:
                     if self.donations > prediction['max']:
                         self.lost.append(prediction['ping'])
                         if not loser:
@@ -155,29 +341,56 @@ class GDQGames(discord.Client):
                         user = discord.Object(prediction['ping'])
                         users.append(user)
                         winner = "The next closest prediction is <@{}>'s guess of ${:,.2f}.".format(prediction['ping'], prediction['amount'])
-            if not self.first_donation_check and loser and winner:
-                allowed = discord.AllowedMentions(users=users)
-                await self.channel.send(f"{loser}\n{winner}", allowed_mentions=allowed)
-            self.first_donation_check = False
-        except:
-            traceback.print_exc()
+        if not self.first_donation_check and loser and winner:
+            allowed = discord.AllowedMentions(users=users)
+            with tracing.span('publish'):
+                await self.store.announce(f"prediction:{config['event_id']}:{users[0].id}",
+                                          lambda: self.channel.send(f"{loser}\n{winner}", allowed_mentions=allowed))
+        self.first_donation_check = False
+
+    def save_state(self):
+        self.store.set(self.namespace, 'lost', self.lost)
+        self.store.set(self.namespace, 'totals', {'donations': self.donations, 'all_donations': self.all_donations})
+
+    def load_state(self):
+        """
+        Picks up the game state saved by the last run for this event.
+        :return: None
+        """
+        self.namespace = f"games:{config['event_id']}"
+        lost = self.store.get(self.namespace, 'lost')
+        if lost is not None:
+            self.lost = lost
+            self.first_donation_check = False  # predictions which lost before the restart are already in self.lost
+        totals = self.store.get(self.namespace, 'totals', max_age=resume_window)
+        if totals is not None:
+            self.donations = totals['donations']
+            self.all_donations = totals['all_donations']
+            self.feed.total = self.donations
+            self.feed.crossed.update(x for x in self.feed.milestones if x <= self.donations)
+            print(f"Resuming from ${self.donations:,.2f}")
 
     @gamer.before_loop
     async def before_gamer(self):
-        global session
-        session = aiohttp.ClientSession()
+        global session, gdq
+        session = aiohttp.ClientSession(trace_configs=[metrics.http_trace('http')])
+        gdq = tracker.TrackerClient(config['gdq_url'], session, gdq_headers['headers'])
+        await metrics.start(config, 'games')
+        tracing.setup(config)
 
         if not isinstance(config['event_id'], int):
-            orig_id = config['event_id'].lower()
-            events = await load_gdq_json(f"?type=event")
-            config['event_id'] = next((event['pk'] for event in events if event['fields']['short'].lower() == orig_id), None)
+            orig_id = config['event_id']
+            config['event_id'] = await self.catalog.resolve(orig_id, gdq)
             if config['event_id'] is None:
                 print(f"Could not find event {orig_id}")
                 exit()
+        self.load_state()
+        self.series = series.open_series(config, config['event_id'])
 
         await self.wait_until_ready()
         self.channel = self.get_channel(murph_channel_id)
 
 
-client = GDQGames(allowed_mentions=discord.AllowedMentions(users=False, roles=False, everyone=False))
-client.run(config['token'], bot=True)
+if __name__ == '__main__':
+    client = GDQGames(**clients.options(config, 'games'))
+    client.run(config['token'])
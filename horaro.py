@@ -1,64 +1,28 @@
-import asyncio
 import datetime
-import json
 import re
 import traceback
+import typing
 import pytz
 import discord
-import aiohttp
-import humanize
-from dateutil.parser import isoparse
-from yaml import load
-try:
-    from yaml import CLoader as Loader
-except ImportError:
-    from yaml import Loader
-from discord.ext import tasks
 
+import host
+import metrics
+import publisher
+import tracing
 
-config = load(open('config.yaml', 'r'), Loader)
 
-# local timezone for appropriately displaying when the upcoming run is
-local_timezone = pytz.timezone(config['local_timezone'])
-
-# request headers
-gdq_headers = {"headers": {"User-Agent": "rush-schedule-updater"}}
-reddit_headers = {"headers": {"User-Agent": "simple-wiki-reader:v0.1 (/u/noellekiq)"}}  # add your own reddit username here?
-
-# aiohttp session, do not change
-session: aiohttp.ClientSession = None  # gets defined later because it yelled at me for creating in non-async func
 utc = pytz.timezone('UTC')
 
 fix_space: re.Pattern = re.compile(" +")
+markdown_link: re.Pattern = re.compile(r"\[([^\]]*)\]\([^)]*\)")
 
-async def load_horaro_json(schedule: bool = True, ticker: bool = False):
-    """
-    Loads and processes a GDQ API page
-    :param schedule: whether to get the schedule or base event page
-    :param ticker: whether to grab the ticker or not
-    :return: json object
-    """
-    query = ''
-    if schedule:
-        query += '/schedules'
-    if ticker and schedule:
-        query += f'/{ticker}/ticker'
-    url = f"{config['gdq_url']}{config['event_id']}{query}"
-    async with session.get(url, **gdq_headers) as r:
-        if r.status == 200:
-            jsondata = await r.json()
-
-            # GDQ doesn't provide official ratelimits, so we apply our own safe amount
-            await asyncio.sleep(2.5)
-        else:
-            print("GET {} returned {} {} -- aborting".format(url, r.status, await r.text()))
-            exit()
-
-    out = jsondata['data']
-    if schedule:
-        out = out[config['horaro_index']]
-
-    return out
+# column names each field of a run is recognised by, lowercase, best first. Columns named in horaro_columns win, and
+# the first column is the game if none of these match
+field_columns = {
+    'game': ('game', 'title'),
+    'category': ('category',),
+    'runners': ('runners', 'runner', 'players', 'player'),
+}
 
 
 # Utility Functions
@@ -80,41 +44,166 @@ def line_split(input_message, char_limit=2000):
     return [msg.strip() for msg in output]
 
 
-class DiscordClient(discord.Client):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+class HoraroSchedule:
+    """
+    One schedule of a Horaro event (ie. a stage), published to its own channels.
+    """
 
-        self.author = "@lexikiq#0493"  # me, the bot creator :)
+    def __init__(self, config: dict, key: typing.Union[int, str], state_key: str):
+        """
+        :param config: the pipeline's config, with the schedule's horaro_schedules entry merged over it
+        :param key: the schedule's position in the event, or its slug or name
+        :param state_key: key of its webhook messages in the state store
+        """
+        self.config = config
+        self.key = key
+        self.state_key = state_key
+        self.webhooks = config.get('schedule_webhooks') or []
+        self.webhook_state = {}  # dict of webhook_id: [[message_id, content], ...], saved in the state store
+        self.publishers = {}  # dict of channel_id or webhook_id: publisher
+        self.channels = []
+        self.gameslist = []
+        self.timezone = None
+        self.starttime = None
+        self.columns = None  # the columns self.fields was resolved from
+        self.fields: typing.Dict[str, int] = {}  # dict of field: column index
+
+    def __str__(self):
+        return str(self.key)
+
+    def find(self, schedules: typing.List[dict]) -> dict:
+        """
+        Picks this schedule out of the event's schedules.
+        :param schedules: the event's schedules, as returned by Horaro
+        :return: the schedule
+        """
+        if isinstance(self.key, int):
+            return schedules[self.key]
+        key = self.key.lower()
+        for schedule in schedules:
+            if key in (str(schedule.get('id', '')).lower(), str(schedule.get('slug', '')).lower(),
+                       str(schedule.get('name', '')).lower()):
+                return schedule
+        raise KeyError(f"Schedule {self.key} not found")
+
+    def resolve_fields(self, columns: typing.List[str]):
+        """
+        Works out which column holds the game, category and runners, once for as long as the columns stay the same.
+        :param columns: the schedule's column names
+        :return: None
+        """
+        if columns == self.columns:
+            return
+        names = [str(column).strip().lower() for column in columns]
+        named = {field: str(column).strip().lower() for field, column in (self.config.get('horaro_columns') or {}).items()}
+        fields = {}
+        for field, candidates in field_columns.items():
+            candidates = ((named[field],) if field in named else ()) + candidates
+            found = next((names.index(c) for c in candidates if c in names), None)
+            if found is None:  # ie. "Runner/s" or "Game & Category"
+                found = next((i for c in candidates for i, name in enumerate(names) if c in name), None)
+            if found is not None and found not in fields.values():
+                fields[field] = found
+        fields.setdefault('game', 0)
+        self.columns = list(columns)
+        self.fields = fields
+
+    def cell(self, run: dict, field: str) -> str:
+        i = self.fields.get(field)
+        if i is None or i >= len(run['data']) or not run['data'][i]:
+            return ''
+        return markdown_link.sub(r"\1", str(run['data'][i])).strip()
+
+    def describe(self, run: dict) -> str:
+        """
+        Describes a run as Game (Category) by Runners, leaving out what the schedule doesn't have.
+        :param run: an item of the schedule
+        :return: str
+        """
+        out = self.cell(run, 'game')
+        category = self.cell(run, 'category')
+        if category:
+            out += f" ({category})"
+        runners = self.cell(run, 'runners')
+        if runners:
+            out += f" by {runners}"
+        return out
 
-        self.social_emoji = {}  # emojis used for social media links
-        self.runners = {}  # dict of runner_id: fields
 
-        # start the background schedule processor
-        self.processor.start()
+class HoraroPipeline:
+    """
+    Maintains the schedules of one Horaro event, see host.Host.
+    Every schedule of the event comes with one request, so each one in horaro_schedules (ie. main and side stage) is
+    rendered from the same fetch and published to its own channels.
+    """
+    has_total = False  # Horaro knows nothing about donations
+
+    def __init__(self, config: dict, client: host.Host, name: str = None):
+        """
+        :param config: the pipeline's config
+        :param client: the host running the pipeline
+        :param name: the pipeline's name in the pipelines config key, None when it is the only one
+        """
+        self.config = config
+        self.client = client
+        self.name = name
+        self.loop = 'processor' if name is None else f"processor:{name}"  # name of its cycles in metrics and traces
+        self.namespace = 'horaro' if name is None else f"horaro:{name}"  # in the state store
+        self.interval = config['wait_minutes'] * 60
+        self.due = self.offset = 0.0  # set by the host's scheduler
+        self.presence = False
 
-    def get_time(self, timestamp: int):
-        dt = datetime.datetime.utcfromtimestamp(timestamp).replace(tzinfo=utc)
-        return dt.astimezone(self.timezone)
+        self.author = "@lexikiq#0493"  # me, the bot creator :)
 
-    async def on_ready(self):
-        print('Logged in as')
-        print(self.user.name)
-        print(self.user.id)
-        print('------')
+        # local timezone for appropriately displaying when the upcoming run is
+        self.local_timezone = pytz.timezone(config['local_timezone'])
+        self.social_emoji = {}  # emojis used for social media links
+        self.runners = {}  # dict of runner_id: fields
+        self.publishers = {}  # dict of channel_id or webhook_id: publisher, of every schedule
+        self.store = client.store
+        self.horaro = None  # shared with the other pipelines on Horaro, set in start()
+
+        # without horaro_schedules, horaro_index picks the only schedule, published to the channels configured above
+        entries = config.get('horaro_schedules') or []
+        if entries:
+            self.schedules = [HoraroSchedule(dict(config, **entry), entry['schedule'], f"webhooks:{entry['schedule']}")
+                              for entry in entries]
+        else:
+            self.schedules = [HoraroSchedule(config, config.get('horaro_index', 0), 'webhooks')]
 
-    async def on_message(self, message):
-        if message.channel.id in config['schedule_channel'] and message.type == discord.MessageType.pins_add and \
-                message.channel.permissions_for(message.guild.me).manage_messages:
-            await message.delete()
+    def __str__(self):
+        return self.name or 'horaro'
 
-    async def human_schedule(self):
+    async def load_horaro_json(self, schedule: bool = True, ticker: bool = False, **kwargs):
+        """
+        Loads and processes a GDQ API page.
+        Failed requests are retried and fall back to the last good response, see tracker.TrackerClient.get
+        :param schedule: whether to get the schedules or base event page
+        :param ticker: whether to grab the ticker or not
+        :return: json object, the list of the event's schedules by default
+        """
+        query = f"{self.config['event_id']}"
+        if schedule:
+            query += '/schedules'
+        if ticker and schedule:
+            query += f'/{ticker}/ticker'
+        jsondata = await self.horaro.get(query, **kwargs)
+        return jsondata['data']
+
+    def get_time(self, timestamp: int, timezone: datetime.tzinfo):
+        dt = datetime.datetime.fromtimestamp(timestamp, utc)
+        return dt.astimezone(timezone)
+
+    def human_schedule(self, sched: HoraroSchedule, index: dict):
         """
         Processes the human-readable schedule.
+        :param sched: the schedule to render
+        :param index: its data, as returned by Horaro
         :return: list of runs
         """
-        # load pages
-        index = await load_horaro_json()
+        import humanize  # imported on first use, starting up doesn't need it
         schedule = index['items']
+        sched.resolve_fields(index.get('columns') or [])
 
         # Header Message
         o = [f"**{self.eventname}** ({index['name']})"]
@@ -128,15 +217,16 @@ class DiscordClient(discord.Client):
                 socials.append(f"{self.social_emoji[skey]}/{index[skey]}")
         if socials:
             o.append('     '.join(socials))
-        o.append(f"All times are in {self.timezone}.")
+        o.append(f"All times are in {sched.timezone}.")
         outputmsg = '\n'.join(o)
         schedule_list = [outputmsg]
 
         current_date = datetime.date(year=1970, month=1, day=15)  # for splitting schedule by end of day
+        dtnow = datetime.datetime.now(sched.timezone)
 
         # finally iterate through every run
         for run_data in schedule:
-            starts_at = self.get_time(run_data['scheduled_t'])  # converts utc time to event time
+            starts_at = self.get_time(run_data['scheduled_t'], sched.timezone)  # converts utc time to event time
             starts_at_frmt = starts_at.strftime("`%b %d %I:%M %p`")  # formats for msg later
             # adds the new day separator
             prefix = ''
@@ -144,139 +234,132 @@ class DiscordClient(discord.Client):
                 prefix += fix_space.sub(" ", starts_at.strftime("_ _%n> **%A** %b %e%n_ _%n"))
                 current_date = starts_at.date()
 
-            game = run_data['data'][0]
+            game = sched.describe(run_data)
             length = datetime.timedelta(seconds=run_data['length_t'])
             estimate = str(length)
             ends_at = starts_at + length
 
-            dtnow = datetime.datetime.now(self.timezone)
             # upcoming games list (channel topic)
             gameslist_prefix = None
             # if one of the upcoming runs:
-            if 0 < len(self.gameslist) < config['upcoming_runs']+1:
-                htime = humanize.naturaltime(starts_at.astimezone(local_timezone).replace(tzinfo=None))
+            if 0 < len(sched.gameslist) < sched.config['upcoming_runs']+1:
+                htime = humanize.naturaltime(starts_at.astimezone(self.local_timezone).replace(tzinfo=None))
                 gameslist_prefix = htime[0].upper() + htime[1:]  # capitalize first letter
             # if current run:
-            elif starts_at <= dtnow < ends_at.astimezone(self.timezone):
+            elif starts_at <= dtnow < ends_at.astimezone(sched.timezone):
                 prefix += "\N{BLACK RIGHTWARDS ARROW} "
                 gameslist_prefix = "Current Game"
             # if one of the above two if statements executed
             if gameslist_prefix:
                 runline = f"{gameslist_prefix}: {game}"
-                self.gameslist.append(runline)
+                sched.gameslist.append(runline)
 
             output = f"{prefix}{starts_at_frmt}: {game} in {estimate}"
             schedule_list.append(output)
 
         return schedule_list
 
-    async def process_message(self, schedule, channel=None, message=None):
+    def build_embed(self, sched: HoraroSchedule, index: dict) -> discord.Embed:
         """
-        Edits or sends a new message to the schedule channel.
-        :param schedule: A schedule list from human_schedule()
-        :param channel: (optional) channel to send new messages to
-        :param message: (optional) a discord Message to edit
-        :return: None
+        Creates the Run Roster embed which follows the schedule messages.
+        :param sched: the schedule, rendered by human_schedule()
+        :param index: its data, as returned by Horaro
+        :return: the embed
         """
-        if self.msgIndex >= len(schedule):
-            if message is not None:
-                await message.delete()  # idk if this check is necessary
-            return
-        outputmsg = schedule[self.msgIndex]
-        is_embed = not isinstance(outputmsg, str)
-        embed = None
-        if is_embed:
-            index = await load_horaro_json()
-            twitch = index['twitch'] if 'twitch' in index and index['twitch'] else config['twitch_channel']
-            s_name = "{} {}".format(self.social_emoji['twitch'], twitch).strip()
-            desc = [f"Bot created by {self.author}",
-                    f"Updates every {config['wait_minutes']} minutes",
-                    f"Watch live at [{s_name}](https://twitch.tv/{twitch})"]
-            embed = discord.Embed(title=f"{self.eventname} Run Roster",
-                                  description='\n'.join(desc),
-                                  timestamp=datetime.datetime.utcnow(), color=0x3bb830)
-            embed.set_footer(text="Last updated:")
-            if outputmsg:
-                for run in outputmsg:
-                    # from the self.gameslist, the messages take the format of "Current Run: Game (Category) by Runners"
-                    run_when = run.split(':')[0].strip()
-                    run_desc = ':'.join(run.split(':')[1:]).strip()
-                    embed.add_field(name=run_when, value=run_desc, inline=False)
-            else:
-                val_end = "The event has ended. Thank you all for watching and donating!"
-                val_strt = self.starttime.strftime("The event will start on %A %b %e.")
-                _dt = datetime.datetime.utcnow().replace(tzinfo=utc).astimezone(self.timezone)
-                val_bool = _dt > self.starttime
-
-                val = val_end if val_bool else val_strt
-                embed.add_field(name="N/A", value=val)
-            outputmsg = None
-        output_args = {False: {"args": [outputmsg], "kwargs": {}}, True: {"args": [], "kwargs": {"embed": embed}}}
-
-        if message is None:
-            data = output_args[is_embed]
-            message = await channel.send(*data["args"], **data["kwargs"])
+        config = sched.config
+        twitch = index['twitch'] if 'twitch' in index and index['twitch'] else config['twitch_channel']
+        s_name = "{} {}".format(self.social_emoji['twitch'], twitch).strip()
+        desc = [f"Bot created by {self.author}",
+                f"Updates every {config['wait_minutes']} minutes",
+                f"Watch live at [{s_name}](https://twitch.tv/{twitch})"]
+        title = self.eventname if len(self.schedules) == 1 else f"{self.eventname} ({index['name']})"
+        embed = discord.Embed(title=f"{title} Run Roster",
+                              description='\n'.join(desc),
+                              timestamp=datetime.datetime.now(datetime.timezone.utc), color=0x3bb830)
+        embed.set_footer(text="Last updated:")
+        if sched.gameslist:
+            for run in sched.gameslist:
+                # from the gameslist, the messages take the format of "Current Run: Game (Category) by Runners"
+                run_when = run.split(':')[0].strip()
+                run_desc = ':'.join(run.split(':')[1:]).strip()
+                embed.add_field(name=run_when, value=run_desc, inline=False)
         else:
-            if outputmsg is None or message.content != outputmsg.strip():
-                await message.edit(content=outputmsg, embed=embed)
-
-        if (outputmsg and outputmsg.startswith('\N{BLACK RIGHTWARDS ARROW}')) or self.msgIndex == 0:
-            if not message.pinned:
-                await message.pin()
-        elif message.pinned:
-            await message.unpin()
-
-        self.msgIndex += 1
-        return None
-
-    @tasks.loop(minutes=config['wait_minutes'])
-    async def processor(self):
-        # donation status changer
-        try:  # the SCHEDULE
-            # reset variables
-            self.gameslist = []
-            self.msgIndex = 0
-            # get schedule
-            schedule = await self.human_schedule()
-            schedule.append(self.gameslist)  # add data for embed
-
-            dtoffset = self.starttime.astimezone(utc).replace(tzinfo=None) - datetime.timedelta(days=1)
-
-            # update/post the schedule messages
-            index_copy = self.msgIndex  # lazy fix for multi channels
-            for chan in self.channels:
-                self.msgIndex = index_copy
-                async for message in chan.history(after=dtoffset, limit=None):
-                    if message.author == self.user:
-                        await self.process_message(schedule, message=message)
-                while self.msgIndex < len(schedule):
-                    await self.process_message(schedule, channel=chan)
-                print(f"[{datetime.datetime.now()}] #{chan}: Schedule Updated!")
-        except Exception as e:
-            print(f"SCHEDULE: {e}")
-            traceback.print_exc()
-
-        for chan in self.channels:
-            await chan.edit(topic='\n\n'.join(self.gameslist))
-
-    @processor.before_loop
-    async def before_processor(self):
-        # load session
-        global session
-        session = aiohttp.ClientSession()
-        index = await load_horaro_json(schedule=False)
-        schedule = await load_horaro_json()
+            val_end = "The event has ended. Thank you all for watching and donating!"
+            val_strt = sched.starttime.strftime("The event will start on %A %b %e.")
+            _dt = datetime.datetime.now(datetime.timezone.utc)
+            val_bool = _dt > sched.starttime
+
+            val = val_end if val_bool else val_strt
+            embed.add_field(name="N/A", value=val)
+        return embed
+
+    async def cycle(self):
+        with metrics.cycle(self.loop, self.interval), tracing.cycle(self.loop):
+            try:
+                # one request for every schedule of the event
+                with tracing.span('fetch'):
+                    schedules = await self.load_horaro_json()
+            except Exception as e:
+                print(f"SCHEDULE: {e}")
+                traceback.print_exc()
+                return
+            for sched in self.schedules:
+                try:  # the SCHEDULE
+                    # reset variables
+                    sched.gameslist = []
+                    index = sched.find(schedules)
+                    with metrics.timer('render_duration_seconds', bot='horaro'), tracing.span('render'):
+                        payloads = [publisher.Payload(content=msg) for msg in self.human_schedule(sched, index)]
+                        payloads.append(publisher.Payload(embed=self.build_embed(sched, index)))
+
+                    # aware, discord.py takes naive datetimes as local time
+                    dtoffset = sched.starttime - datetime.timedelta(days=1)
+                    topic = '\n\n'.join(sched.gameslist)
+
+                    # queue the schedule messages for its channels and webhooks, see publisher.PublishQueue
+                    with tracing.span('queue'):
+                        for pub in sched.publishers.values():
+                            self.client.queue.put(pub, payloads, after=dtoffset, topic=topic,
+                                                  done=lambda sched=sched: self.save_webhooks(sched))
+                except Exception as e:
+                    print(f"SCHEDULE {sched}: {e}")
+                    traceback.print_exc()
+
+    def save_webhooks(self, sched: HoraroSchedule):
+        if sched.webhooks:
+            self.store.set(self.namespace, sched.state_key, sched.webhook_state)
+
+    async def start(self):
+        config = self.config
+        self.horaro = self.client.tracker(config['gdq_url'])
+        index = await self.load_horaro_json(schedule=False, patient=True)
+        schedules = await self.load_horaro_json(patient=True)
         self.eventname = index['name']
-        self.timezone = pytz.timezone(schedule['timezone'])
-        self.starttime = self.get_time(schedule['start_t'])
+        for sched in self.schedules:
+            data = sched.find(schedules)
+            sched.timezone = pytz.timezone(data['timezone'])
+            sched.starttime = self.get_time(data['start_t'], sched.timezone)
+
+            # webhook publishers don't need the gateway
+            sched.webhook_state = self.store.get(self.namespace, sched.state_key, {})
+            for url in sched.webhooks:
+                pub = publisher.WebhookPublisher(publisher.webhook_from_url(url, self.client.session), sched.webhook_state)
+                sched.publishers[pub.webhook.id] = pub
+            self.publishers.update(sched.publishers)
+
+        if not self.client.gateway:
+            # custom emoji IDs can't be resolved without the gateway, only emoji strings are used
+            for key, emoji in config['emojis'].items():
+                self.social_emoji[key] = emoji if isinstance(emoji, str) else ""
+            return
 
         # we've done everything we can do before discord is ready, now wait for discord.py to finish connecting
-        await self.wait_until_ready()
+        await self.client.wait_until_ready()
 
         # load social media emojis
         for key, emoji in config['emojis'].items():
             if isinstance(emoji, int):
-                disc_emoji = self.get_emoji(emoji)
+                disc_emoji = self.client.get_emoji(emoji)
                 if disc_emoji:
                     emoji = str(disc_emoji)
                 else:
@@ -284,14 +367,17 @@ class DiscordClient(discord.Client):
             self.social_emoji[key] = emoji
 
         # load embed author
-        lexi = self.get_user(140564059417346049)
+        lexi = self.client.get_user(140564059417346049)
         if lexi:
             self.author = lexi.mention
 
-        # get channel
-        self.channels = list(filter(lambda x: x is not None, map(lambda x: self.get_channel(x), config['schedule_channel'])))
-        assert len(self.channels) == len(config['schedule_channel'])
+        # get channels
+        for sched in self.schedules:
+            sched.channels = self.client.schedule_channels(sched.config.get('schedule_channel') or [])
+            for chan in sched.channels:
+                sched.publishers[chan.id] = publisher.ChannelPublisher(chan, self.client.user)
+            self.publishers.update(sched.publishers)
 
 
-client = DiscordClient(allowed_mentions=discord.AllowedMentions.none())
-client.run(config['token'], bot=True)
+if __name__ == '__main__':
+    host.run(host.load_config(), {'horaro': HoraroPipeline}, 'horaro')
@@ -0,0 +1,207 @@
+"""
+Runs one or more schedule pipelines in a single process.
+
+A pipeline maintains the schedule of one event in its own channels at its own cadence, from the tracker (main.py) or
+Horaro (horaro.py). The pipelines share one Discord connection, HTTP session, state store and render executor, and one
+tracker client per site so they stay within its rate limit together. A single scheduler runs their cycles one at a
+time, spread evenly over their intervals so the heavy parts of different events don't line up.
+
+Without a pipelines list in the config, the config itself describes the only pipeline, as it always has.
+"""
+import asyncio
+import time
+import traceback
+import typing
+
+import aiohttp
+import discord
+from yaml import load
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+from discord.ext import tasks
+
+import catalog
+import clients
+import metrics
+import publisher
+import renderer
+import state
+import tracing
+import tracker
+
+# request headers
+gdq_headers = {"headers": {"User-Agent": "rush-schedule-updater"}}
+
+tick = 5.0  # seconds between checks for pipelines which are due
+
+
+def load_config(filename: str = 'config.yaml') -> dict:
+    with open(filename, 'r') as f:
+        return load(f, Loader)
+
+
+class Host(discord.Client):
+    def __init__(self, config: dict, backends: typing.Dict[str, type], bot: str, *args, **kwargs):
+        """
+        :param config: the loaded config.yaml
+        :param backends: dict of backend name: pipeline class, the first one is the default
+        :param bot: name of the bot in the metrics_ports and metrics_json config keys
+        """
+        super().__init__(*args, **kwargs)
+        self.config = config
+        self.bot = bot
+        self.gateway = bool(config['token'])  # publish-only deployments post through webhooks without logging in
+        self.store = state.open_store(config)
+        self.executor = renderer.executor(config.get('render_workers', 'thread'))
+        self.session: aiohttp.ClientSession = None  # created once the event loop runs
+        self.trackers: typing.Dict[str, tracker.TrackerClient] = {}  # dict of base URL: client
+        self.catalogs: typing.Dict[str, catalog.EventCatalog] = {}  # dict of base URL: catalog
+        self.queue = publisher.PublishQueue(config.get('publish_workers', 4), timeout=config.get('publish_timeout', 120.0),
+                                            bot=bot)
+        self.pipelines = self.build_pipelines(backends)
+
+    def build_pipelines(self, backends: typing.Dict[str, type]) -> list:
+        """
+        Creates a pipeline for every entry of the pipelines config key, or just one for the config itself.
+        Entries override the keys of the top-level config, so settings shared by the events are only written once.
+        :param backends: dict of backend name: pipeline class
+        :return: list of pipelines
+        """
+        pipelines = []
+        for entry in self.config.get('pipelines') or []:
+            config = {key: value for key, value in self.config.items() if key != 'pipelines'}
+            config.update(entry)
+            backend = config.get('backend', next(iter(backends)))
+            if backend not in backends:
+                print(f"Unknown backend {backend}, expected one of {', '.join(backends)}")
+                exit()
+            pipelines.append(backends[backend](config, self, str(config.get('name', config['event_id']))))
+        if not pipelines:
+            pipelines.append(next(iter(backends.values()))(self.config, self))
+        self.show_presence(pipelines)
+        return pipelines
+
+    @staticmethod
+    def show_presence(pipelines: list):
+        # the bot's status shows the donation total of the first event which has one
+        shown = next((pipeline for pipeline in pipelines if pipeline.has_total), None)
+        if shown is not None:
+            shown.presence = True
+
+    def tracker(self, base_url: str) -> tracker.TrackerClient:
+        """
+        Returns the client of a tracker (or Horaro), shared by every pipeline using it.
+        :param base_url: URL the queries are appended to, ie. gdq_url
+        :return: TrackerClient
+        """
+        if base_url not in self.trackers:
+            self.trackers[base_url] = tracker.TrackerClient(base_url, self.session, gdq_headers['headers'])
+        return self.trackers[base_url]
+
+    def catalog(self, base_url: str) -> catalog.EventCatalog:
+        """
+        Returns the event catalog of a tracker, shared by every pipeline using it.
+        :param base_url: the tracker's search API, ie. gdq_url
+        :return: EventCatalog
+        """
+        if base_url not in self.catalogs:
+            self.catalogs[base_url] = catalog.EventCatalog(self.store, base_url, self.config.get('catalog_max_age', 86400.0))
+        return self.catalogs[base_url]
+
+    def schedule_channels(self, channel_ids: typing.List[int]) -> typing.List[discord.TextChannel]:
+        """
+        Looks up the channels a schedule is maintained in, skipping the ones the bot can't see or post in.
+        :param channel_ids: schedule_channel from the config
+        :return: list of channels
+        """
+        channels = []
+        for channel_id in channel_ids:
+            channel = self.get_channel(channel_id)
+            if channel is None:
+                print(f"Channel {channel_id} not found, skipping it")
+                continue
+            permissions = channel.permissions_for(channel.guild.me)
+            if not (permissions.read_message_history and permissions.send_messages):
+                print(f"Missing permissions in #{channel} ({channel.guild}), skipping it")
+                continue
+            channels.append(channel)
+        return channels
+
+    async def setup_hook(self):
+        # start the background scheduler once the event loop runs
+        self.scheduler.start()
+
+    async def serve(self):
+        """Runs the pipelines without logging in to Discord, for publish-only deployments"""
+        async with self:
+            await self.setup_hook()
+            await asyncio.Event().wait()
+
+    async def on_ready(self):
+        print('Logged in as')
+        print(self.user.name)
+        print(self.user.id)
+        print('------')
+
+    async def on_message(self, message):
+        if message.type != discord.MessageType.pins_add:
+            return
+        for pipeline in self.pipelines:
+            if message.channel.id in pipeline.publishers and \
+                    message.channel.permissions_for(message.guild.me).manage_messages:
+                pipeline.publishers[message.channel.id].queue_pin_notice(message)
+
+    @tasks.loop(seconds=tick)
+    async def scheduler(self):
+        now = time.monotonic()
+        for pipeline in sorted((p for p in self.pipelines if p.due <= now), key=lambda p: p.due):
+            started = time.monotonic()
+            try:
+                await pipeline.cycle()
+            except Exception as e:
+                print(f"{pipeline}: {e}")
+                traceback.print_exc()
+            metrics.save(self.config, self.bot)
+            # the first cycles run back to back, after that the pipelines are spread over their interval
+            pipeline.due = max(pipeline.due + pipeline.interval + pipeline.offset, started)
+            pipeline.offset = 0.0
+
+    @scheduler.before_loop
+    async def before_scheduler(self):
+        # load session
+        self.session = aiohttp.ClientSession(trace_configs=[metrics.http_trace('http')])
+        await metrics.start(self.config, self.bot)
+        tracing.setup(self.config)
+        # the pipelines load their events (and wait for discord.py to finish connecting) side by side, and one which
+        # can't start (ie. its event doesn't exist) is dropped rather than stopping the others
+        results = await asyncio.gather(*(pipeline.start() for pipeline in self.pipelines), return_exceptions=True)
+        for pipeline, result in zip(list(self.pipelines), results):
+            if isinstance(result, Exception):
+                print(f"{pipeline}: could not start, dropping it -- {result}")
+                traceback.print_exception(type(result), result, result.__traceback__)
+                self.pipelines.remove(pipeline)
+        if not self.pipelines:
+            print("No pipeline could start")
+            exit()
+        if not any(pipeline.presence for pipeline in self.pipelines):
+            self.show_presence(self.pipelines)
+        now = time.monotonic()
+        for i, pipeline in enumerate(self.pipelines):
+            pipeline.due = now
+            pipeline.offset = pipeline.interval * i / len(self.pipelines)
+
+
+def run(config: dict, backends: typing.Dict[str, type], bot: str):
+    """
+    Runs the pipelines of a config until the process is stopped.
+    :param config: the loaded config.yaml
+    :param backends: dict of backend name: pipeline class, the first one is the default
+    :param bot: name of the bot in the metrics config keys
+    """
+    client = Host(config, backends, bot, **clients.options(config, bot))
+    if client.gateway:
+        client.run(config['token'])
+    else:
+        asyncio.run(client.serve())
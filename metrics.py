@@ -0,0 +1,211 @@
+import asyncio
+import contextlib
+import json
+import re
+import time
+import typing
+
+import aiohttp
+from aiohttp import web
+
+
+# upper bounds of the latency histogram buckets, in seconds
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+# name: (type, help) of every metric the bots record
+descriptions = {
+    'tracker_requests_total': ('counter', "Requests made to the tracker (or Horaro) API by endpoint and status"),
+    'tracker_request_duration_seconds': ('histogram', "Latency of tracker requests by endpoint"),
+    'cache_requests_total': ('counter', "Lookups of cached data by cache and result (hit, stale, coalesced, fallback, miss)"),
+    'proxy_requests_total': ('counter', "Requests served by the tracker proxy by search type and status"),
+    'http_requests_total': ('counter', "HTTP requests made through an instrumented session by client, route and status"),
+    'http_request_duration_seconds': ('histogram', "Latency of HTTP requests through an instrumented session"),
+    'http_ratelimited_total': ('counter', "HTTP 429 responses by client and route"),
+    'render_duration_seconds': ('histogram', "Time spent rendering the schedule"),
+    'publish_duration_seconds': ('histogram', "Time spent bringing one channel or webhook up to date"),
+    'publish_jobs_total': ('counter', "Publishing jobs by result (published, superseded, retried, unavailable, failed)"),
+    'publish_queue_depth': ('gauge', "Channels and webhooks waiting to be brought up to date"),
+    'publish_queue_wait_seconds': ('histogram', "Time a publishing job waited for a free worker"),
+    'command_replies_total': ('counter', "Chat command replies by result (sent, coalesced, repeated)"),
+    'cycle_duration_seconds': ('histogram', "Duration of a background loop iteration or event handler by loop"),
+    'loop_lag_seconds': ('gauge', "How late the last iteration of a loop started, or a message was handled"),
+    'event_loop_lag_seconds': ('gauge', "How late a 1 second asyncio sleep woke up, a measure of event loop blocking"),
+}
+
+counters: typing.Dict[str, typing.Dict[tuple, float]] = {}
+gauges: typing.Dict[str, typing.Dict[tuple, float]] = {}
+histograms: typing.Dict[str, typing.Dict[tuple, list]] = {}  # [bucket counts..., sum, count]
+last_cycle: typing.Dict[str, float] = {}  # dict of loop: monotonic start of its last iteration
+
+
+def _key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def inc(name: str, value: float = 1.0, **labels):
+    series = counters.setdefault(name, {})
+    key = _key(labels)
+    series[key] = series.get(key, 0.0) + value
+
+
+def gauge(name: str, value: float, **labels):
+    gauges.setdefault(name, {})[_key(labels)] = value
+
+
+def observe(name: str, value: float, **labels):
+    series = histograms.setdefault(name, {})
+    key = _key(labels)
+    if key not in series:
+        series[key] = [0] * len(buckets) + [0.0, 0]
+    histogram = series[key]
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            histogram[i] += 1
+    histogram[-2] += value
+    histogram[-1] += 1
+
+
+@contextlib.contextmanager
+def timer(name: str, **labels):
+    """Observes how long the block took"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+@contextlib.contextmanager
+def cycle(loop: str, interval: float = None):
+    """
+    Instruments one iteration of a background loop or event handler.
+    :param loop: name of the loop, ie. processor
+    :param interval: seconds the loop is meant to wait between iterations, to work out how late this one started
+    """
+    now = time.monotonic()
+    if interval is not None and loop in last_cycle:
+        gauge('loop_lag_seconds', max(now - last_cycle[loop] - interval, 0.0), loop=loop)
+    last_cycle[loop] = now
+    with timer('cycle_duration_seconds', loop=loop):
+        yield
+
+
+snowflake = re.compile(r'/\d{6,}')
+token = re.compile(r'/[\w.-]{40,}')
+
+
+def http_trace(client: str) -> aiohttp.TraceConfig:
+    """
+    Creates an aiohttp trace config which records every request of a session.
+    Pass it to discord.Client as http_trace, or to aiohttp.ClientSession in trace_configs.
+    :param client: label identifying the session, ie. discord
+    :return: aiohttp.TraceConfig
+    """
+    async def on_request_start(session, context, params):
+        context.start = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        route = token.sub('/{token}', snowflake.sub('/{id}', params.url.path))
+        status = params.response.status
+        inc('http_requests_total', client=client, method=params.method, route=route, status=str(status))
+        observe('http_request_duration_seconds', time.perf_counter() - context.start, client=client)
+        if status == 429:
+            inc('http_ratelimited_total', client=client, method=params.method, route=route)
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    return trace
+
+
+def _labels(key: tuple, **extra) -> str:
+    items = list(key) + list(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + '}'
+
+
+def render() -> str:
+    """
+    Formats every metric in the Prometheus text exposition format.
+    :return: str
+    """
+    lines = []
+    for name in sorted(set(counters) | set(gauges) | set(histograms)):
+        kind, description = descriptions.get(name, ('untyped', name))
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for key, value in counters.get(name, {}).items():
+            lines.append(f"{name}{_labels(key)} {value}")
+        for key, value in gauges.get(name, {}).items():
+            lines.append(f"{name}{_labels(key)} {value}")
+        for key, histogram in histograms.get(name, {}).items():
+            for bound, count in zip(buckets, histogram):
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{name}_bucket{_labels(key, le=le)} {count}")
+            lines.append(f"{name}_sum{_labels(key)} {histogram[-2]}")
+            lines.append(f"{name}_count{_labels(key)} {histogram[-1]}")
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot() -> dict:
+    """
+    Collects every metric into a json-friendly dict.
+    :return: dict of name: list of series
+    """
+    output = {}
+    for name, series in counters.items():
+        output[name] = [{'labels': dict(key), 'value': value} for key, value in series.items()]
+    for name, series in gauges.items():
+        output[name] = [{'labels': dict(key), 'value': value} for key, value in series.items()]
+    for name, series in histograms.items():
+        output[name] = [{'labels': dict(key), 'sum': h[-2], 'count': h[-1]} for key, h in series.items()]
+    return output
+
+
+def dump(filename: str):
+    with open(filename, 'w') as f:
+        json.dump(snapshot(), f, indent=2)
+
+
+async def watch_event_loop(interval: float = 1.0):
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        gauge('event_loop_lag_seconds', max(time.monotonic() - start - interval, 0.0))
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+
+async def handle_json(request: web.Request) -> web.Response:
+    return web.json_response(snapshot())
+
+
+async def start(config: dict, bot: str) -> typing.Optional[web.AppRunner]:
+    """
+    Serves /metrics (Prometheus) and /metrics.json on localhost if the bot has a port in config['metrics_ports'].
+    :param config: the bot's config
+    :param bot: name of the bot, ie. schedule
+    :return: the server, or None if disabled
+    """
+    port = (config.get('metrics_ports') or {}).get(bot)
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/metrics.json', handle_json)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, config.get('metrics_host', '127.0.0.1'), port).start()
+    asyncio.get_event_loop().create_task(watch_event_loop())
+    print(f"Serving metrics on port {port}")
+    return runner
+
+
+def save(config: dict, bot: str):
+    """Dumps the metrics to the bot's file in config['metrics_json'], if it has one"""
+    filename = (config.get('metrics_json') or {}).get(bot)
+    if filename:
+        dump(filename)
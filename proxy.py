@@ -0,0 +1,165 @@
+"""
+Local read-through cache of the tracker search API.
+
+Serves the same path and queries as gdq_url, ie. http://127.0.0.1:9110/tracker/search/?type=run&event=36, from a
+shared tracker.TrackerClient: responses are cached per search type (proxy_ttl), identical requests arriving together
+share one upstream request, and the queries which are asked for the most are refreshed before they expire. Every
+response carries an Age header, which the bots' clients count towards how old the data is. Point the
+gdq_url of the bots (and any overlays or scripts) at it and the tracker sees the same load however many of them run.
+
+usage: python proxy.py, with gdq_url of the bots set to the proxy and proxy_upstream to the tracker
+"""
+import asyncio
+import collections
+import json
+import time
+import typing
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import aiohttp
+from aiohttp import web
+
+import host
+import metrics
+import tracker
+
+# seconds responses are served from the cache, by search type
+ttls = {
+    'event': 10.0,  # includes the donation total
+    'run': 60.0,
+    'bid': 30.0,
+    'bidtarget': 30.0,
+    'donation': 10.0,
+    'runner': 3600.0,
+    'default': 30.0,
+}
+
+
+class TrackerProxy:
+    def __init__(self, client: tracker.TrackerClient, ttl: typing.Dict[str, float] = None, stale_for: float = 300.0,
+                 prefetch: typing.Iterable[str] = (), prefetch_at: float = 0.75, hot_hits: int = 3,
+                 hot_window: float = 300.0):
+        """
+        :param client: client of the upstream tracker
+        :param ttl: seconds responses are cached by search type, merged into the defaults
+        :param stale_for: seconds after its ttl an expired response is still served while it is refreshed
+        :param prefetch: queries which are always kept fresh, ie. ?type=run&event=36
+        :param prefetch_at: share of its ttl after which a hot query is refreshed in the background
+        :param hot_hits: requests within hot_window which make a query hot
+        :param hot_window: seconds over which requests are counted
+        """
+        self.client = client
+        self.ttl = dict(ttls, **(ttl or {}))
+        self.stale_for = stale_for
+        self.prefetch = [normalize(query) for query in prefetch]
+        self.prefetch_at = prefetch_at
+        self.hot_hits = hot_hits
+        self.hot_window = hot_window
+        self.hits: typing.Counter[str] = collections.Counter()  # requests per query in the current window
+        self.hot: typing.Set[str] = set(self.prefetch)
+        # dict of query: (response, its JSON), least recently used first and no bigger than the client's cache
+        self.encoded: typing.OrderedDict[str, typing.Tuple[typing.Any, bytes]] = collections.OrderedDict()
+
+    def ttl_of(self, query: str) -> float:
+        search = dict(parse_qsl(query.lstrip('?'))).get('type', 'default')
+        return self.ttl.get(search, self.ttl['default'])
+
+    def encode(self, query: str, jsondata: typing.Any) -> bytes:
+        """Serializes a response, once for as long as it is cached rather than for every request"""
+        cached = self.encoded.get(query)
+        if cached is not None and cached[0] is jsondata:
+            self.encoded.move_to_end(query)
+            return cached[1]
+        body = json.dumps(jsondata).encode()
+        self.encoded[query] = (jsondata, body)
+        self.encoded.move_to_end(query)
+        while len(self.encoded) > self.client.max_cached:
+            self.encoded.popitem(last=False)
+        return body
+
+    async def handle(self, request: web.Request) -> web.Response:
+        query = normalize(request.query_string)
+        search = request.query.get('type', 'default')
+        self.hits[query] += 1
+        ttl = self.ttl_of(query)
+        try:
+            jsondata = await self.client.get(query, max_age=ttl, stale_for=self.stale_for)
+        except tracker.TrackerError as e:
+            # the tracker's own answer to a query it refuses, otherwise a bad gateway
+            status = e.status if isinstance(e, tracker.QueryError) else 502
+            metrics.inc('proxy_requests_total', type=search, status=str(status))
+            return web.Response(status=status, text=str(e))
+        metrics.inc('proxy_requests_total', type=search, status='200')
+        # how long ago the tracker itself answered, so clients don't take a cached or stale response for a fresh one
+        age = max(0.0, time.time() - self.client.fetched_at(query))
+        return web.Response(body=self.encode(query, jsondata), content_type='application/json',
+                            headers={'Cache-Control': f"max-age={ttl:.0f}", 'Age': f"{age:.0f}"})
+
+    async def keep_hot(self):
+        """Refreshes the prefetched and most requested queries before they expire, so requests for them never wait"""
+        window_start = time.monotonic()
+        while True:
+            await asyncio.sleep(1.0)
+            if time.monotonic() - window_start >= self.hot_window:
+                self.hot = set(self.prefetch) | {query for query, hits in self.hits.items() if hits >= self.hot_hits}
+                self.hits.clear()
+                window_start = time.monotonic()
+            for query in list(self.hot):
+                cached = self.client.cache.get(f"{self.client.base_url}{query}")
+                if cached is not None and time.monotonic() - cached[0] < self.ttl_of(query) * self.prefetch_at:
+                    continue
+                try:
+                    await self.client.get(query)
+                except tracker.TrackerError as e:
+                    print(f"PREFETCH: {e}")
+
+    async def start(self, path: str, host_name: str, port: int) -> web.AppRunner:
+        """
+        Starts serving the API, and keeping the hot queries fresh.
+        :param path: the path of the search API, ie. /tracker/search/
+        :param host_name: address to listen on
+        :param port: port to listen on
+        :return: the server
+        """
+        app = web.Application()
+        app.router.add_get(path, self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host_name, port).start()
+        asyncio.get_event_loop().create_task(self.keep_hot())
+        print(f"Serving {self.client.base_url} on http://{host_name}:{port}{path}")
+        return runner
+
+
+def normalize(query: str) -> str:
+    """
+    Orders the parameters of a query, so the same search is cached once however it is written.
+    :param query: query string, with or without the leading ?
+    :return: str, ie. ?event=36&type=run
+    """
+    return '?' + urlencode(sorted(parse_qsl(query.lstrip('?'), keep_blank_values=True)))
+
+
+def event_queries(event_id) -> typing.List[str]:
+    """The queries every bot makes each cycle, prefetched for the configured event"""
+    if not isinstance(event_id, int):
+        return []
+    return [f"?type=event&id={event_id}", f"?type=run&event={event_id}", f"?type=bid&event={event_id}",
+            f"?type=bidtarget&event={event_id}"]
+
+
+async def serve(config: dict):
+    upstream = config.get('proxy_upstream') or config['gdq_url']
+    session = aiohttp.ClientSession(trace_configs=[metrics.http_trace('http')])
+    client = tracker.TrackerClient(upstream, session, host.gdq_headers['headers'])
+    proxy = TrackerProxy(client, config.get('proxy_ttl'), config.get('proxy_stale_for', 300.0),
+                         config.get('proxy_prefetch') or event_queries(config['event_id']))
+    await metrics.start(config, 'proxy')
+    await proxy.start(urlsplit(upstream).path or '/', config.get('proxy_host', '127.0.0.1'),
+                      config.get('proxy_port', 9110))
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(serve(host.load_config()))
+    loop.run_forever()
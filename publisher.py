@@ -0,0 +1,364 @@
+import asyncio
+import contextvars
+import datetime
+import itertools
+import time
+import traceback
+import typing
+
+import aiohttp
+import discord
+
+import metrics
+import tracing
+
+
+ARROW = '\N{BLACK RIGHTWARDS ARROW}'  # prefix of the current run's schedule line
+
+bulk_delete_limit = 100  # discord accepts at most 100 messages per bulk-delete
+bulk_delete_age = datetime.timedelta(days=14, minutes=-5)  # and refuses anything older than 2 weeks
+pin_notice_delay = 5.0  # seconds to collect "pinned a message" notices before deleting them in one go
+
+# priorities of publishing jobs, lower goes first
+URGENT = 0  # the current run or something urgent changed, or the channel has never been published to
+ROUTINE = 1
+
+
+class Payload(typing.NamedTuple):
+    """One schedule message, either plain text or an embed"""
+    content: typing.Optional[str] = None
+    embed: typing.Optional[discord.Embed] = None
+
+
+async def bulk_delete(channel, messages: typing.List[discord.Message]):
+    """
+    Deletes messages using as few API calls as possible.
+    Bulk-delete needs manage_messages and only works on messages younger than two weeks, everything else is deleted
+    one at a time.
+    :param channel: the channel containing the messages
+    :param messages: the messages to delete
+    :return: None
+    """
+    if not messages:
+        return
+    can_bulk = channel.permissions_for(channel.guild.me).manage_messages
+    cutoff = discord.utils.utcnow() - bulk_delete_age
+    young, old = [], []
+    for message in messages:
+        sent_at = discord.utils.snowflake_time(message.id)
+        (young if can_bulk and sent_at > cutoff else old).append(message)
+    for i in range(0, len(young), bulk_delete_limit):
+        await channel.delete_messages(young[i:i + bulk_delete_limit])
+    for message in old:
+        await message.delete()
+
+
+class ChannelPublisher:
+    """
+    Keeps the schedule messages of one channel in sync with the rendered schedule.
+    The header message stays pinned and the pin of the current run is tracked, so a cycle moves at most one pin.
+    Surplus schedule messages and pin notices are removed with bulk-delete.
+    """
+
+    def __init__(self, channel, user):
+        self.channel = channel
+        self.user = user  # the bot user, only its messages belong to the schedule
+        self.pinned_run: typing.Optional[int] = None  # ID of the message pinned as the current run
+        self.pin_notices: typing.List[discord.Message] = []
+        self.notice_task: typing.Optional[asyncio.Task] = None
+
+    def __str__(self):
+        return f"#{self.channel}"
+
+    async def publish(self, payloads: typing.List[Payload], after: datetime.datetime = None, topic: str = None):
+        """
+        Edits, sends and deletes messages until the channel matches the payloads.
+        :param payloads: rendered schedule messages, in order
+        :param after: ignore messages sent before this time
+        :param topic: channel topic, left alone if None
+        :return: None
+        """
+        messages = []
+        stale = []
+        with tracing.span('fetch'):
+            async for message in self.channel.history(after=after, limit=None, oldest_first=True):
+                if message.author != self.user:
+                    continue
+                if message.type == discord.MessageType.pins_add or len(messages) >= len(payloads):
+                    stale.append(message)
+                else:
+                    messages.append(message)
+        pinned = {message.id for message in messages if message.pinned}
+
+        with tracing.span('publish'):
+            for i, payload in enumerate(payloads):
+                if i < len(messages):
+                    message = messages[i]
+                    if payload.embed is not None or message.content != payload.content.strip():
+                        await message.edit(content=payload.content, embed=payload.embed)
+                else:
+                    messages.append(await self.channel.send(payload.content, embed=payload.embed))
+
+        # the header is always pinned, next to it only the current run
+        current = next((message for message, payload in zip(messages, payloads)
+                        if payload.content and payload.content.startswith(ARROW)), None)
+        current_id = current.id if current is not None else None
+        wanted = {messages[0].id} if messages else set()
+        if current_id is not None:
+            wanted.add(current_id)
+        # most cycles the current run is still the one pinned last time, and there is nothing to move
+        if current_id != self.pinned_run or not wanted <= pinned:
+            with tracing.span('pin'):
+                for message in messages:
+                    if message.id in pinned and message.id not in wanted:
+                        await message.unpin()
+                    elif message.id in wanted and message.id not in pinned:
+                        await message.pin()
+            self.pinned_run = current_id
+
+        if stale:
+            with tracing.span('delete'):
+                await bulk_delete(self.channel, stale)
+
+        if topic is not None and getattr(self.channel, 'topic', None) != topic:
+            with tracing.span('topic'):
+                await self.channel.edit(topic=topic)
+
+    def queue_pin_notice(self, message: discord.Message):
+        """
+        Schedules a "pinned a message" notice for deletion.
+        Notices arriving within a few seconds of each other are deleted together.
+        :param message: the pins_add system message
+        :return: None
+        """
+        self.pin_notices.append(message)
+        if self.notice_task is None or self.notice_task.done():
+            self.notice_task = asyncio.get_event_loop().create_task(self.flush_pin_notices())
+
+    async def flush_pin_notices(self):
+        await asyncio.sleep(pin_notice_delay)
+        notices, self.pin_notices = self.pin_notices, []
+        await bulk_delete(self.channel, notices)
+
+
+def webhook_from_url(url: str, session):
+    """
+    Creates a webhook that sends through the given aiohttp session.
+    :param url: the webhook URL, as copied from the channel settings
+    :param session: aiohttp session
+    :return: discord.Webhook
+    """
+    return discord.Webhook.from_url(url, session=session)
+
+
+class WebhookPublisher:
+    """
+    Keeps the schedule messages posted by one webhook in sync with the rendered schedule.
+    Webhooks can't read history or pin messages, so the posted message IDs and their content are remembered instead
+    (and saved in the bot's state store between restarts). Edits go through the webhook message endpoints, which are rate limited
+    per webhook rather than per bot.
+    """
+
+    def __init__(self, webhook, state: typing.Dict[str, list]):
+        self.webhook = webhook
+        self.state = state  # shared with the other webhook publishers
+        self.key = str(webhook.id)
+        self.state.setdefault(self.key, [])
+
+    def __str__(self):
+        return f"webhook {self.webhook.id}"
+
+    async def publish(self, payloads: typing.List[Payload], after: datetime.datetime = None, topic: str = None):
+        """
+        Edits, sends and deletes messages until the webhook's messages match the payloads.
+        :param payloads: rendered schedule messages, in order
+        :param after: unused, webhook messages are tracked by ID
+        :param topic: unused, webhooks can't edit the channel
+        :return: None
+        """
+        posted = self.state[self.key]
+        with tracing.span('publish'):
+            for i, payload in enumerate(payloads):
+                if i < len(posted):
+                    message_id, content = posted[i]
+                    if payload.embed is None and content == payload.content:
+                        continue
+                    try:
+                        await self.webhook.edit_message(message_id, content=payload.content, embed=payload.embed)
+                    except discord.NotFound:  # deleted by a moderator, post everything after it again
+                        for stale_id, _ in posted[i + 1:]:
+                            await self.delete(stale_id)
+                        del posted[i:]
+                    else:
+                        posted[i][1] = payload.content
+                        continue
+                kwargs = {'embed': payload.embed} if payload.embed is not None else {}
+                message = await self.webhook.send(payload.content, wait=True, **kwargs)
+                posted.append([message.id, payload.content])
+
+        if len(posted) > len(payloads):
+            with tracing.span('delete'):
+                for message_id, _ in posted[len(payloads):]:
+                    await self.delete(message_id)
+                del posted[len(payloads):]
+
+    async def delete(self, message_id: int):
+        try:
+            await self.webhook.delete_message(message_id)
+        except discord.NotFound:
+            pass
+
+
+def current_run(payloads: typing.List[Payload]) -> typing.Optional[str]:
+    """Returns the schedule message starting with the current run, if any"""
+    return next((payload.content for payload in payloads if payload.content and payload.content.startswith(ARROW)), None)
+
+
+class Job:
+    __slots__ = ('publisher', 'payloads', 'after', 'topic', 'done', 'priority', 'attempt', 'queued_at')
+
+    def __init__(self, publisher, payloads: typing.List[Payload], after: typing.Optional[datetime.datetime],
+                 topic: typing.Optional[str], done: typing.Optional[typing.Callable], priority: int):
+        self.publisher = publisher
+        self.payloads = payloads
+        self.after = after
+        self.topic = topic
+        self.done = done
+        self.priority = priority
+        self.attempt = 0
+        self.queued_at = time.monotonic()
+
+
+class PublishQueue:
+    """
+    Brings any number of channels and webhooks up to date with a schedule rendered once per cycle.
+    Every publisher has at most one pending job; a newer schedule replaces the one still waiting, so a slow guild falls
+    at most one schedule behind rather than building up a backlog. Jobs which move the current run go first.
+    A fixed number of workers publish side by side, each job has a time limit, and failed jobs are retried with backoff.
+    Channels which were deleted or which the bot may no longer post in are reported and skipped until the next cycle.
+    """
+
+    def __init__(self, workers: int = 4, retries: int = 3, timeout: float = 120.0, backoff: float = 5.0,
+                 bot: str = 'schedule'):
+        """
+        :param workers: jobs published at the same time
+        :param retries: attempts after the first failed one
+        :param timeout: seconds a job may take before it is cancelled and retried
+        :param backoff: delay before the first retry, doubled after every failure
+        :param bot: label of the metrics
+        """
+        self.workers = workers
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.bot = bot
+        self.queue: asyncio.PriorityQueue = None  # created with the workers, once the event loop runs
+        self.pending: typing.Dict[typing.Any, Job] = {}  # dict of publisher: its waiting job
+        self.published: typing.Dict[typing.Any, typing.Optional[str]] = {}  # dict of publisher: its current run message
+        self.running: typing.Set[typing.Any] = set()  # publishers being brought up to date right now
+        self.deferred: typing.Set[typing.Any] = set()  # publishers whose next job waits for the running one
+        self.order = itertools.count()  # keeps jobs of the same priority first in, first out
+        self.tasks: typing.List[asyncio.Task] = []
+
+    def put(self, publisher, payloads: typing.List[Payload], after: datetime.datetime = None, topic: str = None,
+            done: typing.Callable = None, urgent: bool = False):
+        """
+        Queues a publisher for bringing up to date, replacing its job if it is still waiting.
+        :param publisher: ChannelPublisher or WebhookPublisher
+        :param payloads: rendered schedule messages, in order
+        :param after: see ChannelPublisher.publish
+        :param topic: see ChannelPublisher.publish
+        :param done: called once the publisher is up to date
+        :param urgent: publish ahead of routine jobs even if the current run is the same, ie. when a run moved
+        :return: None
+        """
+        if not self.tasks:
+            self.queue = asyncio.PriorityQueue()
+            # in a context of their own, the first put() may happen inside a pipeline's traced cycle
+            loop = asyncio.get_event_loop()
+            self.tasks = [loop.create_task(self.worker(), context=contextvars.Context()) for _ in range(self.workers)]
+        current = current_run(payloads)
+        priority = URGENT if urgent or publisher not in self.published or self.published[publisher] != current else ROUTINE
+        waiting = self.pending.get(publisher)
+        if waiting is not None:
+            metrics.inc('publish_jobs_total', bot=self.bot, result='superseded')
+            priority = min(priority, waiting.priority)
+        self.pending[publisher] = Job(publisher, payloads, after, topic, done, priority)
+        if waiting is None or priority < waiting.priority:
+            self.queue.put_nowait((priority, next(self.order), publisher))
+        metrics.gauge('publish_queue_depth', len(self.pending), bot=self.bot)
+
+    async def join(self):
+        """Waits until every queued job has been published (or given up on), not counting pending retries"""
+        if self.queue is not None:
+            await self.queue.join()
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    async def worker(self):
+        while True:
+            _, _, publisher = await self.queue.get()
+            try:
+                if publisher not in self.pending:  # an earlier entry of the publisher, with a higher priority, took it
+                    continue
+                if publisher in self.running:  # one channel is never published to twice at once
+                    self.deferred.add(publisher)
+                    continue
+                job = self.pending.pop(publisher)
+                metrics.gauge('publish_queue_depth', len(self.pending), bot=self.bot)
+                metrics.observe('publish_queue_wait_seconds', time.monotonic() - job.queued_at, bot=self.bot)
+                self.running.add(publisher)
+                try:
+                    await self.run(job)
+                finally:
+                    self.running.discard(publisher)
+                    if publisher in self.deferred:
+                        self.deferred.discard(publisher)
+                        self.queue.put_nowait((self.pending[publisher].priority, next(self.order), publisher))
+            finally:
+                self.queue.task_done()
+
+    async def run(self, job: Job):
+        with tracing.cycle('publish'):
+            await self.publish(job)
+
+    async def publish(self, job: Job):
+        pub = job.publisher
+        try:
+            with metrics.timer('publish_duration_seconds', bot=self.bot):
+                await asyncio.wait_for(pub.publish(job.payloads, after=job.after, topic=job.topic), self.timeout)
+        except (discord.NotFound, discord.Forbidden) as e:
+            metrics.inc('publish_jobs_total', bot=self.bot, result='unavailable')
+            print(f"{pub}: {e} -- skipping it this cycle")
+        except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if job.attempt >= self.retries:
+                metrics.inc('publish_jobs_total', bot=self.bot, result='failed')
+                print(f"{pub}: {e!r} -- giving up until the next cycle")
+                return
+            metrics.inc('publish_jobs_total', bot=self.bot, result='retried')
+            delay = self.backoff * 2 ** job.attempt
+            print(f"{pub}: {e!r} -- retrying in {delay:.0f}s")
+            job.attempt += 1
+            asyncio.get_event_loop().create_task(self.retry(job, delay))
+        except Exception as e:
+            metrics.inc('publish_jobs_total', bot=self.bot, result='failed')
+            print(f"{pub}: {e}")
+            traceback.print_exc()
+        else:
+            metrics.inc('publish_jobs_total', bot=self.bot, result='published')
+            self.published[pub] = current_run(job.payloads)
+            print(f"[{datetime.datetime.now()}] {pub}: Schedule Updated!")
+            if job.done is not None:
+                job.done()
+
+    async def retry(self, job: Job, delay: float):
+        await asyncio.sleep(delay)
+        if job.publisher in self.pending or job.publisher in self.running:  # a newer schedule was queued meanwhile
+            return
+        job.queued_at = time.monotonic()
+        self.pending[job.publisher] = job
+        self.queue.put_nowait((job.priority, next(self.order), job.publisher))
+        metrics.gauge('publish_queue_depth', len(self.pending), bot=self.bot)
@@ -0,0 +1,487 @@
+"""
+Renders the schedule messages of main.py from a snapshot of tracker data, without any I/O.
+Everything a render depends on is in the Snapshot, so results can be cached on its digest and rendering can be handed
+to a worker thread or process. Only the current run's arrow and the "in 2 hours" times of the channel topic depend on
+the time, so the messages are cached on the digest plus the runs marked as current. As the donation and bid totals
+change nearly every cycle of an event, each run's message is also cached on a digest of what it is rendered from, and
+only the runs whose bids, VOD links or details changed are rendered again.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import math
+import pickle
+import re
+import typing
+
+import discord
+import pytz
+
+import metrics
+
+
+fix_space: re.Pattern = re.compile(" +")
+utc = pytz.timezone('UTC')
+_1970 = datetime.datetime(1970, 1, 1)
+ARROW = "\N{BLACK RIGHTWARDS ARROW}"
+
+
+class Settings(typing.NamedTuple):
+    gdq_url: str  # used for links to bids without a canonical_url
+    run_name_display: str  # which field of a run to use as the game name
+    upcoming_runs: int  # runs listed in the topic after the current one
+    emojis: dict  # dict of twitter/twitch/youtube: emoji string, blank to leave out
+
+
+class Snapshot(typing.NamedTuple):
+    """Everything the schedule is rendered from. Treat it as immutable, cached renders are keyed on its contents."""
+    index: dict  # fields of the event
+    runs: tuple  # ?type=run records in schedule order
+    runners: dict  # dict of runner_id: fields, for every runner of the runs
+    bids: tuple  # ?type=bid records
+    options: tuple  # ?type=bidtarget records
+    vods: dict  # dict of run_id: VOD link lines
+    timezone: str  # the event's timezone
+    settings: Settings
+    now: datetime.datetime  # timezone aware
+
+
+class Rendered(typing.NamedTuple):
+    messages: typing.Tuple[str, ...]  # header followed by one message per run
+    topic: typing.Tuple[str, ...]  # current and upcoming runs for the channel topic
+    roster: typing.Tuple[str, ...]  # the same runs with linked runners, for the Run Roster embed
+
+
+# Utility Functions
+def comma_format(input_list) -> str:
+    if not input_list:
+        return ''
+    *a, b = input_list
+    return ' and '.join([', '.join(a), b]) if a else b
+
+
+def bkup_link(gdq_url: str, _dir: str, _id: str):
+    _dir, _id = str(_dir), str(_id)
+    bkup_lnk_raw = gdq_url.split('/')
+    bkup_lnk_raw[-1] = _id
+    bkup_lnk_raw[-2] = _dir
+    return '/'.join(bkup_lnk_raw)
+
+
+def timestamp_obj_of(dt: datetime.datetime, mode: str = "") -> str:
+    return f"<t:{math.floor((dt.astimezone(utc).replace(tzinfo=None) - _1970).total_seconds())}:{mode}>"
+
+
+# noinspection HttpUrlsUsage
+def fix_stream_url(url: typing.Optional[str]) -> typing.Optional[str]:
+    if not url:
+        return url
+    if url.startswith("http://"):
+        url.replace("http://", "https://", 1)
+    if not url.startswith("https://"):
+        url = "https://" + url
+    return url
+
+
+def to_json(snapshot: Snapshot) -> dict:
+    """
+    Converts a snapshot into json-friendly data for saving, without the time.
+    :param snapshot: the snapshot
+    :return: dict
+    """
+    data = snapshot._replace(settings=snapshot.settings._asdict(), now=None)._asdict()
+    del data['now']
+    return data
+
+
+def encode(snapshot: Snapshot) -> typing.Tuple[str, str]:
+    """
+    Encodes a snapshot for saving, see to_json.
+    :param snapshot: the snapshot
+    :return: json text, and its digest
+    """
+    text = json.dumps(to_json(snapshot))
+    return text, hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def from_json(data: dict, now: datetime.datetime) -> Snapshot:
+    """
+    Restores a snapshot saved with to_json.
+    :param data: the saved data
+    :param now: the time to render it at
+    :return: Snapshot
+    """
+    return Snapshot(index=data['index'], runs=tuple(data['runs']),
+                    runners={int(pk): fields for pk, fields in data['runners'].items()},
+                    bids=tuple(data['bids']), options=tuple(data['options']),
+                    vods={int(pk): tuple(lines) for pk, lines in data['vods'].items()},
+                    timezone=data['timezone'], settings=Settings(**data['settings']), now=now)
+
+
+def digest(*data) -> str:
+    # pickle is several times faster than json here, and equal pickles always mean equal data
+    # (equal data may rarely pickle differently, which only costs a render)
+    return hashlib.blake2b(pickle.dumps(data, protocol=4), digest_size=16).hexdigest()
+
+
+def keys(snapshot: Snapshot) -> typing.Tuple[str, str]:
+    """
+    Hashes a snapshot for caching.
+    :param snapshot: the snapshot
+    :return: digest of the runs (all the run times depend on), and of everything except the time
+    """
+    return digest(snapshot.timezone, snapshot.runs), digest(snapshot._replace(now=None))
+
+
+def run_times(snapshot: Snapshot) -> typing.Tuple[typing.Tuple[datetime.datetime, datetime.datetime], ...]:
+    """
+    Parses the start and end times of every run, in the event's timezone.
+    :return: tuple of (starts_at, ends_at)
+    """
+    from dateutil.parser import isoparse  # dateutil is slow to import, so it is only loaded once there is something to parse
+    timezone = pytz.timezone(snapshot.timezone)
+    return tuple((isoparse(run['fields']['starttime']).astimezone(timezone),
+                  isoparse(run['fields']['endtime']).astimezone(timezone)) for run in snapshot.runs)
+
+
+def marks(snapshot: Snapshot, times) -> typing.Tuple[typing.FrozenSet[int], typing.Tuple[typing.Tuple[int, str], ...]]:
+    """
+    Finds the current run and the upcoming runs listed after it.
+    :param snapshot: the snapshot
+    :param times: run_times() of the snapshot
+    :return: positions of the runs to mark with an arrow, and (position, label) of every run in the topic
+    """
+    import humanize  # imported on first use, starting up doesn't need it
+    arrows = set()
+    entries = []
+    for runcount, (starts_at, ends_at) in enumerate(times):
+        # if one of the upcoming runs:
+        if 0 < len(entries) < snapshot.settings.upcoming_runs + 1:
+            htime = humanize.naturaltime(snapshot.now - starts_at)
+            entries.append((runcount, htime[0].upper() + htime[1:]))  # capitalize first letter
+        # if current run:
+        elif starts_at <= snapshot.now < ends_at:
+            arrows.add(runcount)
+            entries.append((runcount, "Current Game"))
+    return frozenset(arrows), tuple(entries)
+
+
+def format_runners(snapshot: Snapshot, run_data: dict) -> typing.Tuple[str, str]:
+    """
+    Lists the runners of a run.
+    :param snapshot: the snapshot
+    :param run_data: fields of the run
+    :return: runner names, and runner names linked to their streams and socials
+    """
+    emojis = snapshot.settings.emojis
+    runners = []  # not a one liner bc it makes them linked
+    runners_linked = []
+    for rid in run_data['runners']:  # for runner id in list of ids
+        data = snapshot.runners[rid]
+        runner_name = discord.utils.escape_markdown(data['name'])
+        runners.append(runner_name)
+        stream_url = fix_stream_url(data['stream'])
+        if stream_url:
+            name_temp = runner_name
+            if "twitch.tv/" in stream_url and emojis['twitch']:
+                name_temp += " " + emojis['twitch']
+            elif "youtube.com/" in stream_url and emojis['youtube']:
+                name_temp += " " + emojis['youtube']
+            name_temp = name_temp.strip()
+            runner_name = "[{}]({})".format(name_temp, stream_url)
+        if data['twitter'] and emojis['twitter']:
+            runner_name += " [{}](https://twitter.com/{})".format(emojis['twitter'], data['twitter'])
+        if data['youtube'] and "youtube.com/" not in stream_url and emojis['youtube']:
+            runner_name += " [{}](https://youtube.com/user/{})".format(emojis['youtube'], data['youtube'])
+        runners_linked.append(runner_name)
+    if runners:
+        return comma_format(runners), comma_format(runners_linked)
+    return "[nobody]", "[nobody]"
+
+
+def render_header(snapshot: Snapshot) -> str:
+    """
+    Renders the header message, with the event's name and donation total.
+    :param snapshot: the snapshot
+    :return: str
+    """
+    index = snapshot.index
+    settings = snapshot.settings
+    dnmsg1 = "Join the {dns} donators who have raised {amt} for {cha} at {lnk}. (Minimum Donation: {mnd})"
+    dnmsg2 = "Raised {amt} from {dns} donators for {cha}. "
+    dnmsg = dnmsg1 if not index['locked'] else dnmsg2
+    lnk = index['canonical_url'] if 'canonical_url' in index else bkup_link(settings.gdq_url, "index", index['short'])
+    dnmsg = dnmsg.format(dns=f"{int(index['count']):,}", amt=f"${float(index['amount']):,.2f}",
+                         cha=index['receivername'], lnk=lnk,
+                         mnd=f"${float(index['minimumdonation']):,.2f}")
+    return '\n'.join([f"**{index['name']}**",
+                      f"Date headers are in the {pytz.timezone(snapshot.timezone)} timezone.",
+                      dnmsg])
+
+
+def bid_indexes(snapshot: Snapshot) -> typing.Tuple[dict, dict]:
+    """
+    Indexes the bids by run and the bid options by bid, for efficient bid iteration.
+    :param snapshot: the snapshot
+    :return: dict of run_id: [bid1, bid2, ...], and dict of bid_id: [option fields, ...]
+    """
+    biddex = {}  # portmanteau of bid index, ha!
+    for bidorigin in snapshot.bids:
+        biddex.setdefault(bidorigin['fields']['speedrun'], []).append(bidorigin)
+    optiondex = {}
+    for optorigin in snapshot.options:
+        optiondex.setdefault(optorigin['fields']['parent'], []).append(optorigin['fields'])
+    return biddex, optiondex
+
+
+def day_starts(times) -> typing.FrozenSet[int]:
+    """
+    Finds the runs which start a new day, and so get a day separator.
+    :param times: run_times() of a snapshot
+    :return: positions of the runs
+    """
+    starts = set()
+    current_date = datetime.date(year=1970, month=1, day=15)  # for splitting schedule by end of day
+    for runcount, (starts_at, _) in enumerate(times):
+        if starts_at.date() > current_date:
+            starts.add(runcount)
+            current_date = starts_at.date()
+    return frozenset(starts)
+
+
+def run_keys(snapshot: Snapshot) -> typing.Tuple[str, ...]:
+    """
+    Hashes what each run's message is rendered from, but for its arrow and day separator.
+    :param snapshot: the snapshot
+    :return: one digest per run, in schedule order
+    """
+    biddex, optiondex = bid_indexes(snapshot)
+    shared = (snapshot.timezone, snapshot.settings)
+    keys = []
+    for run in snapshot.runs:
+        bids = biddex.get(run['pk'], [])
+        keys.append(digest(shared, run, [snapshot.runners[rid] for rid in run['fields']['runners']], bids,
+                           [optiondex.get(bid['pk']) for bid in bids], snapshot.vods.get(run['pk'])))
+    return tuple(keys)
+
+
+def render_run(snapshot: Snapshot, runcount: int, times, arrow: bool, new_day: bool, biddex: dict,
+               optiondex: dict) -> str:
+    """
+    Renders the message of one run, with its bids and VOD links.
+    :param snapshot: the snapshot
+    :param runcount: position of the run
+    :param times: run_times() of the snapshot
+    :param arrow: whether the run is marked as current
+    :param new_day: whether the run starts a new day
+    :param biddex: bids by run, see bid_indexes
+    :param optiondex: bid options by bid, see bid_indexes
+    :return: str
+    """
+    settings = snapshot.settings
+    run_data_base = snapshot.runs[runcount]
+    run_data = run_data_base['fields']  # all run data contained in here (except the ID)
+
+    starts_at = times[runcount][0]
+    _starts_at_frmt = timestamp_obj_of(starts_at, 'd')
+    starts_at_frmt = _starts_at_frmt + " " + _starts_at_frmt.replace('d', 't')
+    # adds the new day separator
+    prefix = ''
+    if new_day:
+        prefix += fix_space.sub(" ", starts_at.strftime("_ _%n> **%A** %b %e%n_ _%n"))
+    if arrow:
+        prefix += ARROW + " "
+
+    # name options/examples:
+    #   'name': 'Bonus Game 2 - Mario Kart 8 Deluxe' -- what appears on the schedule/index
+    #   'display_name': 'Mario Kart 8 Deluxe' -- actual game name
+    #   'twitch_name': 'Mario Kart 8' -- what the game will be set to on Twitch, often missing
+    gamename = run_data[settings.run_name_display]
+    category = run_data['category']
+    human_runners, _ = format_runners(snapshot, run_data)
+    race_str = " **RACE**" if (not run_data['coop'] and len(run_data['runners']) > 1) else ""  # says if race or not
+    estimate = run_data['run_time']  # run length/estimate
+
+    output = [f"{prefix}{starts_at_frmt}: {gamename} ({category}){race_str} by {human_runners} in {estimate}"]
+
+    for bid_data in biddex.get(run_data_base['pk'], []):
+        bid_id = bid_data['pk']
+        bid_data = bid_data['fields']
+        is_closed = bid_data['state'] == 'CLOSED'
+        bidname = bid_data['name']
+        moneyraised = float(bid_data['total'])
+        if bid_data['goal'] is not None:
+            moneygoal = float(bid_data['goal'])
+            # TODO: replace emoji chars with \N{} or something
+            if moneyraised >= moneygoal:
+                emoji = '✅'
+            elif is_closed:
+                emoji = '❌'
+            else:
+                emoji = '⚠️'
+            extradata = f"${moneyraised:,.2f}/${moneygoal:,.2f}, {int((moneyraised / moneygoal) * 100)}%"
+        else:
+            emoji = '💰' if is_closed else '⏰'
+            if optiondex.get(bid_id):
+                optfields = optiondex[bid_id]
+                templist = [o2['name'] for o2 in sorted(optfields, reverse=True, key=lambda o1: float(o1['total']))[:3]]
+                if len(optfields) > 3:
+                    templist.append('...')
+                templist[0] = f"**{templist[0]}**"
+                extradata = '/'.join(templist)
+            else:
+                bid_lnk = bid_data['canonical_url'] if 'canonical_url' in bid_data else bkup_link(settings.gdq_url, "bid", bid_id)
+                extradata = f"<{bid_lnk}>"
+        output.append(f"{emoji} {bidname} ({extradata})")
+
+    # VOD links from VODThread
+    output.extend(snapshot.vods.get(run_data_base['pk'], ()))
+    return '\n'.join(output)
+
+
+def render_runs(snapshot: Snapshot, times, arrows: typing.FrozenSet[int],
+                positions: typing.Iterable[int]) -> typing.Tuple[str, ...]:
+    """
+    Renders the messages of some of the runs.
+    :param snapshot: the snapshot
+    :param times: run_times() of the snapshot
+    :param arrows: positions of the runs to mark as current
+    :param positions: positions of the runs to render
+    :return: tuple of messages, in the order of positions
+    """
+    biddex, optiondex = bid_indexes(snapshot)
+    new_days = day_starts(times)
+    return tuple(render_run(snapshot, runcount, times, runcount in arrows, runcount in new_days, biddex, optiondex)
+                 for runcount in positions)
+
+
+def render_messages(snapshot: Snapshot, times, arrows: typing.FrozenSet[int]) -> typing.Tuple[str, ...]:
+    """
+    Renders the header and run messages.
+    :param snapshot: the snapshot
+    :param times: run_times() of the snapshot
+    :param arrows: positions of the runs to mark as current
+    :return: tuple of messages
+    """
+    return (render_header(snapshot),) + render_runs(snapshot, times, arrows, range(len(snapshot.runs)))
+
+
+def render_upcoming(snapshot: Snapshot, entries) -> typing.Tuple[typing.Tuple[str, ...], typing.Tuple[str, ...]]:
+    """
+    Lists the current and upcoming runs.
+    :param snapshot: the snapshot
+    :param entries: (position, label) of the runs to list, from marks()
+    :return: lines for the channel topic and lines for the Run Roster embed
+    """
+    topic = []
+    roster = []
+    for runcount, label in entries:
+        run_data = snapshot.runs[runcount]['fields']
+        human_runners, human_runners_linked = format_runners(snapshot, run_data)
+        runline = f"{label}: {run_data[snapshot.settings.run_name_display]} ({run_data['category']}) by "
+        topic.append(runline + human_runners)
+        roster.append(runline + human_runners_linked)
+    return tuple(topic), tuple(roster)
+
+
+def render(snapshot: Snapshot) -> Rendered:
+    """
+    Renders a snapshot without any caching.
+    :param snapshot: the snapshot
+    :return: Rendered
+    """
+    times = run_times(snapshot)
+    arrows, entries = marks(snapshot, times)
+    return Rendered(render_messages(snapshot, times, arrows), *render_upcoming(snapshot, entries))
+
+
+def executor(workers: str = 'thread') -> typing.Optional[concurrent.futures.Executor]:
+    """
+    Creates the executor schedules are rendered in, picked with render_workers in the config.
+    :param workers: thread, process or none
+    :return: the executor, or None to render on the event loop
+    """
+    if workers == 'process':
+        return concurrent.futures.ProcessPoolExecutor(max_workers=1)
+    if workers == 'thread':
+        return concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='renderer')
+    return None
+
+
+class Renderer:
+    """
+    Renders snapshots, caching the messages of recent snapshots, the parsed run times of recent schedules and the
+    message of every run of the last render. The times stay cached while only donation totals change, which during an
+    event is nearly every cycle, and the runs stay cached until something shown in their message changes.
+    The heavy steps run in an executor when one is given; a thread pool keeps the event loop (and so the gateway
+    heartbeat) responsive, a process pool also sidesteps the GIL.
+    """
+
+    def __init__(self, executor: concurrent.futures.Executor = None, cache_size: int = 8):
+        self.executor = executor
+        self.cache_size = cache_size
+        self.times: typing.OrderedDict[str, tuple] = collections.OrderedDict()  # dict of runs digest: run_times()
+        self.messages: typing.OrderedDict[tuple, tuple] = collections.OrderedDict()  # dict of (digest, arrows): messages
+        self.runs: typing.Dict[tuple, str] = {}  # dict of (run digest, arrow, new day): message, of the last render
+
+    def remember(self, cache: collections.OrderedDict, key, value):
+        cache[key] = value
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return value
+
+    async def call(self, func, *args):
+        if self.executor is None:
+            return func(*args)
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    async def hash(self, func, snapshot: Snapshot):
+        if isinstance(self.executor, concurrent.futures.ProcessPoolExecutor):
+            # hashing pickles the snapshot anyway, so don't pickle it a second time to send it to the process
+            return await asyncio.get_event_loop().run_in_executor(None, func, snapshot)
+        return await self.call(func, snapshot)
+
+    async def render_messages(self, snapshot: Snapshot, times, arrows: typing.FrozenSet[int]) -> typing.Tuple[str, ...]:
+        """
+        Renders the header and run messages, reusing the messages of the runs which didn't change since the last render.
+        :param snapshot: the snapshot
+        :param times: run_times() of the snapshot
+        :param arrows: positions of the runs to mark as current
+        :return: tuple of messages
+        """
+        new_days = day_starts(times)
+        keys = [(key, runcount in arrows, runcount in new_days)
+                for runcount, key in enumerate(await self.hash(run_keys, snapshot))]
+        missing = [runcount for runcount, key in enumerate(keys) if key not in self.runs]
+        metrics.inc('cache_requests_total', len(keys) - len(missing), cache='render_runs', result='hit')
+        metrics.inc('cache_requests_total', len(missing), cache='render_runs', result='miss')
+        runs = {key: self.runs[key] for key in keys if key in self.runs}
+        if missing:
+            runs.update(zip((keys[runcount] for runcount in missing),
+                            await self.call(render_runs, snapshot, times, arrows, missing)))
+        self.runs = runs
+        return (render_header(snapshot),) + tuple(runs[key] for key in keys)
+
+    async def render(self, snapshot: Snapshot) -> Rendered:
+        """
+        Renders a snapshot, reusing the messages of an earlier identical one.
+        :param snapshot: the snapshot
+        :return: Rendered
+        """
+        runs_key, key = await self.hash(keys, snapshot)
+        times = self.times.get(runs_key)
+        if times is None:
+            times = self.remember(self.times, runs_key, await self.call(run_times, snapshot))
+        self.times.move_to_end(runs_key)
+        arrows, entries = marks(snapshot, times)
+        messages = self.messages.get((key, arrows))
+        if messages is None:
+            metrics.inc('cache_requests_total', cache='render', result='miss')
+            messages = self.remember(self.messages, (key, arrows), await self.render_messages(snapshot, times, arrows))
+        else:
+            metrics.inc('cache_requests_total', cache='render', result='hit')
+            self.messages.move_to_end((key, arrows))
+        return Rendered(messages, *render_upcoming(snapshot, entries))
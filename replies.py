@@ -0,0 +1,100 @@
+"""
+Replies to chat commands, throttled per channel.
+
+Each channel sends at most one command reply every cooldown seconds. Commands which arrive in the meantime wait in
+line, and the same command asked again while it waits joins the reply already in line, which then mentions everyone who
+asked. A reply identical to one sent in the channel within the last window seconds isn't sent again, and older replies
+are forgotten. A storm of t!total in a hype moment thus costs a couple of messages, and leaves the channel's rate limit
+to milestone announcements, which don't go through here.
+"""
+import asyncio
+import collections
+import inspect
+import time
+import traceback
+import typing
+
+import metrics
+
+
+mentioned = 10  # askers mentioned in a coalesced reply, the rest are counted
+
+
+def mention(users: typing.List[int]) -> str:
+    """
+    Makes the line naming the users who asked for a coalesced reply.
+    :param users: IDs of the users
+    :return: str, empty for a single user
+    """
+    if len(users) <= 1:
+        return ''
+    more = f" and {len(users) - mentioned} more" if len(users) > mentioned else ''
+    return ' '.join(f"<@{user}>" for user in users[:mentioned]) + more + '\n'
+
+
+class ChannelReplies:
+    """The replies waiting for one channel"""
+
+    def __init__(self):
+        self.ready_at = 0.0  # monotonic time the next reply may be sent
+        self.pending: typing.OrderedDict[str, typing.Tuple[typing.Callable, typing.List[int]]] = collections.OrderedDict()
+        self.sent: typing.Dict[str, typing.Tuple[str, float]] = {}  # dict of key: (content, monotonic time sent)
+        self.flusher: typing.Optional[asyncio.Future] = None
+
+
+class ReplyQueue:
+    def __init__(self, cooldown: float = 2.0, window: float = 10.0):
+        """
+        :param cooldown: seconds between replies in a channel
+        :param window: seconds a reply isn't repeated for in a channel
+        """
+        self.cooldown = cooldown
+        self.window = window
+        self.channels: typing.Dict[int, ChannelReplies] = {}
+
+    def request(self, channel, key: str, user: int, answer: typing.Callable):
+        """
+        Queues a reply to a command.
+        :param channel: the channel the command was sent in
+        :param key: identifies the reply, commands with the same key get the same reply
+        :param user: ID of the user who sent the command
+        :param answer: function (or coroutine function) making the reply, called when it is sent
+        :return: None
+        """
+        replies = self.channels.setdefault(channel.id, ChannelReplies())
+        if key in replies.pending:
+            users = replies.pending[key][1]
+            if user not in users:
+                users.append(user)
+            metrics.inc('command_replies_total', result='coalesced')
+            return
+        replies.pending[key] = (answer, [user])
+        if replies.flusher is None:
+            replies.flusher = asyncio.ensure_future(self.flush(channel, replies))
+
+    async def flush(self, channel, replies: ChannelReplies):
+        try:
+            while replies.pending:
+                wait = replies.ready_at - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                key, (answer, users) = replies.pending.popitem(last=False)
+                try:
+                    reply = answer()
+                    if inspect.isawaitable(reply):
+                        reply = await reply
+                    last = replies.sent.get(key)
+                    if last is not None and last[0] == reply and time.monotonic() - last[1] < self.window:
+                        metrics.inc('command_replies_total', len(users), result='repeated')
+                        continue
+                    await channel.send(mention(users) + reply)
+                    now = time.monotonic()
+                    # keys come from what users type, so only the replies which can still be repeated are kept
+                    replies.sent = {k: sent for k, sent in replies.sent.items() if now - sent[1] < self.window}
+                    replies.sent[key] = (reply, now)
+                    replies.ready_at = time.monotonic() + self.cooldown
+                    metrics.inc('command_replies_total', result='sent')
+                except Exception:
+                    traceback.print_exc()
+        finally:
+            replies.flusher = None
@@ -0,0 +1,197 @@
+"""
+Donation history of an event, as (timestamp, total, donor count) samples.
+
+Whichever bot polls the event index appends a sample to the event's file of fixed-width records, each one in a single
+write to a file opened for appending, so several bots can share a file. Samples which repeat the previous one are
+skipped unless heartbeat seconds have passed. Readers memory-map the file and answer questions with NumPy: the total
+at any time is the last sample before it, found with a binary search, so a week of 1 second samples (about 12 MB) is
+queried in microseconds.
+"""
+import os
+import struct
+import tempfile
+import time
+import typing
+
+import numpy as np
+
+magic = b'GDQDONS\n'
+version = 1
+record = np.dtype([('t', '<f8'), ('total', '<f8'), ('donors', '<u4')])  # unix time, $ raised, number of donors
+_header = struct.Struct('<8sII')  # magic, version, record size
+_record = struct.Struct('<ddI')
+header_size = _header.size
+
+heartbeat = 60.0  # seconds after which an unchanged total is recorded again
+
+
+def open_series(config: dict, event: int) -> typing.Optional['DonationSeries']:
+    """
+    Opens the donation history of an event in the directory named by series_dir in the config.
+    :param config: the bot's config
+    :param event: event pk
+    :return: the series, or None if series_dir is set to null
+    """
+    directory = config.get('series_dir', 'series')
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    return DonationSeries(os.path.join(directory, f"donations-{event}.bin"))
+
+
+class DonationSeries:
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.fd: typing.Optional[int] = None  # opened for appending with the first sample
+        self.map: np.ndarray = np.zeros(0, record)
+        self.times: np.ndarray = np.zeros(0)  # contiguous copy of map['t'], which binary searches need
+        self.mapped_size = 0
+
+    # writing
+    def open(self) -> int:
+        if self.fd is None:
+            if not os.path.exists(self.filename):
+                self.create()
+            self.fd = os.open(self.filename, os.O_RDWR | os.O_APPEND)
+        return self.fd
+
+    def create(self):
+        """Creates the file with its header in one step, so other bots never see it without one"""
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.filename) or '.')
+        try:
+            os.write(fd, _header.pack(magic, version, record.itemsize))
+            os.close(fd)
+            os.link(tmp, self.filename)
+        except FileExistsError:  # another bot was quicker
+            pass
+        finally:
+            os.unlink(tmp)
+
+    def last(self) -> typing.Optional[tuple]:
+        """Reads the newest sample in the file, which may have been written by another bot"""
+        fd = self.open()
+        count = (os.fstat(fd).st_size - header_size) // record.itemsize
+        if count <= 0:
+            return None
+        return _record.unpack(os.pread(fd, record.itemsize, header_size + (count - 1) * record.itemsize))
+
+    def append(self, total: float, donors: int, t: float = None) -> bool:
+        """
+        Records a sample.
+        :param total: $ raised
+        :param donors: number of donors
+        :param t: unix time of the sample, defaults to now
+        :return: whether it was written, it isn't if it is older than the newest sample or repeats it
+        """
+        t = time.time() if t is None else t
+        last = self.last()
+        if last is not None and (t <= last[0] or (total == last[1] and donors == last[2] and t - last[0] < heartbeat)):
+            return False
+        os.write(self.open(), _record.pack(t, total, donors))
+        return True
+
+    def record(self, index: dict, t: float = None) -> bool:
+        """
+        Records the total of an event index.
+        :param index: fields of the event, as returned by the tracker
+        :param t: unix time of the sample, defaults to now
+        :return: whether it was written
+        """
+        return self.append(float(index['amount']), int(index.get('count') or 0), t)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    # reading
+    def samples(self) -> np.ndarray:
+        """
+        Maps the samples, again whenever the file has grown.
+        :return: structured array with the fields t, total and donors, oldest first
+        """
+        try:
+            size = os.path.getsize(self.filename)
+        except FileNotFoundError:
+            return self.map
+        if size != self.mapped_size:
+            count = (size - header_size) // record.itemsize
+            if count > 0:
+                with open(self.filename, 'rb') as f:
+                    if _header.unpack(f.read(header_size)) != (magic, version, record.itemsize):
+                        raise ValueError(f"{self.filename} is not a donation series")
+                self.map = np.memmap(self.filename, dtype=record, mode='r', offset=header_size, shape=(count,))
+                self.times = np.ascontiguousarray(self.map['t'])
+            self.mapped_size = size
+        return self.map
+
+    def total_at(self, t):
+        """
+        Looks up the total at one or more times.
+        :param t: unix time, or an array of them
+        :return: the total of the last sample at or before each time (the first sample's before it), NaN without samples
+        """
+        samples = self.samples()
+        if not len(samples):
+            return np.full(np.shape(t), np.nan)[()]
+        i = np.searchsorted(self.times, t, side='right') - 1
+        return samples['total'][np.maximum(i, 0)]
+
+    def rate(self, start, end):
+        """
+        Works out the $ raised per hour over one or more windows.
+        :param start: unix time the window starts, or an array of them
+        :param end: unix time the window ends, or an array of them
+        :return: $ per hour
+        """
+        start, end = np.asarray(start, dtype=float), np.asarray(end, dtype=float)
+        return (self.total_at(end) - self.total_at(start)) / np.maximum((end - start) / 3600, 1e-9)
+
+    def by_run(self, starts, ends) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Works out what was raised during each run.
+        :param starts: unix times the runs started
+        :param ends: unix times the runs ended
+        :return: arrays of $ raised and $ per hour
+        """
+        starts, ends = np.asarray(starts, dtype=float), np.asarray(ends, dtype=float)
+        raised = self.total_at(ends) - self.total_at(starts)
+        return raised, raised / np.maximum((ends - starts) / 3600, 1e-9)
+
+    def spikes(self, window: float = 60.0, top: int = 5, since: float = None) -> typing.List[typing.Tuple[float, float]]:
+        """
+        Finds the windows in which the most was raised.
+        :param window: length of the windows in seconds
+        :param top: number of windows to return
+        :param since: unix time to look from, defaults to the first sample
+        :return: list of (unix time the window ended, $ raised in it), biggest first, not overlapping
+        """
+        samples = self.samples()
+        first = 0 if since is None else int(np.searchsorted(self.times, since))
+        if first >= len(samples):
+            return []
+        t = self.times[first:]
+        samples = samples[first:]
+        raised = np.asarray(samples['total']) - self.total_at(t - window)
+        found = []
+        while len(found) < top:
+            i = int(np.argmax(raised))
+            if raised[i] <= 0:
+                break
+            found.append((float(t[i]), float(raised[i])))
+            # windows overlapping this one can't be picked anymore
+            raised[np.searchsorted(t, t[i] - window, side='right'):np.searchsorted(t, t[i] + window, side='left')] = 0
+        return found
+
+
+def run_windows(runs: typing.List[dict]) -> typing.Tuple[list, np.ndarray, np.ndarray]:
+    """
+    Extracts when runs started and ended, for DonationSeries.by_run.
+    :param runs: ?type=run records
+    :return: run pks, and arrays of unix start and end times
+    """
+    from dateutil.parser import isoparse  # only needed once runs are looked at
+    runs = [run for run in runs if run['fields'].get('starttime') and run['fields'].get('endtime')]
+    return ([run['pk'] for run in runs],
+            np.array([isoparse(run['fields']['starttime']).timestamp() for run in runs]),
+            np.array([isoparse(run['fields']['endtime']).timestamp() for run in runs]))
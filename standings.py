@@ -0,0 +1,65 @@
+"""
+Standings of the donation total prediction game.
+
+The predictions are kept as NumPy arrays sorted by amount, so who is closest to a total, where a player ranks and how
+many predictions are still in the running are answered with binary searches rather than a scan of every prediction.
+The games bot keeps the replies made from them until the total changes (see GDQGames.answer), so a burst of the same
+question costs one lookup.
+"""
+import typing
+
+import numpy as np
+
+
+class Standings:
+    def __init__(self, predictions: typing.List[dict]):
+        """
+        :param predictions: the contents of predictions.json, dicts with ping, amount and max
+        """
+        order = np.argsort([prediction['amount'] for prediction in predictions], kind='stable')
+        self.amounts = np.array([predictions[i]['amount'] for i in order], dtype=float)
+        self.maxes = np.array([predictions[i]['max'] for i in order], dtype=float)
+        self.pings = np.array([predictions[i]['ping'] for i in order], dtype=np.int64)
+        self.sorted_maxes = np.sort(self.maxes)
+        self.position = {int(ping): i for i, ping in enumerate(self.pings)}  # dict of user ID: index in the arrays
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def closest(self, total: float, n: int = 5) -> typing.List[typing.Tuple[int, float, float]]:
+        """
+        Finds the predictions closest to a total.
+        :param total: $ raised
+        :param n: number of predictions
+        :return: list of (user ID, amount, distance to the total), closest first
+        """
+        i = int(np.searchsorted(self.amounts, total))
+        # the n closest are among the n on either side of the total
+        lo, hi = max(i - n, 0), min(i + n, len(self.amounts))
+        distance = np.abs(self.amounts[lo:hi] - total)
+        best = lo + np.argsort(distance, kind='stable')[:n]
+        return [(int(self.pings[j]), float(self.amounts[j]), float(abs(self.amounts[j] - total))) for j in best]
+
+    def rank(self, total: float, ping: int) -> typing.Optional[typing.Tuple[int, float, float, bool]]:
+        """
+        Works out where a player's prediction ranks by how close it is to a total.
+        :param total: $ raised
+        :param ping: the player's user ID
+        :return: (rank starting at 1, amount, distance to the total, whether it was surpassed), None without a prediction
+        """
+        i = self.position.get(ping)
+        if i is None:
+            return None
+        amount = self.amounts[i]
+        # predictions strictly closer are the ones between this one and its mirror image across the total
+        lo, hi = sorted((amount, 2 * total - amount))
+        closer = np.searchsorted(self.amounts, hi, side='left') - np.searchsorted(self.amounts, lo, side='right')
+        return max(int(closer), 0) + 1, float(amount), float(abs(amount - total)), bool(total > self.maxes[i])
+
+    def alive(self, total: float) -> int:
+        """
+        Counts the predictions which haven't been surpassed.
+        :param total: $ raised
+        :return: int
+        """
+        return len(self.sorted_maxes) - int(np.searchsorted(self.sorted_maxes, total, side='left'))
@@ -0,0 +1,131 @@
+import json
+import sqlite3
+import time
+import typing
+
+
+schema = """
+CREATE TABLE IF NOT EXISTS kv (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE TABLE IF NOT EXISTS runners (
+    event INTEGER NOT NULL,
+    pk INTEGER NOT NULL,
+    fields TEXT NOT NULL,
+    PRIMARY KEY (event, pk)
+);
+CREATE TABLE IF NOT EXISTS announcements (
+    key TEXT PRIMARY KEY,
+    claimed_at REAL NOT NULL
+);
+"""
+
+
+class StateStore:
+    """
+    Crash-safe state shared by the bots, in an SQLite database in WAL mode.
+    Every write is its own small transaction, so the bots save state as it changes and a restart picks up where the
+    last run left off. The bots run as separate processes and may share one database file.
+    """
+
+    def __init__(self, filename: str = 'state.db'):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=10, isolation_level=None)  # autocommit, writes are single statements
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')  # durable across crashes of the bot, only a power cut can lose the last write
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    # plain values
+    def get(self, namespace: str, key: str, default: typing.Any = None, max_age: float = None) -> typing.Any:
+        """
+        Loads a value.
+        :param namespace: ie. the bot and event, games:36
+        :param key: name of the value
+        :param default: returned if there is no (recent enough) value
+        :param max_age: seconds since the value was saved after which it is ignored
+        :return: the json-decoded value
+        """
+        row = self.db.execute('SELECT value, updated_at FROM kv WHERE namespace = ? AND key = ?',
+                              (namespace, key)).fetchone()
+        if row is None or (max_age is not None and time.time() - row[1] > max_age):
+            return default
+        return json.loads(row[0])
+
+    def set(self, namespace: str, key: str, value: typing.Any):
+        self.set_encoded(namespace, key, json.dumps(value))
+
+    def set_encoded(self, namespace: str, key: str, value: str):
+        """Saves a value which is already json, ie. one encoded off the event loop"""
+        self.db.execute('INSERT INTO kv (namespace, key, value, updated_at) VALUES (?, ?, ?, ?) '
+                        'ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at',
+                        (namespace, key, value, time.time()))
+
+    def delete(self, namespace: str, key: str):
+        self.db.execute('DELETE FROM kv WHERE namespace = ? AND key = ?', (namespace, key))
+
+    # runners
+    def runners(self, event: int) -> typing.Dict[int, dict]:
+        """
+        Loads the saved runners of an event.
+        :param event: event pk
+        :return: dict of runner_id: fields
+        """
+        return {pk: json.loads(fields) for pk, fields in
+                self.db.execute('SELECT pk, fields FROM runners WHERE event = ?', (event,))}
+
+    def save_runners(self, event: int, runners: typing.Dict[int, dict]):
+        """
+        Saves runners of an event, replacing earlier versions of them.
+        :param event: event pk
+        :param runners: dict of runner_id: fields
+        """
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR REPLACE INTO runners (event, pk, fields) VALUES (?, ?, ?)',
+                                ((event, pk, json.dumps(fields)) for pk, fields in runners.items()))
+
+    # announcements
+    def claim(self, key: str) -> bool:
+        """
+        Claims an announcement before it is sent, so it is only ever sent once, even across restarts.
+        Release the claim if sending fails. A bot which dies between claiming and sending skips the announcement
+        rather than repeating it.
+        :param key: identifies the announcement, ie. milestone:36:1000000
+        :return: whether the announcement hadn't been claimed yet and should be sent
+        """
+        cursor = self.db.execute('INSERT OR IGNORE INTO announcements (key, claimed_at) VALUES (?, ?)', (key, time.time()))
+        return cursor.rowcount == 1
+
+    def release(self, key: str):
+        self.db.execute('DELETE FROM announcements WHERE key = ?', (key,))
+
+    def announced(self, key: str) -> bool:
+        return self.db.execute('SELECT 1 FROM announcements WHERE key = ?', (key,)).fetchone() is not None
+
+    async def announce(self, key: str, send: typing.Callable[[], typing.Awaitable]) -> bool:
+        """
+        Sends an announcement unless it has been sent before, see claim.
+        :param key: identifies the announcement
+        :param send: coroutine function sending it
+        :return: whether it was sent
+        """
+        if not self.claim(key):
+            return False
+        try:
+            await send()
+        except BaseException:
+            self.release(key)
+            raise
+        return True
+
+
+def open_store(config: dict) -> StateStore:
+    """Opens the database named by state_db in the config"""
+    return StateStore(config.get('state_db', 'state.db'))
@@ -0,0 +1,143 @@
+"""
+Opt-in tracing of the bots' cycles.
+
+Enabled with the trace_dir config key or the GDQ_TRACE environment variable (a directory). Each processor/gamer/handle
+invocation and each publish job then writes its spans as collapsed stacks (`processor;render;fetch;GET run 1234`,
+microseconds of self time), which flamegraph.pl, inferno and speedscope read directly. With trace_memory (or
+GDQ_TRACE_MEMORY=1) the memory growth since the previous cycle is written next to it, as the top allocation sites from
+tracemalloc.
+While disabled span() hands back a shared no-op context manager, so the hooks cost a function call.
+"""
+import contextlib
+import contextvars
+import datetime
+import os
+import time
+import tracemalloc
+import typing
+
+enabled = False
+directory: typing.Optional[str] = None
+memory = False
+memory_top = 15  # allocation sites listed per memory report
+
+_noop = contextlib.nullcontext()
+_stack: contextvars.ContextVar = contextvars.ContextVar('trace_stack', default=())
+_totals: contextvars.ContextVar = contextvars.ContextVar('trace_totals', default=None)
+_snapshots: typing.Dict[str, tracemalloc.Snapshot] = {}  # dict of loop: snapshot after its last cycle
+
+
+def setup(config: dict):
+    """
+    Turns tracing on if it was asked for in the config or environment.
+    :param config: the bot's config
+    """
+    global enabled, directory, memory
+    directory = os.environ.get('GDQ_TRACE') or config.get('trace_dir')
+    memory = os.environ.get('GDQ_TRACE_MEMORY', '') not in ('', '0') or bool(config.get('trace_memory'))
+    enabled = bool(directory)
+    if not enabled:
+        return
+    os.makedirs(directory, exist_ok=True)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start(10)
+    print(f"Tracing cycles to {directory}" + (" with memory reports" if memory else ""))
+
+
+class Span:
+    __slots__ = ('name', 'totals', 'token', 'start')
+
+    def __init__(self, name: str, totals: dict):
+        self.name = name
+        self.totals = totals
+
+    def __enter__(self):
+        self.token = _stack.set(_stack.get() + (self.name,))
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stack = _stack.get()
+        _stack.reset(self.token)
+        self.totals[stack] = self.totals.get(stack, 0.0) + elapsed
+
+
+def span(name: str):
+    """
+    Times a block as a child of the current span.
+    :param name: ie. fetch, parse, render, diff or publish
+    :return: context manager
+    """
+    if not enabled:
+        return _noop
+    totals = _totals.get()
+    if totals is None:  # outside of a traced cycle
+        return _noop
+    return Span(name, totals)
+
+
+@contextlib.contextmanager
+def cycle(loop: str):
+    """
+    Traces one invocation of a loop or handler and writes its profile once it finishes.
+    :param loop: name of the root span, ie. processor
+    """
+    if not enabled:
+        yield
+        return
+    totals = {}
+    token = _totals.set(totals)
+    started = datetime.datetime.now()
+    try:
+        with Span(loop, totals):
+            yield
+    finally:
+        _totals.reset(token)
+        name = f"{loop}-{started:%Y%m%d-%H%M%S-%f}"
+        write_folded(os.path.join(directory, f"{name}.folded"), totals)
+        if memory:
+            write_memory(os.path.join(directory, f"{name}.memory.txt"), loop)
+
+
+def write_folded(filename: str, totals: typing.Dict[tuple, float]):
+    """
+    Writes spans as collapsed stacks of self time in microseconds.
+    :param filename: output file
+    :param totals: dict of span stack: total seconds
+    """
+    children = {}
+    for stack, elapsed in totals.items():
+        if len(stack) > 1:
+            children[stack[:-1]] = children.get(stack[:-1], 0.0) + elapsed
+    with open(filename, 'w') as f:
+        for stack, elapsed in totals.items():
+            self_time = max(elapsed - children.get(stack, 0.0), 0.0)
+            f.write(f"{';'.join(stack)} {int(self_time * 1000000)}\n")
+
+
+def write_memory(filename: str, loop: str):
+    """
+    Writes where memory grew since the previous cycle of a loop.
+    :param filename: output file
+    :param loop: the loop's name
+    """
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    previous = _snapshots.get(loop)
+    _snapshots[loop] = snapshot
+    current, peak = tracemalloc.get_traced_memory()
+    with open(filename, 'w') as f:
+        f.write(f"traced: {current / 1024:,.1f} KiB, peak {peak / 1024:,.1f} KiB\n")
+        if previous is None:
+            f.write("first cycle, growth is reported from the next one on\n")
+            return
+        stats = snapshot.compare_to(previous, 'lineno')
+        growth = sum(stat.size_diff for stat in stats)
+        f.write(f"growth since the last cycle: {growth / 1024:+,.1f} KiB\n\n")
+        for stat in stats[:memory_top]:
+            f.write(f"{stat}\n")
+    print(f"{loop}: memory grew {growth / 1024:+,.1f} KiB since the last cycle")
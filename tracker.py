@@ -0,0 +1,250 @@
+import asyncio
+import collections
+import random
+import time
+import typing
+from urllib.parse import parse_qs, urlsplit
+
+import aiohttp
+
+import metrics
+import tracing
+
+
+class TrackerError(Exception):
+    """Raised when the tracker can't be reached and there is no earlier response to fall back on"""
+
+
+class QueryError(TrackerError):
+    """Raised when the tracker refuses a query (a 4xx response), which asking again won't change"""
+
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+
+# 4xx responses which say nothing about the query, and are retried like server errors
+transient_statuses = {408, 429}
+
+
+def response_age(headers) -> float:
+    """
+    Reads how long a response was cached before it was sent, ie. by proxy.py.
+    :param headers: the response headers
+    :return: seconds, from the Age header
+    """
+    try:
+        return max(0.0, float(headers.get('Age', 0)))
+    except ValueError:
+        return 0.0
+
+
+class CircuitBreaker:
+    """
+    Stops requests to an endpoint after repeated failures.
+    Once reset_after seconds have passed a request is let through again, which closes the circuit if it succeeds.
+    """
+
+    def __init__(self, threshold: int = 5, reset_after: float = 60.0):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: typing.Optional[float] = None
+
+    @property
+    def open(self) -> bool:
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_after
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+class TrackerClient:
+    """
+    Loads pages from a tracker API (or Horaro) without ever taking the bot down.
+    Failed requests are retried with jittered exponential backoff, each endpoint gets a circuit breaker, and while an
+    endpoint is failing the last good response of a query is served instead. Queries the tracker refuses are neither
+    retried nor held against the endpoint, so a malformed query (ie. from a script behind proxy.py) can't open the
+    circuit for everyone else.
+    """
+
+    def __init__(self, base_url: str, session: aiohttp.ClientSession, headers: dict = None, delay: float = 2.5,
+                 retries: int = 3, backoff: float = 1.0, max_backoff: float = 60.0,
+                 threshold: int = 5, reset_after: float = 60.0, max_cached: int = 1000):
+        """
+        :param base_url: URL the queries are appended to
+        :param session: aiohttp session
+        :param headers: request headers
+        :param delay: seconds to wait after each successful request, as the trackers don't publish ratelimits
+        :param retries: attempts after the first failed one before falling back to the last good response
+        :param backoff: base delay between attempts, doubled after every failure
+        :param max_backoff: upper bound of the delay between attempts
+        :param threshold: failures in a row after which an endpoint's circuit opens
+        :param reset_after: seconds until an open circuit lets a request through again
+        :param max_cached: responses kept for falling back on, the least recently used ones are dropped first
+        """
+        self.base_url = base_url
+        self.session = session
+        self.headers = headers or {}
+        self.delay = delay
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.max_cached = max_cached
+        self.breakers: typing.Dict[str, CircuitBreaker] = {}  # dict of endpoint: breaker
+        # dict of url: (monotonic time fetched, json, unix time fetched), least recently used first
+        self.cache: typing.OrderedDict[str, typing.Tuple[float, typing.Any, float]] = collections.OrderedDict()
+        self.refreshing: typing.Dict[str, asyncio.Task] = {}  # background revalidations by url
+        self.loading: typing.Dict[str, asyncio.Future] = {}  # requests on their way by url, shared by identical queries
+        self.limiter = asyncio.Lock()  # one request at a time, so pipelines sharing the client share the delay too
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        """
+        Names the endpoint of a URL, ie. the tracker search type or the Horaro path.
+        :param url: the full URL
+        :return: str
+        """
+        split = urlsplit(url)
+        return parse_qs(split.query).get('type', [split.path])[0]
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        key = self.endpoint(url)
+        if key not in self.breakers:
+            self.breakers[key] = CircuitBreaker(self.threshold, self.reset_after)
+        return self.breakers[key]
+
+    async def fetch(self, url: str) -> typing.Any:
+        """
+        Makes a single request.
+        :param url: the full URL
+        :return: json object
+        """
+        endpoint = self.endpoint(url)
+        try:
+            with metrics.timer('tracker_request_duration_seconds', endpoint=endpoint), tracing.span(f"GET {endpoint}"):
+                async with self.session.get(url, headers=self.headers) as r:
+                    metrics.inc('tracker_requests_total', endpoint=endpoint, status=str(r.status))
+                    if 400 <= r.status < 500 and r.status not in transient_statuses:
+                        raise QueryError("GET {} returned {} {}".format(url, r.status, await r.text()), r.status)
+                    if r.status != 200:
+                        raise TrackerError("GET {} returned {} {}".format(url, r.status, await r.text()))
+                    with tracing.span('parse'):
+                        jsondata = await r.json()
+                    age = response_age(r.headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            metrics.inc('tracker_requests_total', endpoint=endpoint, status='error')
+            raise TrackerError(f"GET {url} failed: {e!r}") from e
+        # a response a proxy had cached is as old as the proxy's request to the tracker
+        self.cache[url] = (time.monotonic() - age, jsondata, time.time() - age)
+        self.cache.move_to_end(url)
+        while len(self.cache) > self.max_cached:
+            self.cache.popitem(last=False)
+        return jsondata
+
+    async def fetch_with_retries(self, url: str, retries: typing.Optional[int]) -> typing.Any:
+        """
+        Requests a URL until it succeeds, the retries are used up or the endpoint's circuit opens.
+        :param url: the full URL
+        :param retries: attempts after the first one, None to keep trying forever
+        :return: json object
+        """
+        breaker = self.breaker(url)
+        attempt = 0
+        while True:
+            if breaker.open and retries is not None:
+                raise TrackerError(f"circuit for {self.endpoint(url)} is open")
+            async with self.limiter:
+                try:
+                    jsondata = await self.fetch(url)
+                except QueryError:
+                    raise
+                except TrackerError as e:
+                    error = e
+                else:
+                    breaker.success()
+                    with tracing.span('sleep'):
+                        await asyncio.sleep(self.delay)
+                    return jsondata
+            # back off without holding the limiter, other queries may still go through
+            breaker.failure()
+            if retries is not None and attempt >= retries:
+                raise error
+            sleep = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            print(f"{error} -- retrying in {sleep:.1f}s")
+            with tracing.span('backoff'):
+                await asyncio.sleep(sleep)
+            attempt += 1
+
+    async def revalidate(self, url: str):
+        try:
+            await self.fetch_with_retries(url, self.retries)
+        except TrackerError as e:
+            print(f"{e} -- still serving the last good response")
+        finally:
+            del self.refreshing[url]
+
+    async def get(self, query: str, max_age: float = 0.0, stale_for: float = 0.0, patient: bool = False) -> typing.Any:
+        """
+        Loads and processes an API page
+        :param query: the search parameters to query
+        :param max_age: seconds a cached response is returned without contacting the tracker
+        :param stale_for: seconds after max_age a cached response is still returned while it is refreshed in the
+            background
+        :param patient: retry until the tracker responds, for startup when there is nothing to fall back on
+        :return: json object
+        """
+        url = f"{self.base_url}{query}"
+        cache = f"tracker:{self.endpoint(url)}"
+        if url in self.cache:
+            self.cache.move_to_end(url)
+            fetched_at, jsondata, _ = self.cache[url]
+            age = time.monotonic() - fetched_at
+            if age < max_age:
+                metrics.inc('cache_requests_total', cache=cache, result='hit')
+                return jsondata
+            if age < max_age + stale_for:
+                metrics.inc('cache_requests_total', cache=cache, result='stale')
+                if url not in self.refreshing:
+                    self.refreshing[url] = asyncio.get_event_loop().create_task(self.revalidate(url))
+                return jsondata
+
+        if patient:
+            return await self.load(url, cache, patient)
+        if url in self.loading:  # the same query is already on its way, share its response
+            metrics.inc('cache_requests_total', cache=cache, result='coalesced')
+        else:
+            self.loading[url] = asyncio.ensure_future(self.load(url, cache, patient))
+            self.loading[url].add_done_callback(lambda _: self.loading.pop(url, None))
+        # one caller giving up (ie. a proxy client disconnecting) doesn't cancel the request for the others
+        return await asyncio.shield(self.loading[url])
+
+    def fetched_at(self, query: str) -> typing.Optional[float]:
+        """
+        Tells when the tracker sent the response get() returns for a query. That is long before the call when the last
+        good response is served during an outage, or when a proxy served it from its cache.
+        :param query: the search parameters
+        :return: unix time, None if it isn't cached
+        """
+        cached = self.cache.get(f"{self.base_url}{query}")
+        return cached[2] if cached is not None else None
+
+    async def load(self, url: str, cache: str, patient: bool) -> typing.Any:
+        try:
+            jsondata = await self.fetch_with_retries(url, None if patient else self.retries)
+        except TrackerError as e:
+            if url not in self.cache:
+                raise
+            metrics.inc('cache_requests_total', cache=cache, result='fallback')
+            print(f"{e} -- serving the last good response")
+            return self.cache[url][1]
+        metrics.inc('cache_requests_total', cache=cache, result='miss')
+        return jsondata
@@ -0,0 +1,125 @@
+import json
+import typing
+
+import aiohttp
+
+import metrics
+import tracing
+
+
+reddit_url = 'https://www.reddit.com'  # swapped out by the benchmarks for a local stand-in
+
+# request headers
+reddit_headers = {"headers": {"User-Agent": "simple-wiki-reader:v0.1 (/u/noellekiq)"}}  # add your own reddit username here?
+
+
+class WikiPage:
+    """
+    A reddit wiki page containing json. Allows the use of # as a comment character.
+    The page is only downloaded and parsed again once a new revision has been made.
+    stolen from https://github.com/blha303/gdq-scripts/blob/master/genvods.py
+    """
+
+    def __init__(self, wiki_page: str, subreddit: str = "VODThread", log_errors: bool = True):
+        self.wiki_page = wiki_page.lower()
+        self.subreddit = subreddit
+        self.log_errors = log_errors
+        self.revision: typing.Optional[str] = None  # ID of the parsed revision
+        self.data = []
+
+    @property
+    def url(self) -> str:
+        return f'{reddit_url}/r/{self.subreddit}/wiki/{self.wiki_page}.json'
+
+    async def latest_revision(self, session: aiohttp.ClientSession) -> typing.Optional[str]:
+        """
+        Gets the ID of the newest revision without downloading the page.
+        :return: revision ID, or None if it couldn't be checked
+        """
+        url = f'{reddit_url}/r/{self.subreddit}/wiki/revisions/{self.wiki_page}.json?limit=1'
+        async with session.get(url, **reddit_headers) as r:
+            if r.status != 200:
+                return None
+            jsondata = await r.json()
+        revisions = jsondata['data']['children']
+        return revisions[0]['id'] if revisions else None
+
+    async def refresh(self, session: aiohttp.ClientSession) -> bool:
+        """
+        Reloads the page if it has been edited since the last refresh.
+        :param session: aiohttp session
+        :return: whether the data changed
+        """
+        if self.revision is not None and await self.latest_revision(session) == self.revision:
+            metrics.inc('cache_requests_total', cache='wiki', result='hit')
+            return False
+        metrics.inc('cache_requests_total', cache='wiki', result='miss')
+        async with session.get(self.url, **reddit_headers) as r:
+            if r.status == 200:
+                jsondata = await r.json()
+            else:
+                if self.log_errors:
+                    print("GET {} returned {} {} -- ignoring".format(self.url, r.status, await r.text()))
+                return False
+        if jsondata['data'].get('revision_id') == self.revision and self.revision is not None:
+            return False
+        page = jsondata['data']['content_md'].replace("\r\n", "\n")
+        wiki_data = "\n".join([line.partition("#")[0].rstrip() for line in page.split("\n")])
+        self.data = json.loads(wiki_data)
+        self.revision = jsondata['data'].get('revision_id')
+        return True
+
+
+class VodIndex:
+    """
+    VOD links of an event's runs, keyed by run pk.
+    The VODThread wikis list VODs by run position, so they are mapped onto the run pks whenever a wiki is revised or
+    the schedule order changes, and the rendered link lines are kept until then. The renderer caches each run's message
+    on its inputs, VOD lines included, so a new VOD only re-renders the runs it was added to.
+    """
+
+    def __init__(self, event: str):
+        self.twitch = WikiPage(f'{event}vods')
+        self.youtube = WikiPage(f'{event}yt', log_errors=False)
+        self.order: typing.Tuple[int, ...] = ()  # run pks the wiki entries were mapped to
+        self.lines: typing.Dict[int, typing.List[str]] = {}  # dict of run_id: VOD link lines
+
+    async def refresh(self, session: aiohttp.ClientSession, run_ids: typing.Iterable[int]):
+        """
+        Reloads revised wiki pages and remaps the VODs onto the runs.
+        :param session: aiohttp session
+        :param run_ids: run pks in schedule order
+        :return: None
+        """
+        with tracing.span('vods'):
+            twitch_changed = await self.twitch.refresh(session)
+            youtube_changed = await self.youtube.refresh(session)
+        run_ids = tuple(run_ids)
+        if not twitch_changed and not youtube_changed and run_ids == self.order:
+            return
+        self.order = run_ids
+        self.lines = {run_id: self.render(runcount) for runcount, run_id in enumerate(run_ids)}
+
+    def render(self, runcount: int) -> typing.List[str]:
+        """
+        Formats the VOD links of the run at a position in the schedule.
+        :param runcount: position of the run
+        :return: list of lines
+        """
+        output = []
+        if len(self.twitch.data) - 1 >= runcount:
+            vodindex = self.twitch.data[runcount]
+            while vodindex:
+                output.append(f"<https://twitch.tv/videos/{vodindex[0]}?t={vodindex[1]}>")
+                vodindex = vodindex[2:]  # gets next link if there is another
+        if len(self.youtube.data) - 1 >= runcount:
+            vodindex = self.youtube.data[runcount]
+            if isinstance(vodindex, str):
+                vodindex = [vodindex]
+            for vod in vodindex:
+                if vod:  # can be blank strings from un-uploaded runs
+                    output.append(f"<https://youtu.be/{vod}>")
+        return output
+
+    def get(self, run_id: int) -> typing.List[str]:
+        return self.lines.get(run_id, [])
@@ -10,6 +10,10 @@ try:
 except ImportError:
     from yaml import Loader
 
+import catalog
+import series
+import state
+
 
 class Watcher:
     # request headers
@@ -20,17 +24,27 @@ class Watcher:
     fast_tick = 1000
     super_fast_tick = 100
     hit_target_at = None
+    resume_window = 300  # seconds a saved total is trusted for after a restart
 
     def __init__(self):
         self.config = load(open('config.yaml', 'r'), Loader)
+        self.store = state.open_store(self.config)
         # load event info
         if not isinstance(self.config['event_id'], int):
-            orig_id = self.config['event_id'].lower()
-            events = self.load_gdq_json(f"?type=event")
-            self.config['event_id'] = next((event['pk'] for event in events if event['fields']['short'].lower() == orig_id), None)
+            orig_id = self.config['event_id']
+            event_catalog = catalog.EventCatalog(self.store, self.config['gdq_url'])
+            if event_catalog.lookup(orig_id) is None:  # new event, or no catalog yet
+                event_catalog.update(self.load_gdq_json(f"?type=event"))
+            self.config['event_id'] = event_catalog.lookup(orig_id)
             if self.config['event_id'] is None:
                 print(f"Could not find event {orig_id}")
                 exit()
+        self.namespace = f"watcher:{self.config['event_id']}"
+        hit_target_at = self.store.get(self.namespace, 'hit_target_at')
+        if hit_target_at:
+            self.hit_target_at = datetime.fromisoformat(hit_target_at)
+        self.last_total = self.store.get(self.namespace, 'last_total', 0, max_age=self.resume_window)
+        self.series = series.open_series(self.config, self.config['event_id'])
         while True:
             self.processor()
 
@@ -58,10 +72,13 @@ class Watcher:
 
     def load_donation_total(self) -> float:
         """
-        Returns the current GDQ donation total
+        Returns the current GDQ donation total, and adds it to the donation history
         :return: float
         """
-        return float(self.load_gdq_index()['amount'])
+        index = self.load_gdq_index()
+        if self.series is not None:
+            self.series.record(index)
+        return float(index['amount'])
 
     def get_prev_target(self, total) -> float:
         return total - (total % self.target_modulo)
@@ -73,8 +90,10 @@ class Watcher:
         total = self.load_donation_total()
         target = self.get_next_target(total)
         prev_target = self.get_prev_target(total)
-        if self.last_total > 0 and self.get_next_target(self.last_total) != target:
+        if self.last_total > 0 and self.get_next_target(self.last_total) != target and \
+                self.store.claim(f"target:{self.config['event_id']}:{prev_target:.0f}"):
             self.hit_target_at = datetime.now()
+            self.store.set(self.namespace, 'hit_target_at', self.hit_target_at.isoformat())
             os.system('notify-send " ! ! ! ! ! A donation target has been reached ! ! ! ! ! " --urgency=critical --app-name="GDQ Watcher" --icon=kmymoney')
 
         os.system('clear')
@@ -88,6 +107,11 @@ class Watcher:
         diff_until_next = target - total
         print(f"$ Until Target: ${diff_until_next:,.2f}")
         print("")
+        if self.series is not None:
+            now = time.time()
+            print(f"Last 10 Minutes: ${float(self.series.rate(now - 600, now)):,.2f}/hour")
+            print(f"Last Hour:       ${float(self.series.rate(now - 3600, now)):,.2f}/hour")
+            print("")
         print(f"Last updated at {datetime.now()}")
 
         prev_diff_until_next = self.get_next_target(self.last_total) - self.last_total
@@ -97,6 +121,7 @@ class Watcher:
             os.system('notify-send "A donation target is approaching! (<\$1000)" --urgency=normal --expire-time=20000 --app-name="GDQ Watcher" --icon=data-information')
 
         self.last_total = total
+        self.store.set(self.namespace, 'last_total', total)
         if diff_until_next <= self.super_fast_tick:
             time.sleep(0.2)
         elif diff_until_next <= self.fast_tick: